@@ -1,9 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from api_collector.air_tickets import air_api_data
 from api_collector.utils.directories import data_directory_path
+from api_collector.utils.currency import convert_price
+from api_collector.utils.response_cache import cached_response
+from api_collector.utils.decoding import loads
+from api_collector.utils.media_cache import media_cache
 import os
 from api_collector.air_tickets.flight_enums import Currency, Market, Sorting, GroupBy, PeriodType, TripClass
 
+# ticket prices are updated by upstream several times an hour
+TICKET_PRICES_TTL = 10 * 60
+# requests which get no response in this number of seconds fail, so abandoned searches do not hang
+REQUEST_TIMEOUT = 15
+# max number of airline logos downloaded at the same time
+LOGO_CONCURRENCY = 8
+
+
+def convert_ticket_prices(response, rate, currency):
+    """
+    Converts prices of 'fetch_cheapest_tickets' and 'fetch_grouped_tickets' responses
+
+    :param response: response with prices in rubles
+    :param rate: units of the currency per ruble
+    :param currency: code of the currency
+    :return: copy of the response with converted prices
+    """
+    def convert(ticket):
+        return {**ticket, 'price': convert_price(ticket['price'], rate), 'currency': currency}
+
+    data = response.get('data')
+    if isinstance(data, list):
+        data = [convert(ticket) for ticket in data]
+    elif isinstance(data, dict):
+        # grouped tickets contain the cheapest ticket or the list of tickets for every group
+        data = {group: [convert(ticket) for ticket in tickets] if isinstance(tickets, list) else convert(tickets)
+                for group, tickets in data.items()}
+    return {**response, 'data': data, 'currency': currency}
+
+
+def convert_ticket_values(response, rate, currency):
+    """
+    Converts prices of 'fetch_period_tickets' and 'fetch_alternative_route_tickets' responses,
+    which are kept in the 'value' field of 'data' or 'prices' lists
+    """
+    converted = {**response, 'currency': currency}
+    for field in ('data', 'prices'):
+        if isinstance(response.get(field), list):
+            converted[field] = [{**ticket, 'value': convert_price(ticket['value'], rate)}
+                                for ticket in response[field]]
+    return converted
+
 
 class AirTicketsApi:
     """
@@ -23,6 +70,7 @@ class AirTicketsApi:
         self.fetch_airline_logos_url_base = air_api_data.fetch_airline_logos_url_base
         self.air_logo_dir = "/photos/airline_logos"
 
+    @cached_response(ttl=TICKET_PRICES_TTL, convert_prices=convert_ticket_prices)
     def fetch_cheapest_tickets(self,
                                currency=Currency.RUB,
                                origin=None,
@@ -95,7 +143,7 @@ class AirTicketsApi:
 
         try:
             # Send a GET request to fetch the cheapest tickets
-            response = requests.get(self.fetch_cheapest_tickets_url,
+            response = requests.get(self.fetch_cheapest_tickets_url, timeout=REQUEST_TIMEOUT,
                                     params=params)
             # Check if the request was successful
             if response.status_code != 200:
@@ -104,12 +152,13 @@ class AirTicketsApi:
                     f"Failed to fetch cheapest tickets. Status code: {response.status_code}"
                 )
             # Return the JSON content of the response
-            return response.json()
+            return loads(response.content)
 
         except requests.exceptions.RequestException as e:
             # Catch any request-related exceptions (e.g., timeouts, connection errors)
             raise Exception("There was an error making the request.") from e
 
+    @cached_response(ttl=TICKET_PRICES_TTL, convert_prices=convert_ticket_prices)
     def fetch_grouped_tickets(self,
                               currency=Currency.RUB,
                               origin=None,
@@ -173,7 +222,7 @@ class AirTicketsApi:
 
         try:
             # Send a GET request to fetch grouped tickets
-            response = requests.get(self.fetch_grouped_tickets_url,
+            response = requests.get(self.fetch_grouped_tickets_url, timeout=REQUEST_TIMEOUT,
                                     params=params)
             # Check if the request was successful
             if response.status_code != 200:
@@ -182,12 +231,13 @@ class AirTicketsApi:
                     f"Failed to fetch cheapest tickets. Status code: {response.status_code}"
                 )
             # Return the JSON content of the response
-            return response.json()
+            return loads(response.content)
 
         except requests.exceptions.RequestException as e:
             # Catch any request-related exceptions (e.g., timeouts, connection errors)
             raise Exception("There was an error making the request.") from e
 
+    @cached_response(ttl=TICKET_PRICES_TTL, convert_prices=convert_ticket_values)
     def fetch_period_tickets(self,
                              currency=Currency.RUB,
                              origin='MOW',
@@ -257,7 +307,7 @@ class AirTicketsApi:
 
         try:
             # Send a GET request to fetch period tickets
-            response = requests.get(self.fetch_period_tickets_url,
+            response = requests.get(self.fetch_period_tickets_url, timeout=REQUEST_TIMEOUT,
                                     params=params)
             # Check if the request was successful
             if response.status_code != 200:
@@ -266,12 +316,13 @@ class AirTicketsApi:
                     f"Failed to fetch period tickets. Status code: {response.status_code}"
                 )
             # Return the JSON content of the response
-            return response.json()
+            return loads(response.content)
 
         except requests.exceptions.RequestException as e:
             # Catch any request-related exceptions (e.g., timeouts, connection errors)
             raise Exception("There was an error making the request.") from e
 
+    @cached_response(ttl=TICKET_PRICES_TTL, convert_prices=convert_ticket_values)
     def fetch_alternative_route_tickets(self,
                                         currency=Currency.RUB,
                                         origin=None,
@@ -332,7 +383,7 @@ class AirTicketsApi:
 
         try:
             # Send a GET request to fetch alternative route tickets
-            response = requests.get(self.fetch_alternative_route_tickets_url,
+            response = requests.get(self.fetch_alternative_route_tickets_url, timeout=REQUEST_TIMEOUT,
                                     params=params)
             # Check if the request was successful
             if response.status_code != 200:
@@ -341,7 +392,7 @@ class AirTicketsApi:
                     f"Failed to fetch alternative route tickets. Status code: {response.status_code}"
                 )
             # Return the JSON content of the response
-            return response.json()
+            return loads(response.content)
 
         except requests.exceptions.RequestException as e:
             # Catch any request-related exceptions (e.g., timeouts, connection errors)
@@ -386,7 +437,7 @@ class AirTicketsApi:
 
         try:
             # Send a GET request to fetch popular routes from the city
-            response = requests.get(self.fetch_popular_routes_from_city_url,
+            response = requests.get(self.fetch_popular_routes_from_city_url, timeout=REQUEST_TIMEOUT,
                                     params=params)
             # Check if the request was successful
             if response.status_code != 200:
@@ -395,7 +446,7 @@ class AirTicketsApi:
                     f"Failed to fetch popular routes. Status code: {response.status_code}"
                 )
             # Return the JSON content of the response
-            return response.json()
+            return loads(response.content)
 
         except requests.exceptions.RequestException as e:
             # Catch any request-related exceptions (e.g., timeouts, connection errors)
@@ -405,32 +456,67 @@ class AirTicketsApi:
         """
         Fetches the logo for a single airline based on its IATA code and saves it as a.png file
         Airline logo is saved to /data/photos/airline_logos/<iata_code>.png
+        The logo is taken from the media cache, it is downloaded only if it is not cached or changed.
 
         :param iata_code: IATA code of the airline whose logo needs to be fetched.
         :param height: Desired height of the logo in pixels.
         :param width: Desired width of the logo in pixels.
-        :return: None
+        :return: path to the saved logo
         """
 
-        logo_directory = data_directory_path() + self.air_logo_dir
-        os.makedirs(logo_directory,
-                    exist_ok=True)  # Ensure the directory exists
-
-        # Construct the URL for the airline logo using the base URL, IATA code, and dimensions
-        logo_url = f"{self.fetch_airline_logos_url_base}{width}/{height}/{iata_code}.png"
-        # Define the local path for saving the logo
-        logo_path = os.path.join(logo_directory, f"{iata_code}.png")
+        logo_url, logo_path = self.airline_logo_location(iata_code, height=height, width=width)
 
         # Attempt to fetch the logo
         try:
-            response = requests.get(logo_url)
-            # If the request is successful, save the logo to the local directory
-            if response.status_code == 200:
-                with open(logo_path, 'wb') as file:
-                    file.write(response.content)
-            else:
-                raise Exception(
-                    f"Failed to fetch cheapest tickets. Status code: {response.status_code}"
-                )
+            return media_cache.fetch(key=f'logo/{iata_code}', url=logo_url, path=logo_path)
         except requests.exceptions.RequestException as e:
             raise Exception(f"Failed to fetch logo for {iata_code}: {str(e)}")
+
+    def fetch_airline_logos(self, airlines, height=100, width=100, max_workers=LOGO_CONCURRENCY) -> dict:
+        """
+        Fetches logos of all airlines of the result set. Logos which are already cached are returned
+        without requests, the rest are downloaded concurrently.
+
+        :param airlines: IATA codes of airlines, e.g. 'airline' fields of found tickets, may repeat
+        :param height: Desired height of the logo in pixels.
+        :param width: Desired width of the logo in pixels.
+        :param max_workers: max number of logos downloaded at the same time
+        :return: dictionary IATA code -> path to the saved logo, airlines which logos failed are missing
+        """
+        logos = {}
+        missing = []
+        for iata_code in dict.fromkeys(airline for airline in airlines if airline):
+            logo_url, _ = self.airline_logo_location(iata_code, height=height, width=width)
+            logo_path = media_cache.lookup(key=f'logo/{iata_code}', url=logo_url)
+            if logo_path is None:
+                missing.append(iata_code)
+            else:
+                logos[iata_code] = logo_path
+        if len(missing) == 0:
+            return logos
+
+        def fetch(iata_code):
+            try:
+                return self.fetch_airline_logo(iata_code, height=height, width=width)
+            except Exception:
+                # the route is shown without the logo
+                return None
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as executor:
+            for iata_code, logo_path in zip(missing, executor.map(fetch, missing)):
+                if logo_path is not None:
+                    logos[iata_code] = logo_path
+        return logos
+
+    def airline_logo_location(self, iata_code, height=100, width=100) -> tuple[str, str]:
+        """
+        :param iata_code: IATA code of the airline
+        :param height: Desired height of the logo in pixels.
+        :param width: Desired width of the logo in pixels.
+        :return: tuple (url of the logo, local path of the logo)
+        """
+        # Construct the URL for the airline logo using the base URL, IATA code, and dimensions
+        logo_url = f"{self.fetch_airline_logos_url_base}{width}/{height}/{iata_code}.png"
+        # Define the local path for saving the logo
+        logo_path = os.path.join(data_directory_path() + self.air_logo_dir, f"{iata_code}.png")
+        return logo_url, logo_path
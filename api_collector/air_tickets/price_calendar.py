@@ -0,0 +1,245 @@
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from api_collector.air_tickets.air_tickets_api import AirTicketsApi
+from api_collector.air_tickets.flight_enums import Currency
+from api_collector.utils.directories import data_directory_path
+import os
+
+# prices found earlier are not used to answer questions by default
+PRICE_MAX_AGE = 12 * 60 * 60
+# full history of prices is kept for this number of days, older prices are compacted
+PRICE_HISTORY_DAYS = 30
+# number of days before and after the departure date where cheaper dates are looked for
+FLEXIBLE_DAYS = 3
+# a date is suggested only if its price is lower at least by this share
+CHEAPER_DATE_MARGIN = 0.05
+
+
+class PriceCalendar:
+    """
+    Local time series of ticket prices. Every row is the cheapest price of the direction for
+    the departure date found at a moment of time (origin, destination, date, price, found_at).
+    Rows are collected from ticket responses, so flexible date questions can be answered
+    without upstream calls. Prices are stored in rubles.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: path to the SQLite database, by default 'air_tickets/price_calendar.sqlite3'
+            in the data directory, ':memory:' keeps the calendar in memory
+        """
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # the database is opened on the first use, so importing the module does not touch the disk
+        if self.connection is None:
+            if self.path is None:
+                directory = data_directory_path() + '/air_tickets'
+                os.makedirs(directory, exist_ok=True)
+                self.path = directory + '/price_calendar.sqlite3'
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS prices (
+                    origin TEXT NOT NULL,
+                    destination TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    price REAL NOT NULL,
+                    found_at TEXT NOT NULL,
+                    UNIQUE (origin, destination, date, found_at)
+                )""")
+            # range queries read the index only
+            self.connection.execute("""
+                CREATE INDEX IF NOT EXISTS prices_by_date
+                ON prices (origin, destination, date, found_at, price)""")
+            self.connection.commit()
+        return self.connection
+
+    def add(self, rows):
+        """
+        Saves prices, several prices of the direction for the same date and the same moment are
+        reduced to the cheapest one
+
+        :param rows: iterable of tuples (origin, destination, date (YYYY-MM-DD), price, found_at (datetime))
+        :return: number of saved rows
+        """
+        cheapest = {}
+        for origin, destination, date, price, found_at in rows:
+            key = (origin, destination, date[:10], _format_time(found_at))
+            if key not in cheapest or price < cheapest[key]:
+                cheapest[key] = price
+        with self.lock:
+            connection = self.connect()
+            before = connection.total_changes
+            connection.executemany("INSERT OR IGNORE INTO prices VALUES (?, ?, ?, ?, ?)",
+                                   [(origin, destination, date, price, found_at)
+                                    for (origin, destination, date, found_at), price in cheapest.items()])
+            connection.commit()
+            return connection.total_changes - before
+
+    def get_prices(self, origin, destination, start_date, end_date, max_age=PRICE_MAX_AGE) -> list[tuple]:
+        """
+        Returns the latest known price for every departure date in the range
+
+        :param origin: str, IATA code of the departure city
+        :param destination: str, IATA code of the destination city
+        :param start_date: str, first departure date (format YYYY-MM-DD)
+        :param end_date: str, last departure date (format YYYY-MM-DD)
+        :param max_age: max age of prices in seconds, None means prices of any age
+        :return: list of tuples (date, price, found_at) sorted by date
+        """
+        found_after = '' if max_age is None else _format_time(datetime.utcnow() - timedelta(seconds=max_age))
+        with self.lock:
+            # SQLite takes the price and the date from the row with the latest 'found_at'
+            rows = self.connect().execute("""
+                SELECT date, price, MAX(found_at) FROM prices
+                WHERE origin = ? AND destination = ? AND date BETWEEN ? AND ? AND found_at >= ?
+                GROUP BY date ORDER BY date""", (origin, destination, start_date, end_date, found_after)).fetchall()
+        return rows
+
+    def get_cheapest_date(self, origin, destination, start_date, end_date, max_age=PRICE_MAX_AGE):
+        """
+        Finds the cheapest departure date in the range
+
+        :return: tuple (date, price, found_at), None if no fresh prices are known
+        """
+        prices = self.get_prices(origin, destination, start_date, end_date, max_age=max_age)
+        return min(prices, key=lambda row: row[1], default=None)
+
+    def get_cheapest_months(self, origin, destination, start_date, end_date, max_age=PRICE_MAX_AGE) -> dict:
+        """
+        Finds the cheapest known price of every month in the range
+
+        :return: dictionary month (YYYY-MM) -> tuple (date, price, found_at)
+        """
+        months = {}
+        for row in self.get_prices(origin, destination, start_date, end_date, max_age=max_age):
+            month = row[0][:7]
+            if month not in months or row[1] < months[month][1]:
+                months[month] = row
+        return months
+
+    def suggest_cheaper_date(self, origin, destination, date, price, days=FLEXIBLE_DAYS, max_age=PRICE_MAX_AGE):
+        """
+        Finds a nearby departure date with cheaper tickets among prices found by earlier searches,
+        so travellers with flexible dates can be offered it without upstream calls
+
+        :param origin: str, IATA code of the departure city
+        :param destination: str, IATA code of the destination city
+        :param date: str, chosen departure date (format YYYY-MM-DD)
+        :param price: float, price of the chosen ticket in rubles
+        :param days: number of days before and after the date which are looked through
+        :param max_age: max age of prices in seconds, None means prices of any age
+        :return: tuple (date, price, found_at) of the cheapest nearby date, None if no date is cheaper enough
+        """
+        day = datetime.strptime(date[:10], '%Y-%m-%d')
+        # past dates can not be offered
+        start_date = max((day - timedelta(days=days)).strftime('%Y-%m-%d'), datetime.utcnow().strftime('%Y-%m-%d'))
+        end_date = (day + timedelta(days=days)).strftime('%Y-%m-%d')
+        cheapest = self.get_cheapest_date(origin, destination, start_date, end_date, max_age=max_age)
+        if cheapest is None or cheapest[0] == date[:10] or cheapest[1] > price * (1 - CHEAPER_DATE_MARGIN):
+            return None
+        return cheapest
+
+    def get_history(self, origin, destination, date) -> list[tuple]:
+        """
+        :return: list of tuples (found_at, price) of the departure date sorted by time
+        """
+        with self.lock:
+            return self.connect().execute("""
+                SELECT found_at, price FROM prices WHERE origin = ? AND destination = ? AND date = ?
+                ORDER BY found_at""", (origin, destination, date)).fetchall()
+
+    def compact(self, history_days=PRICE_HISTORY_DAYS, today=None) -> int:
+        """
+        Deletes prices of past departure dates and prices older than 'history_days'
+        except the latest price of every date
+
+        :param history_days: number of days of the full history to keep
+        :param today: str, optional, current date (format YYYY-MM-DD)
+        :return: number of deleted rows
+        """
+        today = today or datetime.utcnow().strftime('%Y-%m-%d')
+        found_before = _format_time(datetime.utcnow() - timedelta(days=history_days))
+        with self.lock:
+            connection = self.connect()
+            before = connection.total_changes
+            connection.execute("DELETE FROM prices WHERE date < ?", (today,))
+            connection.execute("""
+                DELETE FROM prices WHERE found_at < ? AND EXISTS (
+                    SELECT 1 FROM prices AS newer
+                    WHERE newer.origin = prices.origin AND newer.destination = prices.destination
+                    AND newer.date = prices.date AND newer.found_at > prices.found_at)""", (found_before,))
+            connection.commit()
+            return connection.total_changes - before
+
+    def record_cheapest_tickets(self, arguments, response):
+        """
+        Saves prices from the response of 'fetch_cheapest_tickets'
+
+        :param arguments: dictionary of arguments of the request
+        :param response: response of the request
+        """
+        if arguments.get('currency') != Currency.RUB or not response.get('success'):
+            return
+        now = datetime.utcnow()
+        self.add((ticket['origin'], ticket['destination'], ticket['departure_at'], ticket['price'], now)
+                 for ticket in response['data'])
+
+    def record_grouped_tickets(self, arguments, response):
+        """
+        Saves prices from the response of 'fetch_grouped_tickets'
+        """
+        if arguments.get('currency') != Currency.RUB or not response.get('success'):
+            return
+        now = datetime.utcnow()
+        rows = []
+        for tickets in response['data'].values():
+            # every group contains the cheapest ticket or the list of tickets
+            for ticket in (tickets if isinstance(tickets, list) else [tickets]):
+                rows.append((ticket['origin'], ticket['destination'], ticket['departure_at'], ticket['price'], now))
+        self.add(rows)
+
+    def record_period_tickets(self, arguments, response):
+        """
+        Saves prices from the response of 'fetch_period_tickets', upstream time of every price is kept
+        """
+        if arguments.get('currency') != Currency.RUB or not response.get('success'):
+            return
+        now = datetime.utcnow()
+        self.add((ticket['origin'], ticket['destination'], ticket['depart_date'], ticket['value'],
+                  _parse_time(ticket.get('found_at'), now))
+                 for ticket in response['data'])
+
+    def record_responses(self):
+        """
+        Starts saving prices from all new responses of ticket requests
+        """
+        for method, record in ((AirTicketsApi.fetch_cheapest_tickets, self.record_cheapest_tickets),
+                               (AirTicketsApi.fetch_grouped_tickets, self.record_grouped_tickets),
+                               (AirTicketsApi.fetch_period_tickets, self.record_period_tickets)):
+            if record not in method.response_cache.listeners:
+                method.response_cache.listeners.append(record)
+
+
+def _format_time(moment):
+    # times are stored in UTC as text, so they are compared in the order of time
+    if isinstance(moment, str):
+        return moment
+    return moment.strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def _parse_time(value, default):
+    try:
+        moment = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return default
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+# calendar shared by the whole application
+price_calendar = PriceCalendar()
@@ -0,0 +1,169 @@
+import asyncio
+import json
+import threading
+import time
+from api_collector.hotels.hotel_api import HotelApi
+from api_collector.utils.directories import data_directory_path
+import os
+
+# catalogs are refreshed after this number of seconds, types of hotels and rooms almost never change
+CATALOG_TTL = 7 * 24 * 60 * 60
+# catalogs are checked in the background with this interval in seconds
+CATALOG_CHECK_INTERVAL = 60 * 60
+# ids of property types of hotels offered in routes by default, their names are in the 'hotel_types' catalog
+ROUTE_HOTEL_TYPES = (1, 2, 3, 12)
+
+
+class Catalog:
+    """
+    Lookup table of ids and names (types of hotels or rooms) kept in memory. The table is loaded once
+    from the data directory, requests are made only by 'refresh' when the saved table is missing or
+    older than 'ttl', so lookups never wait for the network.
+    """
+
+    def __init__(self, file_name, fetch, path=None, ttl=CATALOG_TTL):
+        """
+        :param file_name: name of the json file of the table in 'hotels' directory of the data directory
+        :param fetch: function without arguments which returns dictionary id -> name from upstream
+        :param path: path to the json file of the table, by default 'file_name' in the data directory
+        :param ttl: time to live of the table in seconds
+        """
+        self.file_name = file_name
+        self.fetch = fetch
+        self.path = path
+        self.ttl = ttl
+        # id -> name and lowercase name -> id
+        self.names = {}
+        self.ids = {}
+        self.updated_at = 0
+        self.is_loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Loads the saved table, the table is empty until 'refresh' if nothing is saved
+        """
+        with self.lock:
+            self.is_loaded = True
+            if not os.path.exists(self._path()):
+                return
+            with open(self._path()) as file:
+                data = json.load(file)
+            updated_at = os.path.getmtime(self._path())
+        self.set_names(data, updated_at)
+
+    def refresh(self):
+        """
+        Fetches the table from upstream and saves it
+        """
+        data = self.fetch()
+        path = self._path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the table is replaced only when it is written completely
+        with open(path + '.tmp', 'w') as file:
+            json.dump(data, file, indent=4)
+        os.replace(path + '.tmp', path)
+        self.set_names(data)
+
+    def set_names(self, names, updated_at=None):
+        """
+        :param names: dictionary id -> name, ids may be strings of json keys
+        :param updated_at: time of the table, now by default
+        """
+        names = {int(type_id): name for type_id, name in names.items()}
+        with self.lock:
+            self.names = names
+            self.ids = {name.strip().lower(): type_id for type_id, name in names.items() if isinstance(name, str)}
+            self.updated_at = time.time() if updated_at is None else updated_at
+            self.is_loaded = True
+
+    def is_stale(self):
+        return time.time() - self.updated_at > self.ttl
+
+    def name(self, type_id):
+        """
+        :param type_id: id of the type
+        :return: name of the type, None if it is unknown
+        """
+        self._ensure_loaded()
+        return self.names.get(int(type_id))
+
+    def id(self, name):
+        """
+        :param name: name of the type, case does not matter
+        :return: id of the type, None if it is unknown
+        """
+        self._ensure_loaded()
+        return self.ids.get(name.strip().lower())
+
+    def resolve(self, types) -> tuple:
+        """
+        :param types: ids or names of types
+        :return: tuple of ids, unknown names are dropped
+        """
+        ids = []
+        for type_id in types:
+            if isinstance(type_id, str) and not type_id.isdigit():
+                type_id = self.id(type_id)
+            if type_id is not None:
+                ids.append(int(type_id))
+        return tuple(ids)
+
+    def _ensure_loaded(self):
+        if not self.is_loaded:
+            self.load()
+
+    def _path(self):
+        # the data directory is resolved on the first use
+        if self.path is None:
+            self.path = data_directory_path() + '/hotels/' + self.file_name
+        return self.path
+
+
+class Catalogs:
+    """
+    Catalogs of the application, they are loaded at startup and refreshed in the background
+    """
+
+    def __init__(self, catalogs):
+        """
+        :param catalogs: list of 'Catalog'
+        """
+        self.catalogs = catalogs
+
+    def load(self):
+        for catalog in self.catalogs:
+            catalog.load()
+
+    def refresh_stale(self) -> int:
+        """
+        Refreshes catalogs which are missing or older than their ttl
+
+        :return: number of refreshed catalogs
+        """
+        refreshed = 0
+        for catalog in self.catalogs:
+            if catalog.is_stale():
+                try:
+                    catalog.refresh()
+                    refreshed += 1
+                except Exception:
+                    # the saved table is used until the next check
+                    pass
+        return refreshed
+
+    async def run(self, interval=CATALOG_CHECK_INTERVAL):
+        """
+        Refreshes stale catalogs in the background until the task is cancelled
+
+        :param interval: time between checks in seconds
+        """
+        while True:
+            await asyncio.to_thread(self.refresh_stale)
+            await asyncio.sleep(interval)
+
+
+# catalogs shared by the whole application
+hotel_types = Catalog('hotels_type.json', lambda: HotelApi().fetch_hotel_types())
+room_types = Catalog('room_types.json', lambda: HotelApi().fetch_room_types())
+catalogs = Catalogs([hotel_types, room_types])
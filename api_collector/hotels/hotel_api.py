@@ -1,9 +1,49 @@
 import requests
 from api_collector.hotels import hotel_api_data
 from api_collector.utils.directories import data_directory_path
+from api_collector.utils.currency import convert_price
+from api_collector.utils.response_cache import cached_response
+from api_collector.utils.decoding import loads, decode_hotel_prices, decode_hotel_list, iterate_hotel_prices, \
+    iterate_json_array
+from api_collector.utils.media_cache import media_cache
+from api_collector.utils.thumbnails import thumbnail_pipeline
 import os
 from api_collector.hotels.hotel_enums import Language, LookFor, ConvertCase, Currency, CollectionType
-import json
+
+# requests which get no response in this number of seconds fail, so abandoned searches do not hang
+REQUEST_TIMEOUT = 15
+# hotel prices are updated by upstream several times an hour
+HOTEL_PRICES_TTL = 10 * 60
+# locations almost never change
+LOCATIONS_TTL = 24 * 60 * 60
+
+
+def convert_hotel_prices(response, rate, currency):
+    """
+    Converts prices of 'fetch_hotel_prices' response
+
+    :param response: list of hotels with prices in rubles
+    :param rate: units of the currency per ruble
+    :param currency: code of the currency
+    :return: copy of the response with converted prices
+    """
+    def convert(hotel):
+        hotel = {**hotel,
+                 'priceFrom': convert_price(hotel.get('priceFrom'), rate),
+                 'priceAvg': convert_price(hotel.get('priceAvg'), rate)}
+        # slim records have no price percentiles
+        if 'pricePercentile' in hotel:
+            hotel['pricePercentile'] = {percent: convert_price(price, rate)
+                                        for percent, price in hotel['pricePercentile'].items()}
+        return hotel
+
+    return [convert(hotel) for hotel in response]
+
+
+class UpstreamError(Exception):
+    """
+    The request failed or upstream responded with an error status, callers with a fallback catch only this
+    """
 
 
 class HotelApi:
@@ -28,6 +68,7 @@ class HotelApi:
         self.hotel_types_dir = "/hotels"
         self.hotels_list_dir = "/hotels"
 
+    @cached_response(ttl=LOCATIONS_TTL)
     def search_hotel_or_location(self,
                                  query,
                                  lang=Language.EN,
@@ -80,7 +121,7 @@ class HotelApi:
 
         try:
             # Making the GET request
-            response = requests.get(self.search_hotel_or_location_url,
+            response = requests.get(self.search_hotel_or_location_url, timeout=REQUEST_TIMEOUT,
                                     params=params)
             # Check if the request was successful
             if response.status_code != 200:
@@ -89,12 +130,13 @@ class HotelApi:
                     f"Failed to search hotel or location. Status code: {response.status_code}"
                 )
             # Return the JSON content of the response
-            return response.json()
+            return loads(response.content)
 
         except requests.exceptions.RequestException as e:
             # Catch any request-related exceptions (e.g., timeouts, connection errors)
             raise Exception("There was an error making the request.") from e
 
+    @cached_response(ttl=HOTEL_PRICES_TTL, maxsize=256, convert_prices=convert_hotel_prices)
     def fetch_hotel_prices(self,
                            location,
                            check_in,
@@ -105,7 +147,8 @@ class HotelApi:
                            adults=2,
                            limit=5,
                            customer_ip=None,
-                           currency=Currency.RUB):
+                           currency=Currency.RUB,
+                           slim=False):
         """
         Fetches hotel prices based on the provided parameters.
 
@@ -120,20 +163,22 @@ class HotelApi:
         - limit: Number of hotels to return. Default is 4.
         - customer_ip: IP address of the user for non-direct requests through server proxy.
         - currency: Currency of the response.
+        - slim: If True, only fields used by the route search are kept, 'pricePercentile', 'geo' and 'state'
+          are dropped right after parsing, so cached responses take less memory.
         - token: Your partner token.
 
         Returns:
-            A dictionary containing the hotel price information. The structure includes:
+            A list of hotels with price information. The structure includes:
             - 'stars': Number of stars.
             - 'locationId': ID of the location of the hotel.
             - 'priceFrom': Minimum price for staying at the hotel room during the specified period.
             - 'priceAvg': Average price for staying at the hotel room during the specified period.
-            - 'pricePercentile': Price distribution by percentages.
+            - 'pricePercentile': Price distribution by percentages (not in slim records).
             - 'hotelName': Name of the hotel.
             - 'location': Information about the hotel location.
-                - 'geo': Coordinates of the location (city).
+                - 'geo': Coordinates of the location (city) (not in slim records).
                 - 'name': Name of the location (city).
-                - 'state': State where the city is located.
+                - 'state': State where the city is located (not in slim records).
                 - 'country': Country of the hotel.
             - 'hotelId': ID of the hotel.
         """
@@ -154,7 +199,7 @@ class HotelApi:
 
         try:
             # Making the GET request
-            response = requests.get(self.fetch_hotel_prices_url, params=params)
+            response = requests.get(self.fetch_hotel_prices_url, timeout=REQUEST_TIMEOUT, params=params)
             # Check if the request was successful
             if response.status_code != 200:
                 # Raise an exception if the response status code indicates failure
@@ -162,12 +207,73 @@ class HotelApi:
                     f"Failed to fetch hotel prices. Status code: {response.status_code}"
                 )
             # Return the JSON content of the response
-            return response.json()
+            if slim:
+                return decode_hotel_prices(response.content)
+            return loads(response.content)
 
         except requests.exceptions.RequestException as e:
             # Catch any request-related exceptions (e.g., timeouts, connection errors)
             raise Exception("There was an error making the request.") from e
 
+    def iterate_hotel_prices(self,
+                             location,
+                             check_in,
+                             check_out,
+                             location_id=None,
+                             adults=2,
+                             limit=5,
+                             currency=Currency.RUB,
+                             slim=False):
+        """
+        Streaming version of 'fetch_hotel_prices'. The response is not cached, hotels are parsed
+        while the response is downloaded, so the whole list is never kept in memory.
+
+        Parameters:
+        - location: Name of the location (can use IATA code).
+        - check_in: Check-in date.
+        - check_out: Check-out date.
+        - location_id: ID of the location (can be used instead of location).
+        - adults: Number of guests (default is 2).
+        - limit: Number of hotels to return.
+        - currency: Currency of the response.
+        - slim: If True, only fields used by the route search are kept.
+
+        Returns:
+            A generator of hotels in the format of 'fetch_hotel_prices'.
+        """
+        # Constructing the query string
+        params = {
+            'location': location,
+            'checkIn': check_in,
+            'checkOut': check_out,
+            'locationId': location_id,
+            'adults': adults,
+            'limit': limit,
+            'currency': currency.value,
+            'token': self.api_token
+        }
+
+        try:
+            # Making the GET request, the body is read chunk by chunk
+            with requests.get(self.fetch_hotel_prices_url, timeout=REQUEST_TIMEOUT, params=params,
+                              stream=True) as response:
+                # Check if the request was successful
+                if response.status_code != 200:
+                    # Raise an exception if the response status code indicates failure
+                    raise Exception(
+                        f"Failed to fetch hotel prices. Status code: {response.status_code}"
+                    )
+                chunks = response.iter_content(chunk_size=64 * 1024)
+                if slim:
+                    yield from iterate_hotel_prices(chunks)
+                else:
+                    yield from iterate_json_array(chunks)
+
+        except requests.exceptions.RequestException as e:
+            # Catch any request-related exceptions (e.g., timeouts, connection errors)
+            raise Exception("There was an error making the request.") from e
+
+    @cached_response(ttl=HOTEL_PRICES_TTL, maxsize=256)
     def fetch_hotel_collections(self,
                                 check_in,
                                 check_out,
@@ -226,20 +332,20 @@ class HotelApi:
 
         try:
             # Making the GET request
-            response = requests.get(self.fetch_hotel_collections_url,
+            response = requests.get(self.fetch_hotel_collections_url, timeout=REQUEST_TIMEOUT,
                                     params=params)
             # Check if the request was successful
             if response.status_code != 200:
                 # Raise an exception if the response status code indicates failure
-                raise Exception(
+                raise UpstreamError(
                     f"Failed to fetch hotel collections. Status code: {response.status_code}"
                 )
             # Return the JSON content of the response
-            return response.json()
+            return loads(response.content)
 
         except requests.exceptions.RequestException as e:
             # Catch any request-related exceptions (e.g., timeouts, connection errors)
-            raise Exception("There was an error making the request.") from e
+            raise UpstreamError("There was an error making the request.") from e
 
     def fetch_hotel_collection_types(self, city_id):
         """
@@ -271,7 +377,7 @@ class HotelApi:
 
         try:
             # Making the GET request
-            response = requests.get(self.fetch_hotel_collection_types_url,
+            response = requests.get(self.fetch_hotel_collection_types_url, timeout=REQUEST_TIMEOUT,
                                     params=params)
             # Check if the request was successful
             if response.status_code != 200:
@@ -280,7 +386,7 @@ class HotelApi:
                     f"Failed to fetch hotel collection types. Status code: {response.status_code}"
                 )
             # Return the JSON content of the response
-            return response.json()
+            return loads(response.content)
 
         except requests.exceptions.RequestException as e:
             # Catch any request-related exceptions (e.g., timeouts, connection errors)
@@ -288,7 +394,8 @@ class HotelApi:
 
     def fetch_room_types(self, language=Language.EN):
         """
-        Fetches room types
+        Fetches room types. The types are kept in memory and saved to /data/hotels/room_types.json
+        by the room type catalog ('api_collector.hotels.catalog'), which should be used instead of this request.
 
         Parameters:
         - language: Language of the response (e.g., pt, en, fr, de, id, it, pl, es, th, ru). Defaults to English ('en').
@@ -306,7 +413,7 @@ class HotelApi:
 
         try:
             # Making the GET request
-            response = requests.get(self.fetch_room_types_url, params=params)
+            response = requests.get(self.fetch_room_types_url, timeout=REQUEST_TIMEOUT, params=params)
             # Check if the request was successful
             if response.status_code != 200:
                 # Raise an exception if the response status code indicates failure
@@ -314,7 +421,7 @@ class HotelApi:
                     f"Failed to fetch room types. Status code: {response.status_code}"
                 )
             # Return the JSON content of the response
-            return response.json()
+            return loads(response.content)
 
         except requests.exceptions.RequestException as e:
             # Catch any request-related exceptions (e.g., timeouts, connection errors)
@@ -322,7 +429,8 @@ class HotelApi:
 
     def fetch_hotel_types(self, language=Language.EN):
         """
-        Fetches hotel types and saves to /data/hotels directory
+        Fetches hotel types. The types are kept in memory and saved to /data/hotels/hotels_type.json
+        by the hotel type catalog ('api_collector.hotels.catalog'), which should be used instead of this request.
 
         Parameters:
         - language: Language of the response (e.g., pt, en, fr, de, id, it, pl, es, th, ru). Defaults to English ('en').
@@ -340,28 +448,15 @@ class HotelApi:
 
         try:
             # Making the GET request
-            response = requests.get(self.fetch_hotel_types_url, params=params)
+            response = requests.get(self.fetch_hotel_types_url, timeout=REQUEST_TIMEOUT, params=params)
             # Check if the request was successful
             if response.status_code != 200:
                 # Raise an exception if the response status code indicates failure
                 raise Exception(
                     f"Failed to fetch room types. Status code: {response.status_code}"
                 )
-            data = response.json()
-            # define file directory
-            file_directory = data_directory_path() + self.hotel_types_dir
-            # make sure it exists
-            os.makedirs(file_directory,
-                        exist_ok=True)  # Ensure the directory exists
-            # Specify the file name where data will be saved
-            file_path = os.path.join(file_directory, 'hotels_type.json')
-
-            # Save the JSON data to a file
-            with open(file_path, 'w') as file:
-                json.dump(data, file, indent=4)
-
-            # return response data
-            return data
+            # Return the JSON content of the response
+            return loads(response.content)
 
         except requests.exceptions.RequestException as e:
             # Catch any request-related exceptions (e.g., timeouts, connection errors)
@@ -417,15 +512,15 @@ class HotelApi:
 
         try:
             # Making the GET request
-            response = requests.get(self.fetch_hotel_list_url, params=params)
+            response = requests.get(self.fetch_hotel_list_url, timeout=REQUEST_TIMEOUT, params=params)
             # Check if the request was successful
             if response.status_code != 200:
                 # Raise an exception if the response status code indicates failure
                 raise Exception(
                     f"Failed to fetch room types. Status code: {response.status_code}"
                 )
-            # get data
-            data = response.json()
+            # get data with fields used by the route search
+            data = decode_hotel_list(response.content)
             # define file directory
             file_directory = data_directory_path() + self.hotels_list_dir
             # make sure it exists
@@ -434,9 +529,9 @@ class HotelApi:
             # Specify the file name where data will be saved
             file_path = os.path.join(file_directory, f'{locationId}.json')
 
-            # Save the JSON data to a file
-            with open(file_path, 'w') as file:
-                json.dump(data, file, indent=4)
+            # Save the raw response to a file, it is not parsed and formatted again
+            with open(file_path, 'wb') as file:
+                file.write(response.content)
 
             # return response data
             return data
@@ -445,29 +540,36 @@ class HotelApi:
             # Catch any request-related exceptions (e.g., timeouts, connection errors)
             raise Exception("There was an error making the request.") from e
 
-    def fetch_and_save_photo(self, url, hotel_id, photo_index):
-        """Fetches and saves a photo given its URL."""
-        response = requests.get(url)
-        if response.status_code == 200:
-            dir_path = os.path.join(data_directory_path() + self.hotel_photos_dir, str(hotel_id))
-            file_path = os.path.join(dir_path, f"photo{photo_index}.avif")
-            if not os.path.exists(dir_path):
-                os.makedirs(dir_path, exist_ok=True)
-            with open(file_path, 'wb') as file:
-                file.write(response.content)
-        else:
-            raise Exception(
-                f"Failed to fetch photo from {url} for hotel {hotel_id}. Status code: {response.status_code}"
-            )
+    def fetch_and_save_photo(self, url, hotel_id, photo_index, extension='avif'):
+        """
+        Fetches and saves a photo given its URL. The photo is taken from the media cache,
+        it is downloaded only if it is not cached or changed.
+
+        :param extension: extension of the saved photo, photos of other formats are cached separately
+        :return: path to the saved photo
+        """
+        dir_path = os.path.join(data_directory_path() + self.hotel_photos_dir, str(hotel_id))
+        file_path = os.path.join(dir_path, f"photo{photo_index}.{extension}")
+        key = f'hotel/{hotel_id}/{photo_index}' + ('' if extension == 'avif' else f'.{extension}')
+        try:
+            return media_cache.fetch(key=key, url=url, path=file_path)
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"Failed to fetch photo from {url} for hotel {hotel_id}: {str(e)}")
 
-    def fetch_hotel_photos(self, hotel_ids, width=800, height=520, max_photo_number=None, return_only_urls=False):
+    def fetch_hotel_photos(self, hotel_ids, width=800, height=520, max_photo_number=None, return_only_urls=False,
+                           image_format='auto', make_variants=True):
         """
         Fetches photos for specified hotels and saves them locally in /data/photos/hotelPhotos/<hotel_id> directory.
+        Smaller variants of photos (e.g. photo1.thumb.jpg) are made next to them by the thumbnail pipeline
+        in the background.
 
         Parameters:
         - hotel_ids: list of Hotel ids.
         - max_photo_number: max number of photos to save
         - return_only_urls: True if we want to return array of photos id instead of saving photos
+        - image_format: format of photos, 'auto' photos are usually AVIF, 'jpg' photos can be resized locally
+        - make_variants: True if smaller variants of photos are made, Pillow can not decode AVIF,
+          so variants are made only for photos of other formats
 
         Returns:
         None
@@ -476,21 +578,26 @@ class HotelApi:
 
         params = {'id': hotel_ids_str, 'token': self.api_token}
         # First, fetching photo IDs for each hotel
-        photo_ids_response = requests.get(self.fetch_hotel_photos_base_url,
+        photo_ids_response = requests.get(self.fetch_hotel_photos_base_url, timeout=REQUEST_TIMEOUT,
                                           params=params)
         if photo_ids_response.status_code == 200:
-            photo_ids_data = photo_ids_response.json()
+            photo_ids_data = loads(photo_ids_response.content)
             if return_only_urls:
                 return photo_ids_data
+            photo_paths = []
             for hotel_id, photo_ids in photo_ids_data.items():
                 for i, photo_id in enumerate(photo_ids, start=1):
                     # Constructing the photo URL
-                    photo_url = f"https://photo.hotellook.com/image_v2/limit/{photo_id}/{width}/{height}.auto"
+                    photo_url = f"https://photo.hotellook.com/image_v2/limit/{photo_id}/{width}/{height}.{image_format}"
                     # Saving the photo
-                    self.fetch_and_save_photo(photo_url, int(hotel_id), i)
+                    photo_paths.append(self.fetch_and_save_photo(
+                        photo_url, int(hotel_id), i, extension='avif' if image_format == 'auto' else image_format))
                     if max_photo_number:
                         if i >= max_photo_number:
                             break
+            if make_variants and image_format != 'auto':
+                # resizing runs in other processes, photos are returned without waiting for it
+                thumbnail_pipeline.submit(photo_paths)
         else:
             raise Exception(
                 f"Failed to fetch photo IDs. Status code: {photo_ids_response.status_code}"
@@ -499,26 +606,16 @@ class HotelApi:
     def fetch_city_photo(self, iata_code, width=960, height=720):
         """
         Fetches city photos for specified IATA codes and saves them locally in /data/photos/cityPhotos/<iata_code>.png
-         file.
+         file. The photo is taken from the media cache, it is downloaded only if it is not cached or changed.
         :param iata_code: iata code og the city
-        :return: None
+        :return: path to the saved photo
         """
         photo_directory = data_directory_path() + self.city_photos_dir
-        os.makedirs(photo_directory,
-                    exist_ok=True)  # Ensure the directory exists
         photo_url = f'{self.fetch_city_photos_base_url}{width}x{height}/{iata_code}.jpg'
         photo_path = os.path.join(photo_directory, f"{iata_code}.png")
 
         # Attempt to fetch the photo
         try:
-            response = requests.get(photo_url)
-            # If the request is successful, save the logo to the local directory
-            if response.status_code == 200:
-                with open(photo_path, 'wb') as file:
-                    file.write(response.content)
-            else:
-                raise Exception(
-                    f"Failed to fetch cheapest tickets. Status code: {response.status_code}"
-                )
+            return media_cache.fetch(key=f'city/{iata_code}', url=photo_url, path=photo_path)
         except requests.exceptions.RequestException as e:
             raise Exception(f"Failed to fetch logo for {iata_code}: {str(e)}")
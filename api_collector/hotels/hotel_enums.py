@@ -28,3 +28,8 @@ class CollectionType(Enum):
     POPULARITY = 'popularity'
     RATING = 'rating'
     DISTANCE = 'distance'
+    CHEAP = 'cheaphotel'
+    TOP = 'tophotels'
+    THREE_STARS = '3-stars'
+    FOUR_STARS = '4-stars'
+    FIVE_STARS = '5-stars'
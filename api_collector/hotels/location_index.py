@@ -0,0 +1,238 @@
+import math
+import sqlite3
+import threading
+from datetime import datetime
+from api_collector.hotels.hotel_api import HotelApi
+from api_collector.utils.directories import data_directory_path
+import os
+
+# size of a cell of the coordinate grid in degrees
+GRID_CELL = 1.0
+# kilometers in a degree of latitude
+DEGREE_KM = 111.2
+EARTH_RADIUS_KM = 6371.0
+
+
+class LocationIndex:
+    """
+    Local index of hotel locations (cities). Locations are collected from responses of 'search_hotel_or_location'
+    and from hotel lists, so repeated resolution of a city name or an IATA code is a local lookup.
+    Coordinates of locations are indexed by a grid of 'GRID_CELL' degrees for nearest location queries.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: path to the SQLite database, by default 'hotels/locations.sqlite3' in the data directory,
+            ':memory:' keeps the index in memory
+        """
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # the database is opened on the first use, so importing the module does not touch the disk
+        if self.connection is None:
+            if self.path is None:
+                directory = data_directory_path() + '/hotels'
+                os.makedirs(directory, exist_ok=True)
+                self.path = directory + '/locations.sqlite3'
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS locations (
+                    id INTEGER PRIMARY KEY,
+                    city_name TEXT,
+                    full_name TEXT,
+                    country_name TEXT,
+                    country_code TEXT,
+                    lat REAL,
+                    lon REAL,
+                    cell_lat INTEGER,
+                    cell_lon INTEGER,
+                    hotels_count INTEGER,
+                    updated_at TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS locations_by_cell ON locations (cell_lat, cell_lon);
+                CREATE TABLE IF NOT EXISTS location_names (
+                    name TEXT PRIMARY KEY,
+                    location_id INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS location_iata (
+                    iata TEXT PRIMARY KEY,
+                    location_id INTEGER NOT NULL
+                );""")
+            self.connection.commit()
+        return self.connection
+
+    def add_locations(self, locations, query=None):
+        """
+        Saves locations, the query is resolved to the first of them
+
+        :param locations: list of locations of json type in the format of 'search_hotel_or_location'
+        :param query: str, optional, query which found the locations
+        """
+        now = _now()
+        with self.lock:
+            connection = self.connect()
+            for location in locations:
+                location_id = int(location['id'])
+                coordinates = location.get('location') or {}
+                lat, lon = _float(coordinates.get('lat')), _float(coordinates.get('lon'))
+                connection.execute("""
+                    INSERT INTO locations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET city_name = excluded.city_name, full_name = excluded.full_name,
+                        country_name = excluded.country_name, country_code = excluded.country_code,
+                        lat = COALESCE(excluded.lat, lat), lon = COALESCE(excluded.lon, lon),
+                        cell_lat = COALESCE(excluded.cell_lat, cell_lat), cell_lon = COALESCE(excluded.cell_lon, cell_lon),
+                        hotels_count = COALESCE(excluded.hotels_count, hotels_count),
+                        updated_at = excluded.updated_at""",
+                                   (location_id, location.get('cityName'), location.get('fullName'),
+                                    location.get('countryName'), location.get('countryCode'), lat, lon,
+                                    _cell(lat), _cell(lon), location.get('hotelsCount'), now))
+                for name in (location.get('cityName'), location.get('fullName')):
+                    if name:
+                        connection.execute("INSERT OR REPLACE INTO location_names VALUES (?, ?)",
+                                           (_normalize(name), location_id))
+                iata_codes = location.get('iata') or []
+                for iata in ([iata_codes] if isinstance(iata_codes, str) else iata_codes):
+                    connection.execute("INSERT OR REPLACE INTO location_iata VALUES (?, ?)",
+                                       (iata.upper(), location_id))
+            if query and locations:
+                connection.execute("INSERT OR REPLACE INTO location_names VALUES (?, ?)",
+                                   (_normalize(query), int(locations[0]['id'])))
+            connection.commit()
+
+    def add_hotel_list(self, location_id, hotels):
+        """
+        Updates the number of hotels of the location, the center of its hotels becomes the location
+        coordinates if they are unknown
+
+        :param location_id: id of the location
+        :param hotels: list of hotels of json type in the format of 'fetch_hotel_list'
+        """
+        points = [(hotel['location']['lat'], hotel['location']['lon']) for hotel in hotels
+                  if hotel.get('location') and hotel['location'].get('lat') is not None
+                  and hotel['location'].get('lon') is not None]
+        lat = sum(point[0] for point in points) / len(points) if points else None
+        lon = sum(point[1] for point in points) / len(points) if points else None
+        with self.lock:
+            connection = self.connect()
+            connection.execute("""
+                INSERT INTO locations (id, lat, lon, cell_lat, cell_lon, hotels_count, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET lat = COALESCE(lat, excluded.lat), lon = COALESCE(lon, excluded.lon),
+                    cell_lat = COALESCE(cell_lat, excluded.cell_lat), cell_lon = COALESCE(cell_lon, excluded.cell_lon),
+                    hotels_count = excluded.hotels_count, updated_at = excluded.updated_at""",
+                               (int(location_id), lat, lon, _cell(lat), _cell(lon), len(hotels), _now()))
+            connection.commit()
+
+    def find(self, query):
+        """
+        Resolves the city name, the previous query or the IATA code
+
+        :param query: str, name of the location or IATA code
+        :return: location of json type in the format of 'search_hotel_or_location', None if it is unknown
+        """
+        with self.lock:
+            connection = self.connect()
+            row = None
+            if len(query) == 3 and query.isalpha():
+                row = connection.execute("SELECT location_id FROM location_iata WHERE iata = ?",
+                                         (query.upper(),)).fetchone()
+            if row is None:
+                row = connection.execute("SELECT location_id FROM location_names WHERE name = ?",
+                                         (_normalize(query),)).fetchone()
+        return None if row is None else self.get(row[0])
+
+    def get(self, location_id):
+        """
+        :param location_id: id of the location
+        :return: location of json type in the format of 'search_hotel_or_location', None if it is unknown
+        """
+        with self.lock:
+            connection = self.connect()
+            row = connection.execute("SELECT * FROM locations WHERE id = ?", (int(location_id),)).fetchone()
+            if row is None:
+                return None
+            iata_codes = [iata for iata, in connection.execute(
+                "SELECT iata FROM location_iata WHERE location_id = ? ORDER BY iata", (int(location_id),))]
+        return _to_location(row, iata_codes)
+
+    def nearest(self, lat, lon, max_distance=500, number=1, with_hotels=True) -> list[tuple]:
+        """
+        Finds the nearest locations, only grid cells around the point are read
+
+        :param lat: latitude of the point
+        :param lon: longitude of the point
+        :param max_distance: max distance to the location in kilometers
+        :param number: max number of locations to return
+        :param with_hotels: True if only locations with hotels are returned
+        :return: list of tuples (distance in kilometers, location of json type) sorted by distance
+        """
+        lat_radius = max_distance / DEGREE_KM
+        lon_radius = max_distance / (DEGREE_KM * max(math.cos(math.radians(lat)), 0.01))
+        with self.lock:
+            rows = self.connect().execute("""
+                SELECT * FROM locations WHERE cell_lat BETWEEN ? AND ? AND cell_lon BETWEEN ? AND ?""",
+                                          (_cell(lat - lat_radius), _cell(lat + lat_radius),
+                                           _cell(lon - lon_radius), _cell(lon + lon_radius))).fetchall()
+        found = []
+        for row in rows:
+            if with_hotels and not row[9]:
+                continue
+            distance = haversine(lat, lon, row[5], row[6])
+            if distance <= max_distance:
+                found.append((distance, row))
+        found.sort(key=lambda item: item[0])
+        return [(round(distance, 1), _to_location(row, [])) for distance, row in found[:number]]
+
+    def record_search(self, arguments, response):
+        """
+        Saves cities from the response of 'search_hotel_or_location'
+
+        :param arguments: dictionary of arguments of the request
+        :param response: response of the request
+        """
+        locations = (response.get('results') or {}).get('locations') or []
+        self.add_locations(locations, query=arguments.get('query'))
+
+    def record_responses(self):
+        """
+        Starts saving locations from all new responses of location searches
+        """
+        listeners = HotelApi.search_hotel_or_location.response_cache.listeners
+        if self.record_search not in listeners:
+            listeners.append(self.record_search)
+
+
+def haversine(lat1, lon1, lat2, lon2) -> float:
+    """
+    :return: distance between two points in kilometers
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def _to_location(row, iata_codes) -> dict:
+    return {'id': str(row[0]), 'cityName': row[1], 'fullName': row[2], 'countryName': row[3], 'countryCode': row[4],
+            'location': {'lat': row[5], 'lon': row[6]}, 'hotelsCount': row[9], 'iata': iata_codes}
+
+
+def _normalize(name):
+    return ' '.join(name.lower().split())
+
+
+def _float(value):
+    return None if value is None else float(value)
+
+
+def _cell(coordinate):
+    return None if coordinate is None else math.floor(coordinate / GRID_CELL)
+
+
+def _now():
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S')
+
+
+# index shared by the whole application
+location_index = LocationIndex()
@@ -0,0 +1,85 @@
+import json
+import sqlite3
+import threading
+import time
+from api_collector.utils.directories import data_directory_path
+import os
+
+# photo sets of hotels rarely change, saved photo ids are used during this number of seconds
+PHOTO_IDS_MAX_AGE = 30 * 24 * 60 * 60
+# url of the photo of the size sent to users, 'auto' lets upstream choose the format (usually AVIF)
+HOTEL_PHOTO_URL = 'https://photo.hotellook.com/image_v2/limit/{photo_id}/800/520.{image_format}'
+
+
+class PhotoIdStore:
+    """
+    Persistent store of photo ids of hotels, so photo ids are requested upstream once a 'max_age'
+    for every hotel instead of once a search. Urls of photos are not stored, they are built from ids.
+    """
+
+    def __init__(self, path=None, max_age=PHOTO_IDS_MAX_AGE):
+        """
+        :param path: path to the SQLite database, by default 'hotels/photo_ids.sqlite3' in the data directory,
+            ':memory:' keeps photo ids in memory
+        :param max_age: time in seconds after which photo ids are requested again
+        """
+        self.path = path
+        self.max_age = max_age
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # the database is opened on the first use, so importing the module does not touch the disk
+        if self.connection is None:
+            if self.path is None:
+                directory = data_directory_path() + '/hotels'
+                os.makedirs(directory, exist_ok=True)
+                self.path = directory + '/photo_ids.sqlite3'
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS photo_ids (
+                    hotel_id INTEGER PRIMARY KEY,
+                    photo_ids TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )""")
+            self.connection.commit()
+        return self.connection
+
+    def get(self, hotel_ids) -> dict:
+        """
+        :param hotel_ids: list of hotel ids
+        :return: dictionary hotel id (str) -> list of photo ids for hotels which photo ids are saved and not expired
+        """
+        hotel_ids = [int(hotel_id) for hotel_id in hotel_ids]
+        if len(hotel_ids) == 0:
+            return {}
+        with self.lock:
+            rows = self.connect().execute(
+                f"SELECT hotel_id, photo_ids FROM photo_ids WHERE updated_at > ? "
+                f"AND hotel_id IN ({', '.join('?' * len(hotel_ids))})",
+                (time.time() - self.max_age, *hotel_ids)).fetchall()
+        return {str(hotel_id): json.loads(photo_ids) for hotel_id, photo_ids in rows}
+
+    def add(self, photo_ids):
+        """
+        :param photo_ids: dictionary hotel id -> list of photo ids in the format of 'fetch_hotel_photos'
+        """
+        now = time.time()
+        with self.lock:
+            connection = self.connect()
+            connection.executemany("INSERT OR REPLACE INTO photo_ids VALUES (?, ?, ?)",
+                                   [(int(hotel_id), json.dumps(ids), now) for hotel_id, ids in photo_ids.items()])
+            connection.commit()
+
+
+def hotel_photo_url(photo_id, image_format='auto') -> str:
+    """
+    :param photo_id: id of the photo
+    :param image_format: format of the photo, e.g. 'jpg' for photos which are resized locally
+    :return: url of the photo of the size sent to users
+    """
+    return HOTEL_PHOTO_URL.format(photo_id=photo_id, image_format=image_format)
+
+
+# photo ids shared by the whole application
+photo_id_store = PhotoIdStore()
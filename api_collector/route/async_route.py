@@ -0,0 +1,396 @@
+import asyncio
+from api_collector.air_tickets.air_tickets_api import AirTicketsApi
+from api_collector.hotels.hotel_api import HotelApi, UpstreamError
+from api_collector.hotels.photo_ids import hotel_photo_url
+from api_collector.route.candidates import TicketCandidates
+from api_collector.route.pagination import PAGE_CONCURRENCY, page_size_history
+from api_collector.route.route_cache import route_cache
+from api_collector.utils.thumbnails import thumbnail_pipeline
+from api_collector.route.route import Route, combine_routes, fetch_hotel_prices, filter_hotels, filter_tickets, \
+    find_filtered_hotels, select_tickets, select_hotels, known_location_id, fetch_hotel_photo_ids, attach_hotel_photo_urls, \
+    fetch_alternative_tickets, add_alternative_routes, fetch_collection_candidates
+
+
+async def iterate_ticket_pages_async(origin, destination, departure_at=None, return_at=None, direct=False,
+                                     page_concurrency=PAGE_CONCURRENCY):
+    """
+    Fetch pages of the cheapest tickets. The page size is chosen by the history of the route like in
+    'fetch_ticket_pages'. Pages are requested in waves of 'page_concurrency' pages, the first wave of
+    a route with known number of tickets is a single page. Walking stops at the same page as in
+    'fetch_ticket_pages'.
+
+    :param origin: str, IATA code of the departure point
+    :param destination: str, IATA code of the destination point
+    :param departure_at: str, optional, departure date (format YYYY-MM or YYYY-MM-DD)
+    :param return_at: str, optional, return date (format YYYY-MM or YYYY-MM-DD)
+    :param direct: True if only direct flights are required
+    :param page_concurrency: number of pages requested at the same time
+    :return: async generator of tickets of json type fetched by each wave, sorted by price
+    """
+    key = (origin, destination, direct)
+    plan = page_size_history.plan(key)
+    air_api = AirTicketsApi()
+    count = 0
+    first_page = 1
+    wave_size = min(plan.first_wave, page_concurrency)
+    while first_page <= plan.max_pages:
+        pages = range(first_page, min(first_page + wave_size, plan.max_pages + 1))
+        # request the whole wave of pages at once, responses come in the order of pages
+        responses = await asyncio.gather(*[
+            asyncio.to_thread(air_api.fetch_cheapest_tickets,
+                              origin=origin,
+                              destination=destination,
+                              departure_at=departure_at,
+                              return_at=return_at,
+                              one_way=True,
+                              direct=direct,
+                              limit=plan.limit,
+                              page=page)
+            for page in pages])
+        tickets = []
+        is_last_wave = False
+        for response in responses:
+            # Check if the response was successful
+            if not response['success']:
+                raise Exception('response was not successful')
+            tickets += response['data']
+            # Stop if next pages are empty
+            if page_size_history.is_last_page(plan.limit, len(response['data'])):
+                is_last_wave = True
+                break
+        count += len(tickets)
+        if tickets:
+            yield tickets
+        if is_last_wave:
+            break
+        first_page = pages.stop
+        wave_size = page_concurrency
+    page_size_history.record(key, count)
+
+
+async def iterate_ticket_candidates_async(origin, destination, departure_at=None, return_at=None, max_transfers=0,
+                                          airlines=(), max_flight_duration=None):
+    """
+    Async version of 'fetch_ticket_candidates' which yields every time a new wave of pages arrives.
+
+    :return: async generator of 'TicketCandidates' with all tickets fetched so far, filtered and sorted by price
+    """
+    tickets = []
+    if max_transfers == 0:
+        async for page_tickets in iterate_ticket_pages_async(origin=origin, destination=destination,
+                                                             departure_at=departure_at, return_at=return_at,
+                                                             direct=True):
+            tickets += page_tickets
+            yield filter_tickets(tickets, max_transfers=max_transfers, airlines=airlines,
+                                 max_flight_duration=max_flight_duration)
+    if len(tickets) == 0 or max_transfers != 0:
+        async for page_tickets in iterate_ticket_pages_async(origin=origin, destination=destination,
+                                                             departure_at=departure_at, return_at=return_at):
+            tickets += page_tickets
+            yield filter_tickets(tickets, max_transfers=max_transfers, airlines=airlines,
+                                 max_flight_duration=max_flight_duration)
+
+
+async def fetch_ticket_candidates_async(origin, destination, departure_at=None, return_at=None, max_transfers=0,
+                                        airlines=(), max_flight_duration=None) -> TicketCandidates:
+    """
+    Async version of 'fetch_ticket_candidates'.
+
+    :return: 'TicketCandidates' sorted by price
+    """
+    tickets = TicketCandidates([])
+    async for tickets in iterate_ticket_candidates_async(origin=origin, destination=destination,
+                                                         departure_at=departure_at, return_at=return_at,
+                                                         max_transfers=max_transfers, airlines=airlines,
+                                                         max_flight_duration=max_flight_duration):
+        pass
+    return tickets
+
+
+async def fetch_hotel_candidates_async(location, check_in, check_out, min_stars=0, amenities=(), max_distance=None,
+                                       poi=None) -> list[dict]:
+    """
+    Async version of 'fetch_hotel_candidates'. If the location id is already known,
+    the hotel list is loaded at the same time as hotel prices.
+    Parameters are the same as in 'fetch_hotel_candidates'.
+
+    :return: list of hotels of json type sorted by price
+    """
+    prices_task = asyncio.create_task(asyncio.to_thread(fetch_hotel_prices, location, check_in, check_out))
+    location_id = known_location_id(location)
+    filtered_task = None
+    if location_id is not None:
+        filtered_task = asyncio.create_task(asyncio.to_thread(find_filtered_hotels, locationId=location_id,
+                                                              min_stars=min_stars, amenities=amenities,
+                                                              max_distance=max_distance, poi=poi))
+    try:
+        hotels = await prices_task
+        # check if we fetched at least one hotel
+        if len(hotels) == 0:
+            return []
+        if filtered_task is None or hotels[0]['locationId'] != location_id:
+            filtered_hotels = await asyncio.to_thread(find_filtered_hotels, locationId=hotels[0]['locationId'],
+                                                      min_stars=min_stars, amenities=amenities,
+                                                      max_distance=max_distance, poi=poi)
+        else:
+            filtered_hotels = await filtered_task
+    finally:
+        for task in (prices_task, filtered_task):
+            if task is not None and not task.done():
+                task.cancel()
+
+    return filter_hotels(hotels, filtered_hotels)
+
+
+async def fetch_hotel_photo_ids_async(hotel_ids) -> dict:
+    """
+    Fetch photo ids of hotels without raising, failed lookup is retried later for the chosen hotels.
+
+    :param hotel_ids: list of hotel ids
+    :return: dictionary hotel id (str) -> list of photo ids
+    """
+    try:
+        return await asyncio.to_thread(fetch_hotel_photo_ids, hotel_ids)
+    except Exception:
+        return {}
+
+
+async def fetch_hotel_photo_files_async(hotel, variant='medium', max_photo_number=5) -> list[str]:
+    """
+    Saves photos of the hotel and makes their smaller variant to be sent to users. Photos are downloaded
+    as JPEG, Pillow can not decode AVIF of the photo urls, and resized in the thumbnail pipeline.
+
+    :param hotel: 'Hotel' class with attached photo ids
+    :param variant: name of the variant of 'PHOTO_VARIANTS'
+    :param max_photo_number: max number of photos
+    :return: paths to variants of photos, photos which failed are missing
+    """
+    hotel_api = HotelApi()
+    photo_paths = await asyncio.gather(*[
+        asyncio.to_thread(hotel_api.fetch_and_save_photo, hotel_photo_url(photo_id, image_format='jpg'),
+                          hotel.hotel_id, photo_index, extension='jpg')
+        for photo_index, photo_id in enumerate(hotel.photo_ids[:max_photo_number], start=1)],
+        return_exceptions=True)
+    photo_paths = [path for path in photo_paths if isinstance(path, str)]
+    variants = await thumbnail_pipeline.generate_async(photo_paths)
+    return [variants[path][variant] for path in photo_paths if path in variants]
+
+
+async def stream_top_routes(origin, destination, departure_at=None, return_at=None, budget=None, route_number=3,
+                            min_stars=0, max_transfers=0, airlines=(), max_flight_duration=None, deadline=None,
+                            amenities=(), max_distance=None, poi=None):
+    """
+    Progressive version of 'find_top_routes'. Ticket pagination, the hotel pipeline and the search
+    of nearby airports run concurrently.
+    The first routes are yielded as soon as the first wave of ticket pages and the hotel prices arrive
+    (hotel collections of the location if they have prices of the dates, then the full price list),
+    then refined routes are yielded every time new tickets change the result. The last yielded routes
+    are final and have hotel photo urls attached. If the deadline is reached, the remaining requests are
+    cancelled and the last routes are built from the data which has arrived, they are marked as partial.
+
+    Parameters:
+    :param origin: str, IATA code of the departure point.
+    :param destination: str, IATA code of the destination point.
+    :param departure_at: str, optional, departure date (format YYYY-MM-DD).
+    :param return_at: str, optional, return date (format YYYY-MM-DD).
+    :param budget: float, optional, maximum combined price for the ticket and hotel.
+    :param route_number: int, optional, number of top routes to find (default is 3).
+    :param min_stars: min number of stars for hotel required
+    :param max_transfers: max number of transfers during a flight, 0 by default
+    :param airlines: list of airlines which are required for a flight, by default empty tuple - all airlines are allowed
+    :param max_flight_duration: max duration of a flight in hours, None by default
+    :param deadline: float, optional, max time of the search in seconds, None means no limit
+    :param amenities: amenities which are required, names of 'shortFacilities' (e.g. 'pool', 'pets')
+        or ids of 'facilities' of the hotel list, by default empty tuple - no amenities are required
+    :param max_distance: max distance from the hotel to the city center or to the 'poi' in kilometers,
+        by default the distance is not limited
+    :param poi: id or name of the place of interest of the hotel list (e.g. 'Kremlin'), by default
+        the distance is measured to the city center
+
+    :return: async generator of lists of 'Route' class
+    """
+    # repeated searches are served from the shared cache
+    key = route_cache.make_key(origin=origin, destination=destination, departure_at=departure_at,
+                               return_at=return_at, budget=budget, route_number=route_number, min_stars=min_stars,
+                               max_transfers=max_transfers, airlines=airlines,
+                               max_flight_duration=max_flight_duration, amenities=amenities,
+                               max_distance=max_distance, poi=poi)
+    cached_routes = route_cache.get(key, budget)
+    if cached_routes is not None:
+        yield cached_routes
+        return
+    loop = asyncio.get_running_loop()
+    deadline_at = None if deadline is None else loop.time() + deadline
+
+    def time_left():
+        return None if deadline_at is None else max(deadline_at - loop.time(), 0)
+
+    queue = asyncio.Queue()
+
+    async def produce(kind, source):
+        try:
+            async for data in source:
+                queue.put_nowait((kind, data))
+        except Exception as e:
+            queue.put_nowait(('error', e))
+        finally:
+            queue.put_nowait(('done', kind))
+
+    async def hotel_source():
+        candidates_task = asyncio.create_task(fetch_hotel_candidates_async(
+            location=destination, check_in=departure_at, check_out=return_at, min_stars=min_stars,
+            amenities=amenities, max_distance=max_distance, poi=poi))
+        try:
+            # the cheapest hotels of collections give the first routes while the full price list is downloaded
+            try:
+                collection_hotels = await asyncio.to_thread(
+                    fetch_collection_candidates, location=destination, check_in=departure_at,
+                    check_out=return_at, min_stars=min_stars, number_of_hotels=route_number, amenities=amenities,
+                    max_distance=max_distance, poi=poi)
+            except UpstreamError:
+                collection_hotels = None
+            if collection_hotels is not None and not candidates_task.done():
+                yield collection_hotels
+            yield await candidates_task
+        finally:
+            if not candidates_task.done():
+                candidates_task.cancel()
+
+    async def alternative_source():
+        try:
+            alternative_tickets = await asyncio.to_thread(
+                fetch_alternative_tickets, origin=origin, destination=destination, departure_at=departure_at,
+                return_at=return_at, max_transfers=max_transfers, airlines=airlines,
+                max_flight_duration=max_flight_duration)
+        except Exception:
+            # alternatives are optional, routes are built without them
+            return
+        yield alternative_tickets
+
+    ticket_source = iterate_ticket_candidates_async(origin=origin, destination=destination,
+                                                    departure_at=departure_at, return_at=return_at,
+                                                    max_transfers=max_transfers, airlines=airlines,
+                                                    max_flight_duration=max_flight_duration)
+    tasks = [asyncio.create_task(produce('tickets', ticket_source)),
+             asyncio.create_task(produce('hotels', hotel_source())),
+             asyncio.create_task(produce('alternatives', alternative_source()))]
+    photo_task = None
+    tickets = None
+    hotels = None
+    alternative_tickets = []
+    routes = None
+    partial = False
+    try:
+        running = {'tickets', 'hotels', 'alternatives'}
+        while running:
+            try:
+                kind, data = await asyncio.wait_for(queue.get(), timeout=time_left())
+            except asyncio.TimeoutError:
+                # the deadline is reached, routes are built from the data which has arrived
+                partial = True
+                break
+            if kind == 'done':
+                running.discard(data)
+                continue
+            if kind == 'error':
+                raise data
+            if kind == 'tickets':
+                tickets = data
+            elif kind == 'alternatives':
+                alternative_tickets = data
+            else:
+                hotels = data
+                # the cheapest hotels are chosen in most routes, so their photos are requested in advance
+                if photo_task is None:
+                    photo_task = asyncio.create_task(
+                        fetch_hotel_photo_ids_async([hotel['hotelId'] for hotel in hotels[:route_number]]))
+            # routes can be combined only when both tickets and hotels are known
+            if hotels is None or (tickets is None and 'tickets' in running):
+                continue
+
+            new_routes = combine_candidates(origin=origin, destination=destination, departure_at=departure_at,
+                                            return_at=return_at, budget=budget, route_number=route_number,
+                                            tickets=tickets or [], hotels=hotels)
+            new_routes = add_alternative_routes(new_routes, alternative_tickets, budget=budget,
+                                                route_number=route_number)
+            if routes is None or route_keys(new_routes) != route_keys(routes):
+                routes = new_routes
+                yield routes
+
+        if routes is None:
+            # no tickets were found at all or hotels have not arrived before the deadline
+            routes = combine_candidates(origin=origin, destination=destination, departure_at=departure_at,
+                                        return_at=return_at, budget=budget, route_number=route_number,
+                                        tickets=tickets or [], hotels=hotels or [])
+            routes = add_alternative_routes(routes, alternative_tickets, budget=budget,
+                                            route_number=route_number)
+
+        photo_ids = {}
+        try:
+            if photo_task is not None:
+                photo_ids = await asyncio.wait_for(photo_task, timeout=time_left())
+            # request photos only for chosen hotels which were not requested in advance
+            missing_ids = [route.hotel.hotel_id for route in routes
+                           if route.hotel.found and str(route.hotel.hotel_id) not in photo_ids]
+            if missing_ids:
+                photo_ids = {**photo_ids, **await asyncio.wait_for(
+                    asyncio.to_thread(fetch_hotel_photo_ids, missing_ids), timeout=time_left())}
+        except asyncio.TimeoutError:
+            # routes are returned without photos which have not arrived before the deadline
+            partial = True
+        attach_hotel_photo_urls(routes, photo_ids)
+        yield route_cache.put(key, routes, budget, partial=partial)
+    finally:
+        # stop the other branches if the search failed or the consumer stopped early
+        for task in tasks + [photo_task]:
+            if task is not None and not task.done():
+                task.cancel()
+
+
+def combine_candidates(origin, destination, departure_at, return_at, budget, route_number, tickets,
+                       hotels) -> list[Route]:
+    """
+    Combines already fetched ticket and hotel candidates into the top routes.
+
+    :param tickets: 'TicketCandidates' or list of tickets of json type sorted by price
+    :param hotels: list of hotels of json type sorted by price
+    :return: list of 'Route' class
+    """
+    def choose_tickets(ticket_budget=None, number_of_tickets=1):
+        return select_tickets(tickets, budget=ticket_budget, number_of_tickets=number_of_tickets)
+
+    def choose_hotels(hotel_budget=None, number_of_hotels=1):
+        return select_hotels(hotels, budget=hotel_budget, number_of_hotels=number_of_hotels)
+
+    return combine_routes(origin=origin, destination=destination, departure_at=departure_at, return_at=return_at,
+                          budget=budget, route_number=route_number,
+                          choose_tickets=choose_tickets, choose_hotels=choose_hotels)
+
+
+def route_keys(routes) -> list:
+    """
+    Returns the values which identify tickets and hotels of routes, used to detect changed results
+    """
+    return [(route.ticket.key, route.hotel.key) for route in routes]
+
+
+async def find_top_routes_async(origin, destination, departure_at=None, return_at=None, budget=None, route_number=3,
+                                min_stars=0, max_transfers=0, airlines=(), max_flight_duration=None,
+                                deadline=None, amenities=(), max_distance=None, poi=None) -> list[Route]:
+    """
+    Async version of 'find_top_routes'. Ticket pagination and the hotel pipeline (prices, hotel list
+    and photo ids of the cheapest hotels) run concurrently, routes are combined once both arrive,
+    so the search takes about as long as the slowest branch.
+
+    Parameters are the same as in 'stream_top_routes'.
+
+    :return: list of 'Route' class
+    """
+    routes = []
+    async for routes in stream_top_routes(origin=origin, destination=destination, departure_at=departure_at,
+                                          return_at=return_at, budget=budget, route_number=route_number,
+                                          min_stars=min_stars, max_transfers=max_transfers, airlines=airlines,
+                                          max_flight_duration=max_flight_duration, deadline=deadline,
+                                          amenities=amenities, max_distance=max_distance, poi=poi):
+        pass
+    return routes
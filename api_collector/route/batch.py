@@ -0,0 +1,160 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from api_collector.air_tickets.price_calendar import price_calendar
+from api_collector.hotels.catalog import catalogs
+from api_collector.hotels.location_index import location_index
+from api_collector.route.async_route import find_top_routes_async
+from api_collector.route.discovery import find_anywhere_routes
+from api_collector.route.route_cache import route_cache
+from api_collector.utils.response_cache import response_cache_stats
+
+# number of queries planned at the same time
+BATCH_CONCURRENCY = 8
+
+
+def query_to_search(query) -> dict:
+    """
+    Converts a query in the format of the request analyzer output to parameters of the route search
+
+    :param query: dictionary with 'Departure', 'Destination', 'Arrival', 'Return' and 'Budget' fields
+    :return: dictionary of 'find_top_routes' parameters
+    """
+    budget = query.get('Budget')
+    destination = query.get('Destination')
+    return {
+        'origin': query['Departure'],
+        'destination': None if destination in (None, "None") else destination,
+        'departure_at': query.get('Arrival'),
+        'return_at': query.get('Return'),
+        'budget': None if budget in (None, "None") else budget,
+    }
+
+
+def route_to_dict(route) -> dict:
+    """
+    Converts a route to the dictionary which can be saved as json
+
+    :param route: 'Route' class
+    :return: dictionary with route, ticket and hotel fields, ticket or hotel is None if it has not been found
+    """
+    ticket = route.ticket
+    hotel = route.hotel
+    return {
+        'origin': route.origin,
+        'destination': route.destination,
+        'departure_at': route.departure_at,
+        'return_at': route.return_at,
+        'budget': route.budget,
+        'total_cost': route.calculate_total_cost(),
+        'partial': route.partial,
+        'ticket': {
+            'origin': ticket.flight_origin,
+            'destination': ticket.flight_destination,
+            'price': ticket.ticket_price,
+            'airline': ticket.airline,
+            'flight_number': ticket.flight_number,
+            'departure_at': ticket.flight_departure_at,
+            'return_at': ticket.flight_return_at,
+            'link': ticket.flight_link,
+            'alternative': ticket.alternative,
+        } if ticket and ticket.found else None,
+        'hotel': {
+            'id': hotel.hotel_id,
+            'name': hotel.hotel_name,
+            'stars': hotel.hotel_stars,
+            'price_from': hotel.hotel_price_from,
+            'photo_urls': hotel.photo_urls,
+        } if hotel and hotel.found else None,
+    }
+
+
+async def plan_query(query, deadline=None) -> list:
+    """
+    Finds routes for a single query of the batch
+
+    :param query: dictionary in the format of the request analyzer output
+    :param deadline: float, optional, max time of the search in seconds
+    :return: list of 'Route' class
+    """
+    search = query_to_search(query)
+    if search['destination'] is None:
+        # destination is not specified, search through popular directions
+        del search['destination']
+        return await asyncio.to_thread(find_anywhere_routes, **search, deadline=deadline)
+    return await find_top_routes_async(**search, deadline=deadline)
+
+
+async def plan_routes_batch(queries, output, max_concurrency=BATCH_CONCURRENCY, deadline=None) -> dict:
+    """
+    Plans routes for many queries. Queries run concurrently, so identical upstream requests of different
+    queries are coalesced or served from the shared response and route caches. Every result is written
+    to the output as a json line as soon as it is ready, results come in the order of completion.
+
+    :param queries: list of queries in the format of the request analyzer output
+    :param output: text file-like object where results are written in JSONL format,
+        every line contains 'index' of the query, 'query' and 'routes' or 'error'
+    :param max_concurrency: max number of queries planned at the same time
+    :param deadline: float, optional, max time of every search in seconds
+    :return: dictionary with statistics of the batch: number of queries and errors, time in seconds,
+        queries per second, requests made to upstream APIs and requests saved by caches
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    stats_before = response_cache_stats()
+    route_hits_before = route_cache.hits
+    start = time.perf_counter()
+
+    async def plan(index, query):
+        async with semaphore:
+            try:
+                routes = await plan_query(query, deadline=deadline)
+                return {'index': index, 'query': query, 'routes': [route_to_dict(route) for route in routes]}
+            except Exception as e:
+                # one failed query should not break the whole batch
+                return {'index': index, 'query': query, 'error': str(e)}
+
+    errors = 0
+    tasks = [asyncio.create_task(plan(index, query)) for index, query in enumerate(queries)]
+    for task in asyncio.as_completed(tasks):
+        result = await task
+        errors += 'error' in result
+        output.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+    seconds = time.perf_counter() - start
+    stats_after = response_cache_stats()
+    return {
+        'queries': len(tasks),
+        'errors': errors,
+        'seconds': round(seconds, 3),
+        'queries_per_second': round(len(tasks) / seconds, 3) if seconds > 0 else None,
+        'upstream_calls': stats_after['misses'] - stats_before['misses'],
+        'saved_calls': (stats_after['hits'] - stats_before['hits'] +
+                        stats_after['coalesced'] - stats_before['coalesced']),
+        'route_cache_hits': route_cache.hits - route_hits_before,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Plan routes for queries from a JSONL file')
+    parser.add_argument('queries', help='JSONL file with queries in the format of the request analyzer output')
+    parser.add_argument('results', help='JSONL file where found routes are written')
+    parser.add_argument('--concurrency', type=int, default=BATCH_CONCURRENCY,
+                        help='max number of queries planned at the same time')
+    parser.add_argument('--deadline', type=float, default=None, help='max time of every search in seconds')
+    args = parser.parse_args()
+
+    price_calendar.record_responses()
+    location_index.record_responses()
+    catalogs.load()
+    with open(args.queries, encoding='utf-8') as f:
+        queries = [json.loads(line) for line in f if line.strip()]
+    with open(args.results, 'w', encoding='utf-8') as output:
+        stats = asyncio.run(plan_routes_batch(queries, output, max_concurrency=args.concurrency,
+                                              deadline=args.deadline))
+    print(json.dumps(stats), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
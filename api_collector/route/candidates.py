@@ -0,0 +1,336 @@
+import heapq
+import math
+import numpy as np
+from api_collector.hotels.location_index import DEGREE_KM, EARTH_RADIUS_KM
+
+# size of a cell of the grid of hotel coordinates in degrees, about a kilometer
+HOTEL_GRID_CELL = 0.01
+
+
+def budget_window(prices, budget=None, number_of_items=1) -> tuple[int, int]:
+    """
+    Finds bounds of 'number_of_items' items which prices are closest to the budget
+
+    :param prices: prices sorted in ascending order
+    :param budget: float, optional, maximum price of the item
+    :param number_of_items: amount of different items to choose
+    :return: tuple (start, end) of the slice with chosen items
+    """
+    length = len(prices)
+    if budget and (not budget == "None"):
+        # index of the most expensive item within budget, the first item if nothing fits the budget
+        last_index = max(int(np.searchsorted(prices, budget, side='left')) - 1, 0)
+        if length <= number_of_items:
+            return 0, length
+        min_index = max(0, last_index - (number_of_items // 2))
+        max_index = min(length, last_index + (number_of_items // 2) + (number_of_items % 2))
+        if max_index - min_index < number_of_items:
+            if min_index == 0:
+                return 0, number_of_items
+            return max_index - number_of_items, max_index
+        return min_index, max_index
+    return 0, min(length, number_of_items)
+
+
+class BudgetWindowHeap:
+    """
+    Bounded selection of items for 'budget_window'. Items come in any order and only the items which
+    can get into the window are kept: the cheapest items, the most expensive items within the budget
+    and the cheapest items over the budget, 'number_of_items' of each. The budget window of the kept
+    items is the same as the budget window of all items.
+    """
+
+    def __init__(self, budget=None, number_of_items=1):
+        """
+        :param budget: float, optional, maximum price of the item
+        :param number_of_items: amount of different items to choose
+        """
+        self.budget = budget if budget and (not budget == "None") else None
+        self.number_of_items = number_of_items
+        # heaps of tuples (key, order, item), the smallest key is dropped first
+        self.cheapest = []
+        self.within_budget = []
+        self.over_budget = []
+        self.count = 0
+
+    def add(self, price, item):
+        """
+        :param price: price of the item
+        :param item: item of any type
+        """
+        # items with equal price keep the order of arrival like after the stable sort
+        order = self.count
+        self.count += 1
+        self._push(self.cheapest, (-price, -order, item))
+        if self.budget is not None:
+            if price < self.budget:
+                self._push(self.within_budget, (price, order, item))
+            else:
+                self._push(self.over_budget, (-price, -order, item))
+
+    def items(self) -> list:
+        """
+        :return: list of kept items sorted by price
+        """
+        kept = {}
+        for price, order, item in self.within_budget:
+            kept[order] = (price, item)
+        for heap in (self.cheapest, self.over_budget):
+            for price, order, item in heap:
+                kept[-order] = (-price, item)
+        return [item for _, (_, item) in sorted(kept.items(), key=lambda entry: (entry[1][0], entry[0]))]
+
+    def _push(self, heap, entry):
+        if len(heap) < self.number_of_items:
+            heapq.heappush(heap, entry)
+        elif entry[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, entry)
+
+
+class TicketCandidates:
+    """
+    Columnar storage of ticket candidates. Tickets of json type are converted once into a NumPy
+    structured array, filtering, sorting and budget window selection are done on its columns and
+    only chosen rows are returned as json tickets.
+    """
+    dtype = np.dtype([
+        ('price', np.float64),
+        ('transfers', np.int32),
+        ('return_transfers', np.int32),
+        ('duration_to', np.float64),
+        ('duration_back', np.float64),
+        ('airline', 'U8'),
+        ('index', np.int64),
+    ])
+
+    def __init__(self, tickets, columns=None):
+        """
+        :param tickets: list of tickets of json type
+        :param columns: structured array of ticket columns, built from tickets if not specified
+        """
+        self.tickets = tickets
+        if columns is None:
+            columns = np.array([(ticket['price'],
+                                 ticket.get('transfers', 0),
+                                 ticket.get('return_transfers', 0),
+                                 ticket.get('duration_to', 0),
+                                 ticket.get('duration_back', 0),
+                                 ticket.get('airline', ''),
+                                 index)
+                                for index, ticket in enumerate(tickets)], dtype=self.dtype)
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns)
+
+    def filter(self, max_transfers=0, airlines=(), max_flight_duration=None) -> 'TicketCandidates':
+        """
+        Filters tickets by number of transfers, airline and flight duration
+
+        :param max_transfers: max number of transfers during a flight, 0 means no filter
+        :param airlines: list of airlines which are required for a flight, empty means all airlines are allowed
+        :param max_flight_duration: max duration of a flight in hours, None by default
+        :return: filtered candidates
+        """
+        columns = self.columns
+        mask = np.ones(len(columns), dtype=bool)
+        # filter tickets by number of transfers
+        if max_transfers > 0:
+            mask &= (columns['transfers'] <= max_transfers) & (columns['return_transfers'] <= max_transfers)
+        # filter by airline
+        if len(airlines) > 0:
+            mask &= np.isin(columns['airline'], list(airlines))
+        # filter by flight duration
+        if max_flight_duration:
+            mask &= (columns['duration_to'] <= max_flight_duration * 60) & \
+                    (columns['duration_back'] <= max_flight_duration * 60)
+        return TicketCandidates(self.tickets, columns[mask])
+
+    def sort_by_price(self) -> 'TicketCandidates':
+        """
+        Sorts tickets by price, tickets with equal price keep their order
+
+        :return: sorted candidates
+        """
+        return TicketCandidates(self.tickets, self.columns[np.argsort(self.columns['price'], kind='stable')])
+
+    def select(self, budget=None, number_of_tickets=1) -> list[dict]:
+        """
+        Chooses tickets closest to the budget, candidates have to be sorted by price
+
+        :param budget: float, optional, maximum price of the ticket
+        :param number_of_tickets: amount of different tickets to return
+        :return: list of tickets of json type
+        """
+        start, end = budget_window(self.columns['price'], budget, number_of_tickets)
+        return [self.tickets[index] for index in self.columns['index'][start:end]]
+
+    def to_list(self) -> list[dict]:
+        """
+        :return: list of all candidate tickets of json type
+        """
+        return [self.tickets[index] for index in self.columns['index']]
+
+
+class HotelIndex:
+    """
+    Columnar index of the hotel list of a location. Amenities of every hotel are stored as a bitset,
+    one bit per amenity found in the list, so filters by property type, stars and any combination
+    of amenities are answered with vectorized comparisons and bitwise operations. Coordinates of hotels
+    are indexed by a grid of 'HOTEL_GRID_CELL' degrees, so only hotels around a place of interest
+    are measured.
+    """
+
+    def __init__(self, hotels, pois=()):
+        """
+        :param hotels: list of hotels of json type in the format of 'fetch_hotel_list'
+        :param pois: list of places of interest of the location in the format of 'decode_hotel_list'
+        """
+        # amenity -> number of its bit, amenities are names of 'shortFacilities' and ids of 'facilities'
+        self.amenity_bits = {}
+        for hotel in hotels:
+            for amenity in _hotel_amenities(hotel):
+                self.amenity_bits.setdefault(amenity, len(self.amenity_bits))
+        words = max(1, (len(self.amenity_bits) + 63) // 64)
+        self.ids = np.array([hotel['id'] for hotel in hotels], dtype=np.int64)
+        self.property_types = np.array([hotel.get('propertyType') or 0 for hotel in hotels], dtype=np.int32)
+        self.stars = np.array([hotel.get('stars') or 0 for hotel in hotels], dtype=np.int32)
+        self.amenities = np.zeros((len(hotels), words), dtype=np.uint64)
+        for row, hotel in enumerate(hotels):
+            for amenity in _hotel_amenities(hotel):
+                bit = self.amenity_bits[amenity]
+                self.amenities[row, bit // 64] |= np.uint64(1 << (bit % 64))
+        # distance to the city center in kilometers, NaN if it is unknown
+        self.center_distances = np.array([_float(hotel.get('distance')) for hotel in hotels], dtype=np.float64)
+        points = [_point(hotel.get('location')) for hotel in hotels]
+        self.lats = np.array([point[0] if point else np.nan for point in points], dtype=np.float64)
+        self.lons = np.array([point[1] if point else np.nan for point in points], dtype=np.float64)
+        # (cell of latitude, cell of longitude) -> rows of hotels in the cell
+        cells = {}
+        for row, point in enumerate(points):
+            if point:
+                cells.setdefault((_grid_cell(point[0]), _grid_cell(point[1])), []).append(row)
+        self.cells = {cell: np.array(rows, dtype=np.int64) for cell, rows in cells.items()}
+        # id and lowercase name of the place of interest -> its coordinates
+        self.pois = {}
+        for poi in pois:
+            point = _point(poi.get('location') or poi.get('geom'))
+            if point is None:
+                continue
+            self.pois[_normalize_amenity(poi['id'])] = point
+            if poi.get('name'):
+                self.pois.setdefault(poi['name'].strip().lower(), point)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def mask(self, amenities) -> np.ndarray:
+        """
+        :param amenities: names of 'shortFacilities' or ids of 'facilities'
+        :return: bitset of the amenities, None if some amenity is not found in the list
+        """
+        mask = np.zeros(self.amenities.shape[1], dtype=np.uint64)
+        for amenity in amenities:
+            bit = self.amenity_bits.get(_normalize_amenity(amenity))
+            if bit is None:
+                return None
+            mask[bit // 64] |= np.uint64(1 << (bit % 64))
+        return mask
+
+    def near(self, lat, lon, max_distance=None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds hotels around the point, only grid cells within 'max_distance' are read
+
+        :param lat: latitude of the point
+        :param lon: longitude of the point
+        :param max_distance: max distance to the hotel in kilometers, by default all hotels with coordinates
+        :return: tuple (rows of hotels, distances in kilometers) sorted by distance
+        """
+        if max_distance is None:
+            rows = np.flatnonzero(~np.isnan(self.lats))
+        else:
+            lat_radius = max_distance / DEGREE_KM
+            lon_radius = max_distance / (DEGREE_KM * max(math.cos(math.radians(lat)), 0.01))
+            lat_cells = range(_grid_cell(lat - lat_radius), _grid_cell(lat + lat_radius) + 1)
+            lon_cells = range(_grid_cell(lon - lon_radius), _grid_cell(lon + lon_radius) + 1)
+            if len(lat_cells) * len(lon_cells) <= len(self.cells):
+                found = [self.cells.get((cell_lat, cell_lon)) for cell_lat in lat_cells for cell_lon in lon_cells]
+            else:
+                # the area is larger than the city, it is faster to check every filled cell
+                found = [rows for (cell_lat, cell_lon), rows in self.cells.items()
+                         if cell_lat in lat_cells and cell_lon in lon_cells]
+            found = [rows for rows in found if rows is not None]
+            rows = np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+        distances = _haversine(lat, lon, self.lats[rows], self.lons[rows])
+        if max_distance is not None:
+            rows, distances = rows[distances <= max_distance], distances[distances <= max_distance]
+        order = np.argsort(distances, kind='stable')
+        return rows[order], distances[order]
+
+    def filter(self, property_types=(), min_stars=0, amenities=(), max_distance=None, poi=None) -> list[int]:
+        """
+        :param property_types: allowed types of hotels, empty means all types
+        :param min_stars: min number of stars for hotel required
+        :param amenities: amenities which are required, names of 'shortFacilities' or ids of 'facilities'
+        :param max_distance: max distance from the hotel to the city center or to the 'poi' in kilometers
+        :param poi: id or name of the place of interest of the hotel list
+        :return: list of ids of suitable hotels in the order of the list, sorted by distance
+            if 'max_distance' or 'poi' is given
+        """
+        selected = self.stars >= min_stars
+        if len(property_types) > 0:
+            selected &= np.isin(self.property_types, list(property_types))
+        if len(amenities) > 0:
+            mask = self.mask(amenities)
+            if mask is None:
+                return []
+            selected &= np.all((self.amenities & mask) == mask, axis=1)
+        if poi is not None:
+            point = self.pois.get(_normalize_amenity(poi))
+            if point is None:
+                return []
+            rows, _ = self.near(point[0], point[1], max_distance)
+            return self.ids[rows[selected[rows]]].tolist()
+        if max_distance is not None:
+            # NaN distances are never within the limit
+            rows = np.flatnonzero(selected & (self.center_distances <= max_distance))
+            return self.ids[rows[np.argsort(self.center_distances[rows], kind='stable')]].tolist()
+        return self.ids[selected].tolist()
+
+
+def _hotel_amenities(hotel):
+    amenities = {_normalize_amenity(name) for name in hotel.get('shortFacilities') or []}
+    amenities.update(int(facility) for facility in hotel.get('facilities') or [])
+    return amenities
+
+
+def _normalize_amenity(amenity):
+    if isinstance(amenity, str) and not amenity.isdigit():
+        return amenity.strip().lower()
+    return int(amenity)
+
+
+def _haversine(lat, lon, lats, lons) -> np.ndarray:
+    lat, lon, lats, lons = np.radians(lat), np.radians(lon), np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def _point(location):
+    # coordinates are given as {'lat', 'lon'} or as GeoJSON point with [lon, lat]
+    if not isinstance(location, dict):
+        return None
+    if location.get('lat') is not None and location.get('lon') is not None:
+        return float(location['lat']), float(location['lon'])
+    coordinates = location.get('coordinates')
+    if coordinates and len(coordinates) == 2:
+        return float(coordinates[1]), float(coordinates[0])
+    return None
+
+
+def _float(value):
+    return np.nan if value is None else float(value)
+
+
+def _grid_cell(coordinate):
+    return math.floor(coordinate / HOTEL_GRID_CELL)
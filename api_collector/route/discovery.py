@@ -0,0 +1,192 @@
+import copy
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from cachetools import TTLCache
+from api_collector.air_tickets.air_tickets_api import AirTicketsApi
+from api_collector.route.route import Route, get_ticket, get_hotel, save_hotel_photo_urls, time_left
+
+# popular directions are recalculated by the upstream API a few times a day
+POPULAR_DESTINATIONS_TTL = 6 * 60 * 60
+# priced destinations depend on live ticket and hotel prices, so they expire sooner
+PRICED_DESTINATIONS_TTL = 30 * 60
+
+_popular_destinations_cache = TTLCache(maxsize=256, ttl=POPULAR_DESTINATIONS_TTL)
+_priced_destinations_cache = TTLCache(maxsize=256, ttl=PRICED_DESTINATIONS_TTL)
+_cache_lock = threading.Lock()
+
+
+def clear_discovery_caches():
+    """
+    Removes cached popular and priced destinations, e.g. between tests
+    """
+    with _cache_lock:
+        _popular_destinations_cache.clear()
+        _priced_destinations_cache.clear()
+
+
+def get_popular_destinations(origin) -> list[dict]:
+    """
+    Returns popular directions from the origin city sorted by ticket price.
+    The response is cached per origin, so repeated discovery searches do not hit the API.
+
+    :param origin: str, IATA code of the departure city
+    :return: list of popular directions in 'fetch_popular_routes_from_city' format
+    """
+    with _cache_lock:
+        if origin in _popular_destinations_cache:
+            return _popular_destinations_cache[origin]
+
+    response = AirTicketsApi().fetch_popular_routes_from_city(origin=origin)
+    # Check if the response was successful
+    if not response['success']:
+        raise Exception('response was not successful')
+    destinations = sorted(response['data'].values(), key=lambda x: x['price'])
+
+    with _cache_lock:
+        _popular_destinations_cache[origin] = destinations
+    return destinations
+
+
+def price_destination(origin, destination, departure_at, return_at, min_stars=0, max_transfers=0, airlines=(),
+                      max_flight_duration=None, amenities=(), max_distance=None, poi=None) -> Route:
+    """
+    Builds the cheapest route to a single destination. Ticket and hotel are searched concurrently.
+
+    :return: 'Route' with the cheapest ticket and hotel for the destination
+    """
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        ticket_future = executor.submit(get_ticket, origin=origin, destination=destination,
+                                        departure_at=departure_at, return_at=return_at,
+                                        max_transfers=max_transfers, airlines=airlines,
+                                        max_flight_duration=max_flight_duration, cheapest_only=True)
+        hotel_future = executor.submit(get_hotel, location=destination, check_in=departure_at,
+                                       check_out=return_at, min_stars=min_stars, streaming=True,
+                                       amenities=amenities, max_distance=max_distance, poi=poi)
+        ticket = ticket_future.result()[0]
+        hotel = hotel_future.result()[0]
+
+    return Route(origin=origin, destination=destination, departure_at=departure_at, return_at=return_at,
+                 ticket=ticket, hotel=hotel)
+
+
+def copy_route(route, budget) -> Route:
+    """
+    Copies the route together with its ticket and hotel, so changes of the copy do not reach the original
+
+    :param route: 'Route' class
+    :param budget: budget of the copy
+    :return: 'Route' class
+    """
+    return Route(origin=route.origin, destination=route.destination, departure_at=route.departure_at,
+                 return_at=route.return_at, budget=budget, ticket=copy.copy(route.ticket),
+                 hotel=copy.copy(route.hotel))
+
+
+def find_anywhere_routes(origin, departure_at=None, return_at=None, budget=None, route_number=3,
+                         destinations_number=8, max_workers=4, min_stars=0, max_transfers=0, airlines=(),
+                         max_flight_duration=None, deadline=None, amenities=(), max_distance=None,
+                         poi=None) -> list[Route]:
+    """
+    Find the best routes from the origin when the destination is not specified.
+    Top popular directions from the origin are priced concurrently and the cheapest
+    complete routes within the budget are returned.
+
+    Parameters:
+    :param origin: str, IATA code of the departure point.
+    :param departure_at: str, optional, departure date (format YYYY-MM-DD).
+    :param return_at: str, optional, return date (format YYYY-MM-DD).
+    :param budget: float, optional, maximum combined price for the ticket and hotel.
+    :param route_number: int, optional, number of routes to return (default is 3).
+    :param destinations_number: int, number of popular destinations to price (default is 8).
+    :param max_workers: int, max number of destinations priced at the same time (default is 4).
+    :param min_stars: min number of stars for hotel required
+    :param max_transfers: max number of transfers during a flight, 0 by default
+    :param airlines: list of airlines which are required for a flight, by default empty tuple - all airlines are allowed
+    :param max_flight_duration: max duration of a flight in hours, None by default
+    :param deadline: float, optional, max time of the search in seconds, None means no limit. Destinations
+        which are not priced by then are skipped and the routes are marked as partial
+    :param amenities: amenities which are required from hotels, see 'get_hotel'
+    :param max_distance: max distance from the hotel to the city center or to the 'poi' in kilometers
+    :param poi: id or name of the place of interest of the hotel list
+
+    :return: list of 'Route' class sorted by total cost, may be empty if no route fits the budget
+    """
+    deadline_at = None if deadline is None else time.monotonic() + deadline
+    partial = False
+    has_budget = budget and (not budget == "None")
+    key = (origin, departure_at, return_at, destinations_number, min_stars, max_transfers, tuple(airlines),
+           max_flight_duration, tuple(sorted(amenities, key=str)), max_distance, poi)
+
+    routes = None
+    with _cache_lock:
+        if key in _priced_destinations_cache:
+            cached_routes, cached_budget = _priced_destinations_cache[key]
+            # destinations are prefiltered by budget, so a smaller budget can reuse the result
+            if cached_budget is None or (has_budget and budget <= cached_budget):
+                routes = cached_routes
+
+    if routes is None:
+        destinations = get_popular_destinations(origin)
+        if has_budget:
+            # the flight alone must leave some money for a hotel
+            destinations = [destination for destination in destinations if destination['price'] < budget]
+        destinations = [destination['destination'] for destination in destinations[:destinations_number]]
+
+        def price(destination):
+            try:
+                return price_destination(origin=origin, destination=destination, departure_at=departure_at,
+                                         return_at=return_at, min_stars=min_stars, max_transfers=max_transfers,
+                                         airlines=airlines, max_flight_duration=max_flight_duration,
+                                         amenities=amenities, max_distance=max_distance, poi=poi)
+            except Exception:
+                # one failed destination should not break the whole discovery search
+                return None
+
+        # bound the fan-out, each destination issues its own ticket and hotel requests
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            futures = [executor.submit(price, destination) for destination in destinations]
+            done, not_done = wait(futures, timeout=time_left(deadline_at))
+            # destinations which are not priced before the deadline are skipped
+            partial = len(not_done) > 0
+            routes = [future.result() for future in futures if future in done]
+        finally:
+            # abandoned requests are not waited for, they end by the request timeout
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        # keep only destinations where both ticket and hotel were found
+        routes = [route for route in routes if route and route.ticket.found and route.hotel.found]
+        routes.sort(key=lambda route: route.calculate_total_cost())
+
+        if not partial:
+            with _cache_lock:
+                _priced_destinations_cache[key] = (routes, budget if has_budget else None)
+
+    if has_budget:
+        routes = [route for route in routes if route.calculate_total_cost() <= budget]
+    # cached routes are shared by searches, so every caller gets its own copies to attach photos to
+    routes = [copy_route(route, budget) for route in routes[:route_number]]
+
+    if deadline_at is None:
+        # collect hotel_photos
+        save_hotel_photo_urls(routes)
+    elif time_left(deadline_at) > 0:
+        # photos are attached to other copies, which are returned only if they arrive before the deadline,
+        # so the request finishing in the background does not change the returned routes
+        photo_routes = [copy_route(route, budget) for route in routes]
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            done, _ = wait([executor.submit(save_hotel_photo_urls, photo_routes)], timeout=time_left(deadline_at))
+        finally:
+            executor.shutdown(wait=False)
+        if done:
+            routes = photo_routes
+        else:
+            partial = True
+    else:
+        partial = True
+    for route in routes:
+        route.partial = partial
+
+    return routes
@@ -0,0 +1,91 @@
+import math
+import threading
+from collections import namedtuple
+from cachetools import LRUCache
+
+# page size of the upstream API by default
+DEFAULT_PAGE_LIMIT = 30
+# pages walk through at most the same number of tickets as nine default pages
+MAX_TICKETS = 9 * DEFAULT_PAGE_LIMIT
+# number of pages requested at the same time by the async search
+PAGE_CONCURRENCY = 3
+# weight of the latest search in the typical number of tickets of the route
+HISTORY_WEIGHT = 0.5
+# the page is larger than the typical number of tickets, so usually it contains all of them
+PAGE_SIZE_MARGIN = 1.25
+
+# limit: number of tickets in a page, max_pages: max number of pages,
+# first_wave: number of pages requested at once in the beginning
+PagePlan = namedtuple('PagePlan', ['limit', 'max_pages', 'first_wave'])
+
+
+class PageSizeHistory:
+    """
+    Typical number of tickets of every route learned from previous searches. Routes with
+    known number of tickets are requested with one page of a suitable size instead of
+    walking through default pages.
+    """
+
+    def __init__(self, maxsize=4096):
+        """
+        :param maxsize: max number of remembered routes
+        """
+        self.counts = LRUCache(maxsize=maxsize)
+        # the largest page size which the upstream has been seen to fill, smaller pages are cut by it
+        self.honored_limit = 0
+        self.lock = threading.Lock()
+
+    def record(self, key, count):
+        """
+        Remembers the number of tickets found by the full walk through pages
+
+        :param key: tuple (origin, destination, direct)
+        :param count: number of found tickets
+        """
+        with self.lock:
+            typical = self.counts.get(key)
+            self.counts[key] = count if typical is None else (HISTORY_WEIGHT * count +
+                                                              (1 - HISTORY_WEIGHT) * typical)
+
+    def plan(self, key, needed=None) -> PagePlan:
+        """
+        Chooses the page size for the search
+
+        :param key: tuple (origin, destination, direct)
+        :param needed: int, optional, number of the cheapest tickets if only they are needed
+        :return: 'PagePlan'
+        """
+        if needed:
+            # tickets come sorted by price, so the first page contains the cheapest ones
+            return PagePlan(limit=needed, max_pages=1, first_wave=1)
+        with self.lock:
+            typical = self.counts.get(key)
+        if typical is None:
+            return PagePlan(limit=DEFAULT_PAGE_LIMIT, max_pages=MAX_TICKETS // DEFAULT_PAGE_LIMIT,
+                            first_wave=PAGE_CONCURRENCY)
+        limit = min(MAX_TICKETS, max(DEFAULT_PAGE_LIMIT, math.ceil(typical * PAGE_SIZE_MARGIN)))
+        return PagePlan(limit=limit, max_pages=math.ceil(MAX_TICKETS / limit), first_wave=1)
+
+    def is_last_page(self, limit, count) -> bool:
+        """
+        Checks if the page is the last one. An empty page is always the last. A page which is not full
+        is the last only if the upstream is known to return full pages of the limit, otherwise it may cap
+        or ignore the limit and the next page still has tickets.
+
+        :param limit: page size of the request
+        :param count: number of tickets in the page
+        :return: True if next pages are empty
+        """
+        with self.lock:
+            if count == limit:
+                self.honored_limit = max(self.honored_limit, limit)
+            return count == 0 or count < limit <= self.honored_limit
+
+    def clear(self):
+        with self.lock:
+            self.counts.clear()
+            self.honored_limit = 0
+
+
+# history shared by all searches
+page_size_history = PageSizeHistory()
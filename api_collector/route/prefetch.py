@@ -0,0 +1,109 @@
+import asyncio
+from datetime import datetime
+from api_collector.air_tickets.air_tickets_api import AirTicketsApi
+from api_collector.route.pagination import page_size_history
+from api_collector.route.route import fetch_hotel_prices, find_filtered_hotels, known_location_id, search_location
+
+# fields of the partial request which define what is prefetched
+PREFETCH_FIELDS = ('Departure', 'Destination', 'Arrival', 'Return')
+
+
+def warm_hotel_list(destination):
+    """
+    Finds the location id of the destination and loads its hotel list, so the hotel list
+    is already saved on disk when the route search starts
+
+    :param destination: str, IATA code or name of the destination city
+    """
+    location_id = known_location_id(destination)
+    if location_id is None:
+        city = search_location(destination)
+        if city is None:
+            return
+        location_id = int(city['id'])
+    find_filtered_hotels(locationId=location_id)
+
+
+def warm_price_calendar(origin, destination, departure_at=None):
+    """
+    Loads the month price calendar of the direction into the response cache
+
+    :param origin: str, IATA code of the departure city
+    :param destination: str, IATA code of the destination city
+    :param departure_at: str, optional, departure date (format YYYY-MM-DD), current month if not specified
+    """
+    month = departure_at[:7] if departure_at else datetime.now().strftime('%Y-%m')
+    AirTicketsApi().fetch_grouped_tickets(origin=origin, destination=destination, departure_at=month)
+
+
+def warm_ticket_pages(origin, destination, departure_at, return_at):
+    """
+    Loads the first wave of direct ticket pages into the response cache, the requests
+    are the same as the first requests of the route search
+    """
+    air_api = AirTicketsApi()
+    plan = page_size_history.plan((origin, destination, True))
+    for page in range(1, plan.first_wave + 1):
+        response = air_api.fetch_cheapest_tickets(origin=origin, destination=destination, departure_at=departure_at,
+                                                  return_at=return_at, one_way=True, direct=True, limit=plan.limit,
+                                                  page=page)
+        if not response['success'] or page_size_history.is_last_page(plan.limit, len(response['data'])):
+            return
+
+
+class RoutePrefetcher:
+    """
+    Warms upstream caches while the conversation is still in progress. It receives partial states
+    of the request analyzer and starts requests which the route search will make later: the hotel
+    list as soon as the destination is known, the price calendar when both cities are known, ticket
+    pages and hotel prices when dates are known too. The prefetch is cancelled when the state changes.
+    """
+
+    def __init__(self):
+        self.state = None
+        self.task = None
+
+    def notify(self, partial_state):
+        """
+        Starts prefetching for the new partial state, must be called from a running event loop.
+        The running prefetch is cancelled if the cities or dates have changed.
+
+        :param partial_state: dictionary with fields retrieved so far, e.g. {"Departure": "KZN"}
+        """
+        state = tuple(partial_state.get(field) for field in PREFETCH_FIELDS)
+        if state == self.state:
+            return
+        self.cancel()
+        self.state = state
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # prefetching is only an optimization, nothing to do outside of the event loop
+            return
+        self.task = loop.create_task(self.prefetch(*state))
+
+    def cancel(self):
+        """
+        Cancels the running prefetch. Requests which have already been sent finish in their threads,
+        but their results are still saved to the cache.
+        """
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+        self.task = None
+
+    async def prefetch(self, origin, destination, departure_at, return_at):
+        """
+        Warms all caches which can be warmed with known fields
+
+        :return: list of results of warming steps, failed steps return exceptions
+        """
+        steps = []
+        if destination:
+            steps.append(asyncio.to_thread(warm_hotel_list, destination))
+        if origin and destination:
+            steps.append(asyncio.to_thread(warm_price_calendar, origin, destination, departure_at))
+        if origin and destination and departure_at and return_at:
+            steps.append(asyncio.to_thread(warm_ticket_pages, origin, destination, departure_at, return_at))
+            steps.append(asyncio.to_thread(fetch_hotel_prices, destination, departure_at, return_at))
+        # failed prefetch does not matter, the route search makes the same requests again
+        return await asyncio.gather(*steps, return_exceptions=True)
@@ -1,11 +1,70 @@
-import json
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from cachetools import LRUCache, TTLCache
 from api_collector.utils.directories import data_directory_path
 from api_collector.air_tickets.air_tickets_api import AirTicketsApi
-from api_collector.hotels.hotel_api import HotelApi
+from api_collector.hotels.hotel_api import HotelApi, UpstreamError
+from api_collector.hotels.hotel_enums import CollectionType, LookFor
+from api_collector.hotels.catalog import ROUTE_HOTEL_TYPES, hotel_types
+from api_collector.hotels.location_index import location_index
+from api_collector.hotels.photo_ids import photo_id_store, hotel_photo_url
+from api_collector.route.candidates import TicketCandidates, BudgetWindowHeap, HotelIndex, budget_window
+from api_collector.route.route_cache import route_cache
+from api_collector.route.pagination import page_size_history
+from api_collector.utils.decoding import decode_hotel_list
 import os
 
+# location ids of already searched locations (IATA code -> locationId), so the hotel list of the location
+# can be loaded without waiting for the hotel prices
+location_ids = {}
+# radius in kilometers around the origin and destination where nearby airports are searched
+ALTERNATIVE_DISTANCE = 200
+# hotel dates are fixed, so alternative flights are searched for the same dates by default
+ALTERNATIVE_FLEXIBILITY = 0
+# number of alternative options requested for every nearby direction
+ALTERNATIVE_LIMIT = 5
+# saved hotel lists are loaded again after this number of seconds
+HOTEL_LIST_MAX_AGE = 7 * 24 * 60 * 60
+# photos of hotels rarely change, so their ids are kept in memory for a day and on disk for 'PHOTO_IDS_MAX_AGE'
+PHOTO_IDS_TTL = 24 * 60 * 60
+# number of hotels requested from every hotel collection
+COLLECTION_LIMIT = 30
+# collections of a location without prices of the searched dates are not requested for this number of seconds
+COLLECTION_MISS_TTL = 60 * 60
+
+# hotel id (str) -> list of photo ids
+_photo_ids_cache = TTLCache(maxsize=4096, ttl=PHOTO_IDS_TTL)
+_photo_ids_lock = threading.Lock()
+# (location id, collection types) of collections which had no prices of the searched dates
+_collection_misses = TTLCache(maxsize=4096, ttl=COLLECTION_MISS_TTL)
+_collection_misses_lock = threading.Lock()
+# location id -> tuple (modification time of the saved hotel list, 'HotelIndex' of the list)
+_hotel_indexes = LRUCache(maxsize=64)
+_hotel_indexes_lock = threading.Lock()
+
+
+def memoized(render):
+    """
+    Caches the string rendered by the method in '_rendered' dictionary of the object,
+    so routes kept for every chat are not rendered again on each message
+    """
+    @functools.wraps(render)
+    def wrapper(self):
+        if render.__name__ not in self._rendered:
+            self._rendered[render.__name__] = render(self)
+        return self._rendered[render.__name__]
+    return wrapper
+
 
 class Ticket:
+    # only fields needed for rendering and route building are kept, raw json is dropped
+    __slots__ = ('flight_origin', 'flight_destination', 'origin_airport', 'destination_airport', 'ticket_price',
+                 'airline', 'flight_number', 'flight_departure_at', 'flight_return_at', 'transfers',
+                 'return_transfers', 'flight_duration', 'flight_duration_to', 'flight_duration_back', 'flight_link',
+                 'alternative', 'found', '_rendered')
+
     def __init__(self, ticket):
         """
                 Initialize ticket information
@@ -27,9 +86,12 @@ class Ticket:
                         duration_to (int): Duration of the outbound flight in minutes
                         duration_back (int): Duration of the return flight in minutes
                         link (str): Link to the ticket on Aviasales
+                        alternative (bool, optional): True if the ticket is from nearby airports
                 """
-        self.ticket = ticket
+        self.found = bool(ticket)
+        self._rendered = {}
         if ticket:
+            self.alternative = ticket.get('alternative', False)
             self.flight_origin = ticket['origin']
             self.flight_destination = ticket['destination']
             self.origin_airport = ticket['origin_airport']
@@ -46,10 +108,35 @@ class Ticket:
             self.flight_duration_back = ticket['duration_back']
             self.flight_link = 'https://www.aviasales.com' + ticket['link']
         else:
+            # all ticket fields except 'found' and '_rendered' are empty
+            for field in Ticket.__slots__[:-2]:
+                setattr(self, field, None)
             self.ticket_price = 0
 
+    @property
+    def key(self):
+        """
+        Stable identifier of the ticket, None if the ticket has not been found
+        """
+        if not self.found:
+            return None
+        if self.alternative:
+            # alternative options have no flight number, they differ by cities
+            return self.flight_origin, self.flight_destination, self.flight_departure_at
+        return self.flight_number, self.flight_departure_at
+
+    @memoized
     def to_string_en(self):
-        if self.ticket:
+        if self.found and self.alternative:
+            flight_info = (f"✈️ Nearby Airport Option ✈️\n"
+                           f"From: {self.flight_origin}\n"
+                           f"To: {self.flight_destination}\n"
+                           f"Departure: {self.flight_departure_at}\n"
+                           f"Return: {self.flight_return_at}\n"
+                           f"Price: {self.ticket_price} rub\n"
+                           f"Connections: {self.transfers}\n"
+                           f"Duration: {self.flight_duration // 60}h {self.flight_duration % 60}m\n")
+        elif self.found:
             flight_info = (f"✈️ Flight Information ✈️\n"
                            f"Airline: {self.airline}\n"
                            f"From: {self.flight_origin} ({self.origin_airport})\n"
@@ -67,8 +154,18 @@ class Ticket:
 
         return flight_info
 
+    @memoized
     def to_string_ru(self):
-        if self.ticket:
+        if self.found and self.alternative:
+            flight_info = (f"✈️ Вариант через соседний аэропорт ✈️\n"
+                           f"Откуда: {self.flight_origin}\n"
+                           f"Куда: {self.flight_destination}\n"
+                           f"Вылет: {self.flight_departure_at}\n"
+                           f"Возвращение: {self.flight_return_at}\n"
+                           f"Цена: {self.ticket_price} руб\n"
+                           f"Пересадки: {self.transfers}\n"
+                           f"Продолжительность полета: {self.flight_duration // 60}ч {self.flight_duration % 60}м\n")
+        elif self.found:
             flight_info = (f"✈️ Информация о рейсе ✈️\n"
                            f"Авиакомпания: {self.airline}\n"
                            f"Откуда: {self.flight_origin} ({self.origin_airport})\n"
@@ -88,6 +185,10 @@ class Ticket:
 
 
 class Hotel:
+    # only fields needed for rendering and route building are kept, raw json is dropped
+    __slots__ = ('hotel_location_id', 'hotel_id', 'hotel_price_from', 'hotel_price_avg', 'hotel_stars', 'hotel_name',
+                 'hotel_city_name', 'hotel_country', 'photo_ids', 'found', '_rendered')
+
     def __init__(self, hotel):
         """
         Initialize hotel information
@@ -107,27 +208,42 @@ class Hotel:
                 state (str): State where the city is located
                 country (str): Country of the hotel
         """
-        self.hotel = hotel
-        self.photo_urls = []
+        self.found = bool(hotel)
+        self._rendered = {}
+        self.photo_ids = []
         if hotel:
             self.hotel_location_id = hotel['locationId']
             self.hotel_id = hotel['hotelId']
             self.hotel_price_from = hotel['priceFrom']
             self.hotel_price_avg = hotel['priceAvg']
-            self.hotel_price_percentile = hotel['pricePercentile']
             self.hotel_stars = hotel['stars']
             self.hotel_name = hotel['hotelName']
-            self.hotel_location = hotel['location']
-            self.hotel_geo = hotel['location']['geo']
             self.hotel_city_name = hotel['location']['name']
-            self.hotel_state = hotel['location']['state']
             self.hotel_country = hotel['location']['country']
         else:
+            # all hotel fields except 'photo_ids', 'found' and '_rendered' are empty
+            for field in Hotel.__slots__[:-3]:
+                setattr(self, field, None)
             self.hotel_price_from = 0
             self.hotel_price_avg = 0
 
+    @property
+    def key(self):
+        """
+        Stable identifier of the hotel, None if the hotel has not been found
+        """
+        return self.hotel_id if self.found else None
+
+    @property
+    def photo_urls(self):
+        """
+        Urls of photos of the hotel, they are built from photo ids only when they are needed
+        """
+        return [hotel_photo_url(photo_id) for photo_id in self.photo_ids]
+
+    @memoized
     def to_string_en(self):
-        if self.hotel:
+        if self.found:
             stars = '⭐' * int(self.hotel_stars)
             hotel_info = (f"🏨 Hotel Information 🏨\n"
                           f"Hotel Name: {self.hotel_name}\n"
@@ -139,8 +255,9 @@ class Hotel:
 
         return hotel_info
 
+    @memoized
     def to_string_ru(self):
-        if self.hotel:
+        if self.found:
             stars = '⭐' * self.hotel_stars
             hotel_info = (f"🏨 Информация об отеле 🏨\n"
                           f"Название отеля: {self.hotel_name}\n"
@@ -165,6 +282,7 @@ class Route:
         budget (float, optional): The budget for the route.
         ticket (Ticket, optional): Information about the flight ticket.
         hotel (Hotel, optional): Information about the hotel.
+        partial (bool): True if the route was built before all data arrived because of the search deadline.
 
     Methods:
         __init__(origin, destination, departure_at, return_at, budget=None, ticket=None, hotel=None):
@@ -183,6 +301,9 @@ class Route:
             Calculates the total cost of the route including both flight and hotel.
     """
 
+    __slots__ = ('origin', 'destination', 'departure_at', 'return_at', 'budget', 'ticket', 'hotel', 'partial',
+                 '_rendered')
+
     def __init__(self, origin, destination, departure_at, return_at, budget=None, ticket=None, hotel=None):
         """
         Initializes the Route instance.
@@ -196,6 +317,8 @@ class Route:
             ticket (dict, optional): Information about the flight ticket.
             hotel (dict, optional): Information about the hotel.
         """
+        self._rendered = {}
+        self.partial = False
         self.origin = origin
         self.destination = destination
         self.departure_at = departure_at
@@ -215,6 +338,7 @@ class Route:
         Adds flight details to the route.
         """
         self.ticket = Ticket(ticket=ticket)
+        self._rendered.clear()
 
     def add_hotel(self, hotel):
         """
@@ -222,7 +346,9 @@ class Route:
 
         """
         self.hotel = Hotel(hotel=hotel)
+        self._rendered.clear()
 
+    @memoized
     def to_string_en(self):
         """
         Returns a string representation of the route including flight and hotel details in English.
@@ -241,6 +367,7 @@ class Route:
 
         return f"Route from {self.origin} to {self.destination}:\n{flight_info}\n{hotel_info}"
 
+    @memoized
     def to_string_ru(self):
         """
         Returns a string representation of the route including flight and hotel details in Russian.
@@ -273,174 +400,537 @@ class Route:
         return round(total_cost)
 
 
-def get_ticket(origin, destination, departure_at=None, return_at=None, budget=None, number_of_tickets=1,
-               max_transfers=0, airlines=(), max_flight_duration=None) -> list[Ticket]:
+def fetch_ticket_pages(origin, destination, departure_at=None, return_at=None, direct=False,
+                       needed=None) -> list[dict]:
     """
-    Fetch the cheapest air ticket based on the specified parameters.
+    Fetch pages of the cheapest tickets. The page size is chosen by the history of the route, so routes
+    with known number of tickets are usually fetched by a single request. Walking stops at the empty
+    page or at the page which is not full if the upstream is known to honor the page size.
+
+    :param origin: str, IATA code of the departure point
+    :param destination: str, IATA code of the destination point
+    :param departure_at: str, optional, departure date (format YYYY-MM or YYYY-MM-DD)
+    :param return_at: str, optional, return date (format YYYY-MM or YYYY-MM-DD)
+    :param direct: True if only direct flights are required
+    :param needed: int, optional, number of the cheapest tickets if only they are needed
+
+    :return: list of tickets of json type sorted by price
+    """
+    key = (origin, destination, direct)
+    plan = page_size_history.plan(key, needed=needed)
+    tickets = []
+    air_api = AirTicketsApi()
+    for page in range(1, plan.max_pages + 1):
+        # Fetch the cheapest tickets for the given parameters
+        response = air_api.fetch_cheapest_tickets(origin=origin,
+                                                  destination=destination,
+                                                  departure_at=departure_at,
+                                                  return_at=return_at,
+                                                  one_way=True,
+                                                  direct=direct,
+                                                  limit=plan.limit,
+                                                  page=page)
+        # Check if the response was successful
+        if not response['success']:
+            raise Exception('response was not successful')
+        # Append the received ticket data to the tickets list
+        tickets += response['data']
+        # Break the loop if next pages are empty
+        if page_size_history.is_last_page(plan.limit, len(response['data'])):
+            break
+    if needed is None:
+        page_size_history.record(key, len(tickets))
+    return tickets
+
+
+def fetch_ticket_candidates(origin, destination, departure_at=None, return_at=None, max_transfers=0, airlines=(),
+                            max_flight_duration=None, needed=None) -> TicketCandidates:
+    """
+    Fetch all air tickets for the route which satisfy the filters. Tickets are sorted by price.
 
     :param origin: str, IATA code of the departure point
     :param destination: str, IATA code of the destination point
     :param departure_at: str, optional, departure date (format YYYY-MM or YYYY-MM-DD)
     :param return_at: str, optional, return date (format YYYY-MM or YYYY-MM-DD)
-    :param budget: float, optional, maximum price of the ticket
-    :param number_of_tickets: amount of different tickets to return
     :param max_transfers: max number of transfers during a flight, 0 by default
     :param airlines: list of airlines which are required for a flight, by default empty tuple - all airlines are allowed
     :param max_flight_duration: max duration of a flight in hours, None by default
+    :param needed: int, optional, number of the cheapest tickets if only they are needed,
+        ignored when tickets are filtered by airlines or flight duration
 
-    :return: list of tickets of class 'Ticket'
+    :return: 'TicketCandidates' sorted by price
     """
+    if len(airlines) > 0 or max_flight_duration is not None or max_transfers != 0:
+        # filters may drop the cheapest tickets, so all pages are required
+        needed = None
     # Initialize an empty list to store tickets
     tickets = []
-    # Loop through the first 9 pages to find tickets
-    air_api = AirTicketsApi()
     # find tickets
     if max_transfers == 0:
-        for page in range(1, 10):
-            # Fetch the cheapest tickets for the given parameters
-            response = air_api.fetch_cheapest_tickets(origin=origin,
-                                                      destination=destination,
-                                                      departure_at=departure_at,
-                                                      return_at=return_at,
-                                                      one_way=True,
-                                                      direct=True,
-                                                      page=page)
-            # Check if the response was successful
-            if not response['success']:
-                raise Exception('response was not successful')
-            # Break the loop if no new ticket data is received
-            if len(response['data']) == 0:
-                break
-            else:
-                # Append the received ticket data to the tickets list
-                tickets += response['data']
+        tickets += fetch_ticket_pages(origin=origin, destination=destination, departure_at=departure_at,
+                                      return_at=return_at, direct=True, needed=needed)
     if len(tickets) == 0 or max_transfers != 0:
-        for page in range(1, 10):
-            # Fetch the cheapest tickets for the given parameters
-            response = air_api.fetch_cheapest_tickets(origin=origin,
-                                                      destination=destination,
-                                                      departure_at=departure_at,
-                                                      return_at=return_at,
-                                                      one_way=True,
-                                                      page=page)
-            # Check if the response was successful
-            if not response['success']:
-                raise Exception('response was not successful')
-            # Break the loop if no new ticket data is received
-            if len(response['data']) == 0:
-                break
-            else:
-                # Append the received ticket data to the tickets list
-                tickets += response['data']
-
-    # filter tickets by number of transfers
-    if max_transfers > 0:
-        tickets[:] = [ticket for ticket in tickets if
-                      ticket['transfers'] <= max_transfers and ticket['return_transfers'] <= max_transfers]
-
-    # filter by airline
-    if len(airlines) > 0:
-        tickets[:] = [ticket for ticket in tickets if
-                      ticket['airline'] in airlines]
-
-    # filter by flight duration
-    if max_flight_duration:
-        tickets[:] = [ticket for ticket in tickets if
-                      ticket['duration_to'] / 60 <= max_flight_duration and ticket[
-                          'duration_back'] / 60 <= max_flight_duration]
-
-    # Filter tickets by budget if a budget is specified
+        tickets += fetch_ticket_pages(origin=origin, destination=destination, departure_at=departure_at,
+                                      return_at=return_at, needed=needed)
+
+    return filter_tickets(tickets, max_transfers=max_transfers, airlines=airlines,
+                          max_flight_duration=max_flight_duration)
+
+
+def filter_tickets(tickets, max_transfers=0, airlines=(), max_flight_duration=None) -> TicketCandidates:
+    """
+    Filters tickets by number of transfers, airline and flight duration and sorts them by price
+
+    :param tickets: list of tickets of json type or 'TicketCandidates'
+    :param max_transfers: max number of transfers during a flight, 0 by default
+    :param airlines: list of airlines which are required for a flight, by default empty tuple - all airlines are allowed
+    :param max_flight_duration: max duration of a flight in hours, None by default
+    :return: 'TicketCandidates' sorted by price
+    """
+    if not isinstance(tickets, TicketCandidates):
+        tickets = TicketCandidates(tickets)
+    return tickets.filter(max_transfers=max_transfers, airlines=airlines,
+                          max_flight_duration=max_flight_duration).sort_by_price()
+
+
+def select_tickets(tickets, budget=None, number_of_tickets=1) -> list[Ticket]:
+    """
+    Chooses tickets closest to the budget from tickets sorted by price
+
+    :param tickets: 'TicketCandidates' or list of tickets of json type sorted by price
+    :param budget: float, optional, maximum price of the ticket
+    :param number_of_tickets: amount of different tickets to return
+    :return: list of tickets of class 'Ticket'
+    """
     if len(tickets) == 0:
         return [Ticket(ticket=None)]
-    if budget and (not budget == "None"):
-        # Initialize the last index of the ticket list to include
-        last_index = 0
-        # Iterate through the tickets to find those within budget
-        for i, ticket in enumerate(tickets):
-            if ticket['price'] < budget:
-                last_index = i
-            else:
-                break
-        # Slice the tickets list to only include tickets within budget
-        if len(tickets) <= number_of_tickets:
-            return conver_to_Ticket_class(tickets)
-        else:
-            min_index = max(0, last_index - (number_of_tickets // 2))
-            max_index = min(len(tickets), last_index + (number_of_tickets // 2) + (number_of_tickets % 2))
-            if max_index - min_index < number_of_tickets:
-                if min_index == 0:
-                    return conver_to_Ticket_class(tickets[:number_of_tickets])
-                else:
-                    return conver_to_Ticket_class(tickets[max_index - number_of_tickets:max_index])
-            return conver_to_Ticket_class(tickets[min_index:max_index])
+    if not isinstance(tickets, TicketCandidates):
+        tickets = TicketCandidates(tickets)
+    # only chosen tickets are converted to 'Ticket' class
+    return conver_to_Ticket_class(tickets.select(budget=budget, number_of_tickets=number_of_tickets))
+
+
+def get_ticket(origin, destination, departure_at=None, return_at=None, budget=None, number_of_tickets=1,
+               max_transfers=0, airlines=(), max_flight_duration=None, cheapest_only=False) -> list[Ticket]:
+    """
+    Fetch the cheapest air ticket based on the specified parameters.
+
+    :param origin: str, IATA code of the departure point
+    :param destination: str, IATA code of the destination point
+    :param departure_at: str, optional, departure date (format YYYY-MM or YYYY-MM-DD)
+    :param return_at: str, optional, return date (format YYYY-MM or YYYY-MM-DD)
+    :param budget: float, optional, maximum price of the ticket
+    :param number_of_tickets: amount of different tickets to return
+    :param max_transfers: max number of transfers during a flight, 0 by default
+    :param airlines: list of airlines which are required for a flight, by default empty tuple - all airlines are allowed
+    :param max_flight_duration: max duration of a flight in hours, None by default
+    :param cheapest_only: True if only the cheapest tickets are needed and no other tickets of the route
+        will be searched, then a single small page is requested
+
+    :return: list of tickets of class 'Ticket'
+    """
+    needed = number_of_tickets if cheapest_only and budget in (None, "None") else None
+    tickets = fetch_ticket_candidates(origin=origin, destination=destination, departure_at=departure_at,
+                                      return_at=return_at, max_transfers=max_transfers, airlines=airlines,
+                                      max_flight_duration=max_flight_duration, needed=needed)
+    return select_tickets(tickets, budget=budget, number_of_tickets=number_of_tickets)
+
+
+def fetch_alternative_tickets(origin, destination, departure_at, return_at, max_transfers=0, airlines=(),
+                              max_flight_duration=None, distance=ALTERNATIVE_DISTANCE,
+                              flexibility=ALTERNATIVE_FLEXIBILITY) -> list[dict]:
+    """
+    Fetch tickets between cities near the origin and the destination. Tickets are converted
+    to the format of 'fetch_cheapest_tickets' and sorted by price.
+
+    :param origin: str, IATA code of the departure point
+    :param destination: str, IATA code of the destination point
+    :param departure_at: str, departure date (format YYYY-MM-DD)
+    :param return_at: str, return date (format YYYY-MM-DD)
+    :param max_transfers: max number of transfers during a flight, 0 by default
+    :param airlines: list of airlines which are required for a flight, alternative options have no airline,
+        so nothing is returned if airlines are specified
+    :param max_flight_duration: max duration of a flight in hours, None by default
+    :param distance: radius in kilometers where nearby cities are searched
+    :param flexibility: range extension around the specified dates in days
+
+    :return: list of tickets of json type
+    """
+    if len(airlines) > 0 or not departure_at or not return_at:
+        return []
+    response = AirTicketsApi().fetch_alternative_route_tickets(origin=origin,
+                                                               destination=destination,
+                                                               depart_date=departure_at,
+                                                               return_date=return_at,
+                                                               distance=distance,
+                                                               limit=ALTERNATIVE_LIMIT,
+                                                               flexibility=flexibility)
+    tickets = []
+    for option in response.get('prices', []):
+        # filter options by number of transfers and flight duration
+        if max_transfers > 0 and option['number_of_changes'] > max_transfers:
+            continue
+        if max_flight_duration and option['duration'] > max_flight_duration * 60:
+            continue
+        tickets.append(alternative_to_ticket(option))
+    tickets.sort(key=lambda ticket: ticket['price'])
+    return tickets
+
+
+def alternative_to_ticket(option) -> dict:
+    """
+    Converts an option of 'fetch_alternative_route_tickets' to the ticket of json type
+
+    :param option: option of json type
+    :return: ticket of json type with 'alternative' flag
+    """
+    depart_date = option['depart_date']
+    return_date = option['return_date']
+    return {
+        'origin': option['origin'],
+        'destination': option['destination'],
+        'origin_airport': option['origin'],
+        'destination_airport': option['destination'],
+        'price': option['value'],
+        'airline': '',
+        'flight_number': None,
+        'departure_at': depart_date,
+        'return_at': return_date,
+        'transfers': option['number_of_changes'],
+        'return_transfers': option['number_of_changes'],
+        'duration': option['duration'],
+        'duration_to': option['duration'],
+        'duration_back': 0,
+        # search page of Aviasales, e.g. /search/MOW0107LED04071
+        'link': f"/search/{option['origin']}{depart_date[8:10]}{depart_date[5:7]}"
+                f"{option['destination']}{return_date[8:10]}{return_date[5:7]}1",
+        'alternative': True
+    }
+
+
+def add_alternative_routes(routes, alternative_tickets, budget=None, route_number=3) -> list[Route]:
+    """
+    Adds routes with tickets from nearby airports as separate variants. If the main search has not found
+    a ticket, alternative routes replace the route without a ticket, otherwise only the alternative which
+    is cheaper than all found tickets is added.
+
+    :param routes: list of 'Route' class built from the main search
+    :param alternative_tickets: list of tickets of json type sorted by price
+    :param budget: float, optional, maximum combined price for the ticket and hotel.
+    :param route_number: int, max number of alternative routes if the main search has not found a ticket
+    :return: list of 'Route' class
+    """
+    if len(routes) == 0 or len(alternative_tickets) == 0:
+        return routes
+    found_routes = [route for route in routes if route.ticket.found]
+    if found_routes:
+        cheapest_price = min(route.ticket.ticket_price for route in found_routes)
+        alternative_tickets = [ticket for ticket in alternative_tickets if ticket['price'] < cheapest_price
+                               and (ticket['origin'], ticket['destination']) != (routes[0].origin,
+                                                                                 routes[0].destination)]
+        number_of_alternatives = 1
     else:
-        return conver_to_Ticket_class(tickets[:number_of_tickets] if len(tickets) > number_of_tickets else tickets)
+        number_of_alternatives = route_number
+    # the cheapest hotel in the destination is combined with alternative tickets
+    hotel = min((route.hotel for route in routes), key=lambda hotel: (not hotel.found, hotel.hotel_price_from))
 
+    if budget and (not budget == "None"):
+        fitting_tickets = [ticket for ticket in alternative_tickets
+                           if ticket['price'] + hotel.hotel_price_from <= budget]
+        # as in 'combine_routes', the cheapest route is returned if nothing fits the budget
+        alternative_tickets = fitting_tickets if fitting_tickets or found_routes else alternative_tickets[:1]
+
+    alternative_tickets = alternative_tickets[:number_of_alternatives]
+    if len(alternative_tickets) == 0:
+        return routes
+    route = routes[0]
+    alternative_routes = [Route(origin=route.origin, destination=route.destination, departure_at=route.departure_at,
+                                return_at=route.return_at, budget=route.budget, ticket=ticket, hotel=hotel)
+                          for ticket in conver_to_Ticket_class(alternative_tickets)]
+    return found_routes + alternative_routes
+
+
+def select_budget_window(items, price_key, budget=None, number_of_items=1) -> list[dict]:
+    """
+    Chooses items which prices are closest to the budget from the list sorted by price
 
-def get_hotel(location, check_in, check_out, budget=None, min_stars=0, number_of_hotels=1) -> list[Hotel]:
+    :param items: list of items of json type sorted by price
+    :param price_key: name of the price field
+    :param budget: float, optional, maximum price of the item
+    :param number_of_items: amount of different items to return
+    :return: list of items of json type
     """
-    Fetches the hotel based on the specified parameters.
+    start, end = budget_window([item[price_key] for item in items], budget, number_of_items)
+    return items[start:end]
+
+
+def fetch_hotel_prices(location, check_in, check_out) -> list[dict]:
+    """
+    Fetches prices of all hotels in the location and remembers the location id of the location.
 
-    Parameters:
     :param location: str, Name of the location (can use IATA code).
     :param check_in: str, Check-in date (format YYYY-MM-DD).
     :param check_out: str, Check-out date (format YYYY-MM-DD).
-    :param budget: float, optional, Maximum price for the hotel.
-    :param min_stars: min number of stars for hotel required
-    :param number_of_hotels: number of different hotels to return
-
-    :return: list of 'Hotel' class
+    :return: list of hotels of json type
     """
     hotel_api = HotelApi()
     # Fetch hotel prices based on the provided location, check-in and check-out dates, and limit
     hotels = hotel_api.fetch_hotel_prices(location=location,
                                           check_in=check_in,
                                           check_out=check_out,
-                                          limit=10000)
-    # check if we fetched at least one hotel
-    if len(hotels) == 0:
-        return [Hotel(hotel=None)]
+                                          limit=10000,
+                                          slim=True)
+    if len(hotels) > 0:
+        location_ids[location] = hotels[0]['locationId']
+    return hotels
 
-    # get all hotel ids satisfied our filter
-    filtered_hotels = find_filtered_hotels(locationId=hotels[0]['locationId'], min_stars=min_stars)
-    # filter obtained hotels
-    hotels[:] = [hotel for hotel in hotels if hotel['hotelId'] in filtered_hotels]
+
+def filter_hotels(hotels, filtered_hotels) -> list[dict]:
+    """
+    Leaves only hotels with allowed ids and sorts them by the 'priceFrom' field in ascending order
+
+    :param hotels: list of hotels of json type
+    :param filtered_hotels: ids of allowed hotels
+    :return: list of hotels of json type sorted by price
+    """
+    filtered_hotels = set(filtered_hotels)
+    hotels = [hotel for hotel in hotels if hotel['hotelId'] in filtered_hotels]
+    return sorted(hotels, key=lambda x: x['priceFrom'])
+
+
+def select_hotels(hotels, budget=None, number_of_hotels=1) -> list[Hotel]:
+    """
+    Chooses hotels closest to the budget from the list of hotels sorted by price
+
+    :param hotels: list of hotels of json type sorted by price
+    :param budget: float, optional, Maximum price for the hotel.
+    :param number_of_hotels: number of different hotels to return
+    :return: list of 'Hotel' class
+    """
     # check if we filtered at least one hotel
     if len(hotels) == 0:
         return [Hotel(hotel=None)]
+    return conver_to_Hotel_class(select_budget_window(hotels, 'priceFrom', budget, number_of_hotels))
 
-    # Sort the fetched hotels by the 'priceFrom' field in ascending order
-    hotels = sorted(hotels, key=lambda x: x['priceFrom'])
 
-    # If a budget is specified, filter hotels to include only those with 'priceFrom' less than the budget
-    if budget and (not budget == "None"):
-        # Initialize the last index of the ticket list to include
-        last_index = 0
-        # Iterate through the tickets to find those within budget
-        for i, hotel in enumerate(hotels):
-            if hotel['priceFrom'] < budget:
-                last_index = i
-            else:
-                break
-        # Slice the tickets list to only include tickets within budget
-        if len(hotels) <= number_of_hotels:
-            return conver_to_Hotel_class(hotels)
-        else:
-            min_index = max(0, last_index - (number_of_hotels // 2))
-            max_index = min(len(hotels), last_index + (number_of_hotels // 2) + (number_of_hotels % 2))
-            if max_index - min_index < number_of_hotels:
-                if min_index == 0:
-                    return conver_to_Hotel_class(hotels[:number_of_hotels])
-                else:
-                    return conver_to_Hotel_class(hotels[max_index - number_of_hotels:max_index])
-            return conver_to_Hotel_class(hotels[min_index:max_index])
-    else:
-        return conver_to_Hotel_class(hotels[:number_of_hotels] if len(hotels) > number_of_hotels else hotels)
+def fetch_hotel_candidates(location, check_in, check_out, min_stars=0, amenities=(), max_distance=None,
+                           poi=None) -> list[dict]:
+    """
+    Fetches all hotels in the location which satisfy the filters. Hotels are sorted by price.
+
+    :param location: str, Name of the location (can use IATA code).
+    :param check_in: str, Check-in date (format YYYY-MM-DD).
+    :param check_out: str, Check-out date (format YYYY-MM-DD).
+    :param min_stars: min number of stars for hotel required
+    :param amenities: amenities which are required, names or ids of facilities of the hotel list
+    :param max_distance: max distance from the hotel to the city center or to the 'poi' in kilometers
+    :param poi: id or name of the place of interest of the hotel list
+    :return: list of hotels of json type
+    """
+    hotels = fetch_hotel_prices(location=location, check_in=check_in, check_out=check_out)
+    # check if we fetched at least one hotel
+    if len(hotels) == 0:
+        return []
+
+    # get all hotel ids satisfied our filter
+    filtered_hotels = find_filtered_hotels(locationId=hotels[0]['locationId'], min_stars=min_stars,
+                                           amenities=amenities, max_distance=max_distance, poi=poi)
+    return filter_hotels(hotels, filtered_hotels)
+
+
+def collection_types(min_stars=0) -> list[CollectionType]:
+    """
+    Chooses hotel collections which contain the cheapest hotels with at least 'min_stars' stars
+
+    :param min_stars: min number of stars for hotel required
+    :return: list of 'CollectionType', empty if no collection fits
+    """
+    if min_stars >= 3:
+        return [CollectionType.THREE_STARS, CollectionType.FOUR_STARS, CollectionType.FIVE_STARS][min_stars - 3:]
+    return [CollectionType.CHEAP]
+
+
+def search_location(location):
+    """
+    Finds the city of the location and remembers its location id. Known locations are found
+    in the local location index without requests.
+
+    :param location: str, Name of the location (can use IATA code).
+    :return: location of json type in the format of 'search_hotel_or_location', None if nothing is found
+    """
+    city = location_index.find(location)
+    if city is None or not city['cityName']:
+        response = HotelApi().search_hotel_or_location(query=location, look_for=LookFor.CITY, limit=1)
+        locations = response['results']['locations']
+        if len(locations) == 0:
+            return None
+        city = locations[0]
+        location_index.add_locations(locations, query=location)
+    location_ids[location] = int(city['id'])
+    return city
+
+
+def known_location_id(location):
+    """
+    :param location: str, Name of the location (can use IATA code).
+    :return: location id of already searched location, None if the location is unknown
+    """
+    location_id = location_ids.get(location)
+    if location_id is None:
+        city = location_index.find(location)
+        if city is not None:
+            location_id = location_ids[location] = int(city['id'])
+    return location_id
+
+
+def fetch_collection_candidates(location, check_in, check_out, budget=None, min_stars=0,
+                                number_of_hotels=1, amenities=(), max_distance=None, poi=None) -> list[dict]:
+    """
+    Fetches hotels from precomputed hotel collections of the location instead of the full price list.
+    Collections contain only the cheapest hotels, so they are used only if the budget window
+    lies inside them. Collections are tried only for locations of the local location index, and
+    a location which collections have no prices of the searched dates is skipped for 'COLLECTION_MISS_TTL'.
+
+    :param location: str, Name of the location (can use IATA code).
+    :param check_in: str, Check-in date (format YYYY-MM-DD).
+    :param check_out: str, Check-out date (format YYYY-MM-DD).
+    :param budget: float, optional, Maximum price for the hotel.
+    :param min_stars: min number of stars for hotel required
+    :param number_of_hotels: number of different hotels to return
+    :param amenities: amenities which are required, names or ids of facilities of the hotel list
+    :param max_distance: max distance from the hotel to the city center or to the 'poi' in kilometers
+    :param poi: id or name of the place of interest of the hotel list
+    :return: list of hotels of json type sorted by price, None if collections can not satisfy the request
+    """
+    types = collection_types(min_stars)
+    if len(types) == 0 or not check_in or not check_out:
+        return None
+    # only locations of the local index are tried, an unknown location would cost a search request
+    city = location_index.find(location)
+    if city is None or not city['cityName']:
+        return None
+    location_id = location_ids[location] = int(city['id'])
+    with _collection_misses_lock:
+        if (location_id, tuple(types)) in _collection_misses:
+            return None
+    hotel_api = HotelApi()
+    allowed_hotels = set(find_filtered_hotels(locationId=location_id, min_stars=min_stars, amenities=amenities,
+                                              max_distance=max_distance, poi=poi))
+    hotels = {}
+    has_dates = False
+    for collection_type in types:
+        collections = hotel_api.fetch_hotel_collections(check_in=check_in, check_out=check_out,
+                                                        city_id=location_id, limit=COLLECTION_LIMIT,
+                                                        collection_type=collection_type)
+        for hotel in collections.get(collection_type.value) or []:
+            price_info = hotel.get('last_price_info') or {}
+            search_params = price_info.get('search_params') or {}
+            # collections keep prices found by other searches, only prices of the same dates are used
+            if search_params.get('checkIn') != check_in or search_params.get('checkOut') != check_out:
+                continue
+            has_dates = True
+            if hotel['hotel_id'] not in allowed_hotels or price_info.get('price') is None:
+                continue
+            hotels[hotel['hotel_id']] = {'locationId': location_id,
+                                         'hotelId': hotel['hotel_id'],
+                                         'priceFrom': price_info['price'],
+                                         'priceAvg': price_info['price'],
+                                         'stars': hotel['stars'],
+                                         'hotelName': hotel['name'],
+                                         'location': {'name': city['cityName'], 'country': city['countryName']}}
+    if not has_dates:
+        # collections of the location are not updated by searches of these dates, the next searches
+        # of the location go to the full price list at once
+        with _collection_misses_lock:
+            _collection_misses[(location_id, tuple(types))] = True
+        return None
+    hotels = sorted(hotels.values(), key=lambda x: x['priceFrom'])
+    if len(hotels) < number_of_hotels:
+        return None
+    if budget and (not budget == "None") and sum(hotel['priceFrom'] >= budget for hotel in hotels) < number_of_hotels:
+        # all hotels fit the budget, more expensive hotels closer to the budget may be only in the full list
+        return None
+    return hotels
+
+
+def stream_hotel_window(location, check_in, check_out, budget=None, min_stars=0, number_of_hotels=1,
+                        amenities=(), max_distance=None, poi=None) -> list[dict]:
+    """
+    Streaming version of 'fetch_hotel_candidates' for a single budget window. Hotel prices are parsed
+    while they are downloaded, hotels which are not allowed are dropped at once and only hotels which
+    can get into the budget window are kept, so memory does not depend on the size of the location.
+
+    :param location: str, Name of the location (can use IATA code).
+    :param check_in: str, Check-in date (format YYYY-MM-DD).
+    :param check_out: str, Check-out date (format YYYY-MM-DD).
+    :param budget: float, optional, Maximum price for the hotel.
+    :param min_stars: min number of stars for hotel required
+    :param number_of_hotels: number of different hotels to return
+    :param amenities: amenities which are required, names or ids of facilities of the hotel list
+    :param max_distance: max distance from the hotel to the city center or to the 'poi' in kilometers
+    :param poi: id or name of the place of interest of the hotel list
+    :return: list of hotels of json type sorted by price, 'select_hotels' chooses the same hotels
+        from it as from the full list of candidates
+    """
+    window = BudgetWindowHeap(budget=budget, number_of_items=number_of_hotels)
+    filtered_hotels = None
+    for hotel in HotelApi().iterate_hotel_prices(location=location, check_in=check_in, check_out=check_out,
+                                                 limit=10000, slim=True):
+        if filtered_hotels is None:
+            # allowed hotels are known as soon as the location of the first hotel arrives
+            location_ids[location] = hotel['locationId']
+            filtered_hotels = set(find_filtered_hotels(locationId=hotel['locationId'], min_stars=min_stars,
+                                                       amenities=amenities, max_distance=max_distance, poi=poi))
+        if hotel['hotelId'] in filtered_hotels:
+            window.add(hotel['priceFrom'], hotel)
+    return window.items()
+
+
+def get_hotel(location, check_in, check_out, budget=None, min_stars=0, number_of_hotels=1,
+              streaming=False, amenities=(), max_distance=None, poi=None) -> list[Hotel]:
+    """
+    Fetches the hotel based on the specified parameters. Hotel collections of the location are tried first,
+    the full price list is fetched only if collections can not satisfy the request.
+
+    Parameters:
+    :param location: str, Name of the location (can use IATA code).
+    :param check_in: str, Check-in date (format YYYY-MM-DD).
+    :param check_out: str, Check-out date (format YYYY-MM-DD).
+    :param budget: float, optional, Maximum price for the hotel.
+    :param min_stars: min number of stars for hotel required
+    :param number_of_hotels: number of different hotels to return
+    :param streaming: True if hotels of the location are chosen only once, then the price list is parsed
+        while it is downloaded instead of being fetched and cached as a whole
+    :param amenities: amenities which are required, names of 'shortFacilities' (e.g. 'pool', 'pets')
+        or ids of 'facilities' of the hotel list, by default empty tuple - no amenities are required
+    :param max_distance: max distance from the hotel to the city center or to the 'poi' in kilometers,
+        by default the distance is not limited
+    :param poi: id or name of the place of interest of the hotel list (e.g. 'Kremlin'), by default
+        the distance is measured to the city center
+
+    :return: list of 'Hotel' class
+    """
+    try:
+        hotels = fetch_collection_candidates(location=location, check_in=check_in, check_out=check_out,
+                                             budget=budget, min_stars=min_stars, number_of_hotels=number_of_hotels,
+                                             amenities=amenities, max_distance=max_distance, poi=poi)
+    except UpstreamError:
+        # collections are only a shortcut, the full price list is used if they are not available
+        hotels = None
+    if hotels is None and streaming:
+        hotels = stream_hotel_window(location=location, check_in=check_in, check_out=check_out, budget=budget,
+                                     min_stars=min_stars, number_of_hotels=number_of_hotels, amenities=amenities,
+                                     max_distance=max_distance, poi=poi)
+    elif hotels is None:
+        hotels = fetch_hotel_candidates(location=location, check_in=check_in, check_out=check_out,
+                                        min_stars=min_stars, amenities=amenities, max_distance=max_distance,
+                                        poi=poi)
+    return select_hotels(hotels, budget=budget, number_of_hotels=number_of_hotels)
 
 
 def find_top_routes(origin, destination, departure_at=None, return_at=None, budget=None, route_number=3, min_stars=0,
-                    max_transfers=0, airlines=(), max_flight_duration=None) -> \
-        list[Route]:
+                    max_transfers=0, airlines=(), max_flight_duration=None, deadline=None, amenities=(),
+                    max_distance=None, poi=None) -> list[Route]:
     """
     Find the top routes based on the cheapest tickets and hotels.
 
@@ -455,14 +945,119 @@ def find_top_routes(origin, destination, departure_at=None, return_at=None, budg
     :param max_transfers: max number of transfers during a flight, 0 by default
     :param airlines: list of airlines which are required for a flight, by default empty tuple - all airlines are allowed
     :param max_flight_duration: max duration of a flight in hours, None by default
+    :param deadline: float, optional, max time of the search in seconds, None means no limit. Requests which
+        have not finished by then are abandoned and the routes are built from the data which has arrived,
+        such routes are marked as partial
+    :param amenities: amenities which are required, names of 'shortFacilities' (e.g. 'pool', 'pets')
+        or ids of 'facilities' of the hotel list, by default empty tuple - no amenities are required
+    :param max_distance: max distance from the hotel to the city center or to the 'poi' in kilometers,
+        by default the distance is not limited
+    :param poi: id or name of the place of interest of the hotel list (e.g. 'Kremlin'), by default
+        the distance is measured to the city center
 
+    :return: list of 'Route' class
+    """
+    # repeated searches are served from the shared cache
+    key = route_cache.make_key(origin=origin, destination=destination, departure_at=departure_at,
+                               return_at=return_at, budget=budget, route_number=route_number, min_stars=min_stars,
+                               max_transfers=max_transfers, airlines=airlines,
+                               max_flight_duration=max_flight_duration, amenities=amenities,
+                               max_distance=max_distance, poi=poi)
+    cached_routes = route_cache.get(key, budget)
+    if cached_routes is not None:
+        return cached_routes
+
+    deadline_at = None if deadline is None else time.monotonic() + deadline
+    partial = False
+    # requests are made by the pool, so the search stops waiting for them at the deadline
+    executor = ThreadPoolExecutor(max_workers=2)
+
+    def wait_for(default, function, **kwargs):
+        nonlocal partial
+        if partial or time_left(deadline_at) == 0:
+            # the deadline is reached, nothing is requested anymore
+            partial = True
+            return default
+        future = executor.submit(function, **kwargs)
+        try:
+            return future.result(timeout=time_left(deadline_at))
+        except FutureTimeoutError:
+            # the request finishes in the background, its result is not needed anymore
+            partial = True
+            return default
+
+    # after the deadline the last found tickets and hotels are reused, so routes are not filled with empty ones
+    last_found = {'tickets': [Ticket(ticket=None)], 'hotels': [Hotel(hotel=None)]}
+
+    def choose_tickets(ticket_budget=None, number_of_tickets=1):
+        last_found['tickets'] = wait_for(last_found['tickets'], get_ticket, origin=origin, destination=destination,
+                                         departure_at=departure_at, return_at=return_at, budget=ticket_budget,
+                                         number_of_tickets=number_of_tickets, max_transfers=max_transfers,
+                                         airlines=airlines, max_flight_duration=max_flight_duration)
+        return list(last_found['tickets'])
+
+    def choose_hotels(hotel_budget=None, number_of_hotels=1):
+        last_found['hotels'] = wait_for(last_found['hotels'], get_hotel, location=destination,
+                                        check_in=departure_at, check_out=return_at, budget=hotel_budget,
+                                        min_stars=min_stars, number_of_hotels=number_of_hotels,
+                                        amenities=amenities, max_distance=max_distance, poi=poi)
+        return list(last_found['hotels'])
+
+    try:
+        # nearby airports are searched at the same time as the main search, not after it
+        alternatives_future = executor.submit(fetch_alternative_tickets, origin=origin, destination=destination,
+                                              departure_at=departure_at, return_at=return_at,
+                                              max_transfers=max_transfers, airlines=airlines,
+                                              max_flight_duration=max_flight_duration)
+        unique_routes = combine_routes(origin=origin, destination=destination, departure_at=departure_at,
+                                       return_at=return_at, budget=budget, route_number=route_number,
+                                       choose_tickets=choose_tickets, choose_hotels=choose_hotels)
+        try:
+            alternative_tickets = alternatives_future.result(timeout=time_left(deadline_at))
+        except FutureTimeoutError:
+            partial = True
+            alternative_tickets = []
+        except Exception:
+            # alternatives are optional, the main result is returned without them
+            alternative_tickets = []
+        unique_routes = add_alternative_routes(unique_routes, alternative_tickets, budget=budget,
+                                               route_number=route_number)
+
+        # collect hotel_photos, routes are returned without photos which have not arrived before the deadline
+        wait_for(None, save_hotel_photo_urls, routes=unique_routes)
+    finally:
+        # abandoned requests are not waited for, they end by the request timeout
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return route_cache.put(key, unique_routes, budget, partial=partial)
+
+
+def time_left(deadline_at):
+    """
+    :param deadline_at: value of 'time.monotonic()' at the deadline, None means no deadline
+    :return: seconds left before the deadline, 0 if it is reached, None if there is no deadline
+    """
+    return None if deadline_at is None else max(deadline_at - time.monotonic(), 0)
+
+
+def combine_routes(origin, destination, departure_at, return_at, budget, route_number, choose_tickets,
+                   choose_hotels) -> list[Route]:
+    """
+    Combines tickets and hotels into the top routes.
+
+    :param origin: str, IATA code of the departure point.
+    :param destination: str, IATA code of the destination point.
+    :param departure_at: str, optional, departure date (format YYYY-MM-DD).
+    :param return_at: str, optional, return date (format YYYY-MM-DD).
+    :param budget: float, optional, maximum combined price for the ticket and hotel.
+    :param route_number: int, number of top routes to find.
+    :param choose_tickets: function (budget, number) which returns list of 'Ticket' class closest to the budget
+    :param choose_hotels: function (budget, number) which returns list of 'Hotel' class closest to the budget
     :return: list of 'Route' class
     """
     # Get the cheapest ticket and hotel
-    cheapest_ticket = get_ticket(origin=origin, destination=destination, departure_at=departure_at,
-                                 return_at=return_at, max_transfers=max_transfers, airlines=airlines,
-                                 max_flight_duration=max_flight_duration)[0]
-    cheapest_hotel = get_hotel(location=destination, check_in=departure_at, check_out=return_at, min_stars=min_stars)[0]
+    cheapest_ticket = choose_tickets()[0]
+    cheapest_hotel = choose_hotels()[0]
 
     # Create a return array with the initial cheapest route
     top_routes = [{
@@ -492,16 +1087,12 @@ def find_top_routes(origin, destination, departure_at=None, return_at=None, budg
             coef = min_ticket_price / (min_ticket_price + min_hotel_price)
             ticket_price = max(coef * budget * 0.9, min_ticket_price)
             # get ticket list
-            tickets = get_ticket(origin=origin, destination=destination, departure_at=departure_at,
-                                 return_at=return_at, budget=ticket_price, number_of_tickets=route_number,
-                                 max_transfers=max_transfers, airlines=airlines,
-                                 max_flight_duration=max_flight_duration)
+            tickets = choose_tickets(ticket_price, route_number)
 
             # define budget for a hotel
             hotel_price = budget - tickets[len(tickets) // 2].ticket_price
             # get hotel list
-            hotels = get_hotel(location=destination, check_in=departure_at, check_out=return_at,
-                               budget=hotel_price, min_stars=min_stars, number_of_hotels=route_number)
+            hotels = choose_hotels(hotel_price, route_number)
             # check sizing
             if len(hotels) != len(tickets):
                 # make size of arrays equal
@@ -522,13 +1113,9 @@ def find_top_routes(origin, destination, departure_at=None, return_at=None, budg
         # Budget is not specified, finding arbitrary routes
         for _ in range(1, route_number):
             min_ticket_price *= 2
-            ticket = get_ticket(origin=origin, destination=destination, departure_at=departure_at,
-                                return_at=return_at, budget=min_ticket_price, max_transfers=max_transfers,
-                                airlines=airlines,
-                                max_flight_duration=max_flight_duration)[0]
+            ticket = choose_tickets(min_ticket_price)[0]
             min_hotel_price *= 3
-            hotel = get_hotel(location=destination, check_in=departure_at, check_out=return_at,
-                              budget=min_hotel_price, min_stars=min_stars)[0]
+            hotel = choose_hotels(min_hotel_price)[0]
             top_routes.append({
                 'ticket': ticket,
                 'hotel': hotel
@@ -538,46 +1125,64 @@ def find_top_routes(origin, destination, departure_at=None, return_at=None, budg
     unique_routes = []
     for i in range(len(top_routes)):
         if i == 0 or (
-                top_routes[i]['ticket'].ticket != top_routes[i - 1]['ticket'].ticket or top_routes[i]['hotel'].hotel !=
-                top_routes[i - 1]['hotel'].hotel):
+                top_routes[i]['ticket'].key != top_routes[i - 1]['ticket'].key or top_routes[i]['hotel'].key !=
+                top_routes[i - 1]['hotel'].key):
             unique_routes.append(
                 Route(origin=origin, destination=destination, departure_at=departure_at, return_at=return_at,
                       budget=budget, ticket=top_routes[i]['ticket'], hotel=top_routes[i]['hotel']))
 
-    # collect hotel_photos
-    save_hotel_photo_urls(unique_routes)
-
     return unique_routes
 
 
-def find_filtered_hotels(locationId, filter=(1, 2, 3, 12), min_stars=0):
+def find_filtered_hotels(locationId, filter=ROUTE_HOTEL_TYPES, min_stars=0, amenities=(), max_distance=None,
+                         poi=None):
     """
     This function filters hotels based on their type
     :param locationId: location of hotels
-    :param filter: hotels types which will be chosen. More information about filters is saved in
-        data/hotels/hotels_type.json directory or can be obtained by 'fetch_hotel_types' method in HotelApi class
+    :param filter: ids or names (e.g. 'Hotel') of hotels types which will be chosen. Types are resolved by
+        'hotel_types' catalog, unknown names are ignored
     :param min_stars: min number of stars for hotel required
-    :return: list of all suitable hotels ids
+    :param amenities: amenities which are required, names of 'shortFacilities' (e.g. 'pool', 'pets')
+        or ids of 'facilities' of the hotel list, by default empty tuple - no amenities are required
+    :param max_distance: max distance from the hotel to the city center or to the 'poi' in kilometers,
+        by default the distance is not limited
+    :param poi: id or name of the place of interest of the hotel list (e.g. 'Kremlin'), by default
+        the distance is measured to the city center
+    :return: list of all suitable hotels ids, nearest hotels first if 'max_distance' or 'poi' is given
+    """
+    property_types = hotel_types.resolve(filter)
+    if len(property_types) == 0:
+        return []
+    return load_hotel_index(locationId).filter(property_types=property_types, min_stars=min_stars,
+                                               amenities=amenities, max_distance=max_distance, poi=poi)
+
+
+def load_hotel_index(locationId) -> HotelIndex:
+    """
+    This function returns the index of the hotel list of the location. The list is fetched again when
+    it is older than HOTEL_LIST_MAX_AGE, built indexes are kept in memory until the saved list changes
+    :param locationId: location of hotels
+    :return: 'HotelIndex' of the hotel list
     """
     hotel_api = HotelApi()
-    # check if we have already saved information about hotels in given location
+    # check if we have already saved fresh information about hotels in given location
     file_path = data_directory_path() + hotel_api.hotels_list_dir + f'/{locationId}.json'
-    if not os.path.exists(file_path):
+    if hotel_list_age(locationId) > HOTEL_LIST_MAX_AGE:
         data = hotel_api.fetch_hotel_list(locationId=locationId)
-    else:
-        with open(file_path) as f:
-            data = json.load(f)
-
-    # list of chosen hotels
-    filtered_hotels = []
-    # iterate through all hotels and choose one which satisfy the condition
-    for hotel in data['hotels']:
-        if hotel['propertyType'] in filter:
-            if hotel['stars'] >= min_stars:
-                filtered_hotels.append(hotel['id'])
-
-    # return list of chosen hotels
-    return filtered_hotels
+        location_index.add_hotel_list(locationId, data['hotels'])
+        return HotelIndex(data['hotels'], data['pois'])
+
+    modified_at = os.path.getmtime(file_path)
+    with _hotel_indexes_lock:
+        cached = _hotel_indexes.get(locationId)
+    if cached is not None and cached[0] == modified_at:
+        return cached[1]
+    with open(file_path, 'rb') as f:
+        data = decode_hotel_list(f.read())
+    index = HotelIndex(data['hotels'], data['pois'])
+    with _hotel_indexes_lock:
+        _hotel_indexes[locationId] = (modified_at, index)
+    return index
 
 
 def conver_to_Ticket_class(tickets) -> list[Ticket]:
@@ -598,21 +1203,72 @@ def conver_to_Hotel_class(hotels) -> list[Hotel]:
     return [Hotel(hotel) for hotel in hotels]
 
 
+def hotel_list_age(locationId) -> float:
+    """
+    This function returns age of the saved hotel list of the location
+    :param locationId: location of hotels
+    :return: age in seconds, infinity if the list has not been saved
+    """
+    file_path = data_directory_path() + HotelApi().hotels_list_dir + f'/{locationId}.json'
+    if not os.path.exists(file_path):
+        return float('inf')
+    return time.time() - os.path.getmtime(file_path)
+
+
+def fetch_hotel_photo_ids(hotel_ids, refresh=False) -> dict:
+    """
+    This function fetches photo ids of hotels, only hotels which photo ids are neither cached in memory
+    nor saved in the photo id store are requested
+    :param hotel_ids: list of hotel ids
+    :param refresh: True if photo ids of all hotels are requested again
+    :return: dictionary hotel id (str) -> list of photo ids
+    """
+    photo_ids = {}
+    with _photo_ids_lock:
+        for hotel_id in hotel_ids:
+            if not refresh and str(hotel_id) in _photo_ids_cache:
+                photo_ids[str(hotel_id)] = _photo_ids_cache[str(hotel_id)]
+    missing_ids = [hotel_id for hotel_id in hotel_ids if str(hotel_id) not in photo_ids]
+    if len(missing_ids) > 0 and not refresh:
+        saved_ids = photo_id_store.get(missing_ids)
+        with _photo_ids_lock:
+            _photo_ids_cache.update(saved_ids)
+        photo_ids.update(saved_ids)
+        missing_ids = [hotel_id for hotel_id in missing_ids if str(hotel_id) not in saved_ids]
+    if len(missing_ids) == 0:
+        return photo_ids
+    hotel_api = HotelApi()
+    fetched_ids = hotel_api.fetch_hotel_photos(hotel_ids=missing_ids, return_only_urls=True)
+    photo_id_store.add(fetched_ids)
+    with _photo_ids_lock:
+        _photo_ids_cache.update(fetched_ids)
+    return {**photo_ids, **fetched_ids}
+
+
+def attach_hotel_photo_urls(routes: list[Route], photo_ids):
+    """
+    This function fills photo ids of hotels from route, photo urls are built from them when they are needed
+    :param routes: list of routes
+    :param photo_ids: dictionary hotel id (str) -> list of photo ids
+    :return:
+    """
+    for route in routes:
+        if not route.hotel.found or route.hotel.photo_ids:
+            continue
+        route.hotel.photo_ids = list(photo_ids.get(str(route.hotel.hotel_id), []))
+
+
 def save_hotel_photo_urls(routes: list[Route]):
     """
     This function saves photos from hotels from route
     :param routes: list of routes
     :return:
     """
-    # collect photo ids
-    hotel_ids = [route.hotel.hotel_id for route in routes if route.hotel.hotel is not None]
+    # collect photo ids of hotels which have no photos yet
+    hotel_ids = [route.hotel.hotel_id for route in routes
+                 if route.hotel.found and not route.hotel.photo_ids]
     if len(hotel_ids) == 0:
         return
 
-    # get photos url
-    hotel_api = HotelApi()
     # save photos urls
-    urls_list = hotel_api.fetch_hotel_photos(hotel_ids=hotel_ids, return_only_urls=True)
-    for route in routes:
-        for photo_id in urls_list[str(route.hotel.hotel_id)]:
-            route.hotel.photo_urls.append(f'https://photo.hotellook.com/image_v2/limit/{photo_id}/800/520.auto')
+    attach_hotel_photo_urls(routes, fetch_hotel_photo_ids(hotel_ids))
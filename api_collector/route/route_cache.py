@@ -0,0 +1,161 @@
+import copy
+import math
+import threading
+from collections import namedtuple
+from datetime import datetime
+from cachetools import TLRUCache
+
+# budgets which differ by less than 5% share cached routes
+BUDGET_BUCKET_STEP = 1.05
+# prices of near departures change quickly, far ones are refreshed by upstream rarely
+NEAR_DEPARTURE_DAYS = 3
+MONTH_DEPARTURE_DAYS = 30
+NEAR_DEPARTURE_TTL = 5 * 60
+MONTH_DEPARTURE_TTL = 30 * 60
+FAR_DEPARTURE_TTL = 2 * 60 * 60
+
+SearchKey = namedtuple('SearchKey', ['origin', 'destination', 'departure_at', 'return_at', 'budget', 'route_number',
+                                     'min_stars', 'max_transfers', 'airlines', 'max_flight_duration', 'amenities',
+                                     'max_distance', 'poi'])
+
+
+def normalize_budget(budget):
+    """
+    Rounds the budget down to the lower bound of its bucket, searches with budgets of the
+    same bucket share cached routes
+
+    :param budget: float, optional, budget of the search
+    :return: int, lower bound of the budget bucket, 0 for budgets below 1 (negative ones too),
+        None if the budget is not specified
+    """
+    if not budget or budget == "None":
+        return None
+    if budget < 1:
+        # no route is that cheap, such budgets give the same routes and have no logarithm bucket
+        return 0
+    bound = math.floor(BUDGET_BUCKET_STEP ** math.floor(math.log(budget, BUDGET_BUCKET_STEP)))
+    return min(bound, budget)
+
+
+def exceeds_budget(route, budget):
+    """
+    Checks if the cached route fits the budget it has been found for, but not the given budget.
+    Routes which exceed both budgets are not rejected, the search returns the cheapest route
+    when nothing fits the budget
+
+    :param route: cached 'Route' class, its budget is the budget of the search which found it
+    :param budget: float, optional, budget of the search served from the cache
+    :return: True if the route must not be returned for the budget
+    """
+    if not budget or budget == "None" or not route.budget or route.budget == "None":
+        return False
+    return budget < route.calculate_total_cost() <= route.budget
+
+
+def price_freshness(key, routes, now):
+    """
+    Returns the expiration time of cached routes, routes with near departure expire sooner
+
+    :param key: 'SearchKey' of the search
+    :param routes: cached routes
+    :param now: current time of the cache timer
+    :return: expiration time
+    """
+    try:
+        days = (datetime.strptime(key.departure_at[:10], "%Y-%m-%d") - datetime.now()).days
+    except (TypeError, ValueError):
+        # departure month or no date at all
+        days = MONTH_DEPARTURE_DAYS
+    if days <= NEAR_DEPARTURE_DAYS:
+        return now + NEAR_DEPARTURE_TTL
+    if days <= MONTH_DEPARTURE_DAYS:
+        return now + MONTH_DEPARTURE_TTL
+    return now + FAR_DEPARTURE_TTL
+
+
+class RouteCache:
+    """
+    Cache of fully built routes keyed by the normalized search. Size of the cache is bounded by
+    number of searches and every entry expires according to freshness of its prices.
+    """
+
+    def __init__(self, maxsize=1024, ttu=price_freshness):
+        """
+        :param maxsize: max number of cached searches
+        :param ttu: function (key, routes, now) which returns the expiration time of routes
+        """
+        self.cache = TLRUCache(maxsize=maxsize, ttu=ttu)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(origin, destination, departure_at=None, return_at=None, budget=None, route_number=3, min_stars=0,
+                 max_transfers=0, airlines=(), max_flight_duration=None, amenities=(), max_distance=None,
+                 poi=None) -> SearchKey:
+        """
+        Builds the normalized key of the search, parameters are the same as in 'find_top_routes'
+
+        :return: 'SearchKey'
+        """
+        return SearchKey(origin=origin, destination=destination, departure_at=departure_at, return_at=return_at,
+                         budget=normalize_budget(budget), route_number=route_number, min_stars=min_stars,
+                         max_transfers=max_transfers, airlines=tuple(sorted(airlines)),
+                         max_flight_duration=max_flight_duration, amenities=tuple(sorted(amenities, key=str)),
+                         max_distance=max_distance, poi=poi)
+
+    def get(self, key, budget=None):
+        """
+        Returns cached routes of the search
+
+        :param key: 'SearchKey' of the search
+        :param budget: original budget of the search, it is set to returned routes
+        :return: list of 'Route' class, None if routes are not cached or none of them fits the budget
+        """
+        with self.lock:
+            routes = self.cache.get(key)
+            if routes is not None:
+                # routes are shared by close budgets, routes found for a larger budget may not fit this one
+                routes = [route for route in routes if not exceeds_budget(route, budget)]
+            if not routes:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return self._copy_routes(routes, budget)
+
+    def put(self, key, routes, budget=None, partial=False):
+        """
+        Saves routes of the search. Routes where ticket or hotel has not been found are not saved,
+        they are usually caused by temporary upstream errors. Partial routes are not saved either.
+
+        :param key: 'SearchKey' of the search
+        :param routes: list of 'Route' class
+        :param budget: original budget of the search, it is set to returned routes
+        :param partial: True if the search stopped at the deadline before all data arrived
+        :return: copies of routes with the original budget
+        """
+        if not partial and routes and all(route.ticket.found and route.hotel.found for route in routes):
+            with self.lock:
+                self.cache[key] = routes
+        return self._copy_routes(routes, budget, partial)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @staticmethod
+    def _copy_routes(routes, budget, partial=False):
+        # tickets and hotels are shared, only the route itself is copied to keep the caller's budget
+        copies = []
+        for route in routes:
+            route_copy = copy.copy(route)
+            route_copy.budget = budget
+            route_copy.partial = partial
+            copies.append(route_copy)
+        return copies
+
+
+# cache shared by all searches
+route_cache = RouteCache()
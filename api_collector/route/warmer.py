@@ -0,0 +1,155 @@
+import asyncio
+import threading
+import time
+from collections import Counter
+from api_collector.air_tickets.air_tickets_api import AirTicketsApi
+from api_collector.air_tickets.price_calendar import price_calendar
+from api_collector.hotels.hotel_api import HotelApi
+from api_collector.route.route import HOTEL_LIST_MAX_AGE, fetch_hotel_photo_ids, hotel_list_age
+
+# warming runs more often than ticket responses expire, so popular responses never expire
+WARM_INTERVAL = 8 * 60
+# max number of upstream requests made by one warming round
+WARM_CALL_BUDGET = 30
+# hotel lists are loaded again when they are close to the expiration
+HOTEL_LIST_REFRESH_AGE = HOTEL_LIST_MAX_AGE - 24 * 60 * 60
+# max number of tracked searches and locations, the least requested are forgotten
+MAX_TRACKED = 1000
+# number of recently chosen hotels of a location which photo ids are refreshed
+HOTELS_PER_LOCATION = 10
+# counters are multiplied by it after every round, so recent searches are preferred
+WARM_DECAY = 0.9
+# searches and locations with a lower counter are forgotten, a single search stays warm for about 3 hours
+MIN_WARM_COUNT = 0.1
+# old prices of the price calendar are compacted once a day
+CALENDAR_COMPACT_INTERVAL = 24 * 60 * 60
+
+
+class CacheWarmer:
+    """
+    Refreshes upstream data of the most requested searches before it expires. Completed searches
+    are tracked by (origin, destination, month) and by locations of chosen hotels. Every round
+    refreshes month price calendars, hotel lists and hotel photo ids in the order of popularity
+    until the budget of upstream requests is spent. Counters decay slowly after every round,
+    so recent searches are preferred, but popular ones are kept warm between their requests.
+    Old prices of the price calendar are compacted by a round once a day.
+    """
+
+    def __init__(self):
+        self.searches = Counter()
+        self.locations = Counter()
+        # location id -> ids of hotels recently chosen in the location
+        self.hotel_ids = {}
+        # value of 'time.monotonic()' at the last compaction of the price calendar
+        self.compacted_at = None
+        self.lock = threading.Lock()
+
+    def record_routes(self, routes):
+        """
+        Tracks the completed search
+
+        :param routes: list of 'Route' class found by the search
+        """
+        if len(routes) == 0 or not routes[0].departure_at:
+            return
+        route = routes[0]
+        with self.lock:
+            self.searches[(route.origin, route.destination, route.departure_at[:7])] += 1
+            hotels = [found.hotel for found in routes if found.hotel and found.hotel.found]
+            if hotels:
+                location_id = hotels[0].hotel_location_id
+                self.locations[location_id] += 1
+                hotel_ids = self.hotel_ids.setdefault(location_id, [])
+                for hotel in hotels:
+                    if hotel.hotel_id in hotel_ids:
+                        hotel_ids.remove(hotel.hotel_id)
+                    hotel_ids.insert(0, hotel.hotel_id)
+                del hotel_ids[HOTELS_PER_LOCATION:]
+            self._trim()
+
+    def plan(self) -> list[tuple]:
+        """
+        :return: list of tasks (kind, arguments) sorted by popularity
+        """
+        with self.lock:
+            tasks = [(count, 'price_calendar', search) for search, count in self.searches.items()]
+            for location_id, count in self.locations.items():
+                tasks.append((count, 'hotel_list', location_id))
+                tasks.append((count, 'photo_ids', tuple(self.hotel_ids.get(location_id, ()))))
+        # tasks of the same popularity keep the order: calendar, hotel list, photos
+        tasks.sort(key=lambda task: -task[0])
+        return [(kind, arguments) for _, kind, arguments in tasks]
+
+    def warm(self, call_budget=WARM_CALL_BUDGET) -> int:
+        """
+        Runs a warming round
+
+        :param call_budget: max number of upstream requests
+        :return: number of made upstream requests
+        """
+        calls = 0
+        for kind, arguments in self.plan():
+            if calls >= call_budget:
+                break
+            try:
+                if kind == 'price_calendar':
+                    origin, destination, month = arguments
+                    AirTicketsApi.fetch_grouped_tickets.refresh(AirTicketsApi(), origin=origin,
+                                                                destination=destination, departure_at=month)
+                    calls += 1
+                elif kind == 'hotel_list':
+                    if hotel_list_age(arguments) > HOTEL_LIST_REFRESH_AGE:
+                        HotelApi().fetch_hotel_list(locationId=arguments)
+                        calls += 1
+                elif arguments:
+                    fetch_hotel_photo_ids(list(arguments), refresh=True)
+                    calls += 1
+            except Exception:
+                # failed refresh is retried in the next round
+                calls += 1
+        self.compact_calendar()
+        with self.lock:
+            for counter in (self.searches, self.locations):
+                for key in list(counter):
+                    counter[key] *= WARM_DECAY
+                    if counter[key] < MIN_WARM_COUNT:
+                        del counter[key]
+            self._trim()
+        return calls
+
+    def compact_calendar(self):
+        """
+        Compacts the price calendar if it has not been compacted for a day
+        """
+        if self.compacted_at is not None and time.monotonic() - self.compacted_at < CALENDAR_COMPACT_INTERVAL:
+            return
+        try:
+            price_calendar.compact()
+        except Exception:
+            # failed compaction is retried in the next round
+            return
+        self.compacted_at = time.monotonic()
+
+    async def run(self, interval=WARM_INTERVAL, call_budget=WARM_CALL_BUDGET):
+        """
+        Runs warming rounds in the background until the task is cancelled
+
+        :param interval: time between rounds in seconds
+        :param call_budget: max number of upstream requests of every round
+        """
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.to_thread(self.warm, call_budget)
+
+    def _trim(self):
+        for counter in (self.searches, self.locations):
+            if len(counter) > MAX_TRACKED:
+                for key, _ in counter.most_common()[MAX_TRACKED:]:
+                    del counter[key]
+        for location_id in list(self.hotel_ids):
+            if location_id not in self.locations:
+                del self.hotel_ids[location_id]
+
+
+# warmer shared by all searches
+cache_warmer = CacheWarmer()
@@ -0,0 +1,128 @@
+import json
+import threading
+import time
+import requests
+from api_collector.utils.directories import data_directory_path
+import os
+
+# prices of all upstream responses are cached in this currency
+CANONICAL_CURRENCY = 'rub'
+# rubles per unit of every currency
+FX_RATES_URL = "https://yasen.aviasales.ru/adaptors/currency.json"
+# request of rates which gets no response in this number of seconds fails
+FX_RATES_TIMEOUT = 10
+# the table is loaded again after this number of seconds
+FX_RATES_TTL = 6 * 60 * 60
+# failed refresh is retried after this number of seconds
+FX_RATES_RETRY = 5 * 60
+# older rates are not used, prices are requested in the required currency instead
+FX_RATES_MAX_AGE = 3 * 24 * 60 * 60
+
+
+class FxTable:
+    """
+    Local table of exchange rates to rubles. The table is saved to the data directory and
+    refreshed in the background when it is older than 'ttl', readers keep using the previous rates
+    meanwhile and failed refresh keeps them until the next retry.
+    """
+
+    def __init__(self, path=None, ttl=FX_RATES_TTL):
+        """
+        :param path: path to the json file of the table, by default 'fx_rates.json' in the data directory
+        :param ttl: time to live of the table in seconds
+        """
+        self.path = path
+        self.ttl = ttl
+        # currency -> rubles per unit
+        self.rates = None
+        self.updated_at = 0
+        self.checked_at = 0
+        self.is_loaded = False
+        # thread of the running refresh, None when the table is not being refreshed
+        self.refresh_thread = None
+        self.lock = threading.Lock()
+
+    def rate(self, currency):
+        """
+        Returns the rate of conversion from rubles
+
+        :param currency: str, code of the currency, e.g. 'usd'
+        :return: float, units of the currency per ruble, None if the rate is unknown or too old
+        """
+        if currency == CANONICAL_CURRENCY:
+            return 1.0
+        with self.lock:
+            if not self.is_loaded:
+                # the saved table is read once, later misses do not touch the disk
+                self.is_loaded = True
+                self._load()
+            now = time.time()
+            if now - self.updated_at > self.ttl and now - self.checked_at > FX_RATES_RETRY \
+                    and self.refresh_thread is None:
+                self.checked_at = now
+                self.refresh_thread = threading.Thread(target=self.refresh, daemon=True)
+                self.refresh_thread.start()
+            if self.rates is None or now - self.updated_at > FX_RATES_MAX_AGE:
+                return None
+            rubles = self.rates.get(currency)
+        return 1 / rubles if rubles else None
+
+    def refresh(self):
+        """
+        Fetches rates from upstream and saves them, previous rates are kept if the request fails
+        """
+        try:
+            response = requests.get(FX_RATES_URL, timeout=FX_RATES_TIMEOUT)
+            if response.status_code != 200:
+                raise Exception(f"Failed to fetch exchange rates. Status code: {response.status_code}")
+            self.set_rates(response.json())
+            with open(self._path(), 'w') as file:
+                json.dump({'updated_at': self.updated_at, 'rates': self.rates}, file)
+        except Exception:
+            # previous rates are used until the next retry
+            pass
+        finally:
+            with self.lock:
+                self.refresh_thread = None
+
+    def set_rates(self, rates, updated_at=None):
+        """
+        :param rates: dictionary currency -> rubles per unit
+        :param updated_at: time of the rates, now by default
+        """
+        rates = dict(rates)
+        updated_at = time.time() if updated_at is None else updated_at
+        with self.lock:
+            self.rates = rates
+            self.updated_at = updated_at
+            self.is_loaded = True
+
+    def _load(self):
+        # called under the lock
+        if not os.path.exists(self._path()):
+            return
+        with open(self._path()) as file:
+            data = json.load(file)
+        self.rates = dict(data['rates'])
+        self.updated_at = data['updated_at']
+
+    def _path(self):
+        # the data directory is resolved on the first use
+        if self.path is None:
+            self.path = data_directory_path() + '/fx_rates.json'
+        return self.path
+
+
+def convert_price(price, rate):
+    """
+    :param price: price in rubles, may be None
+    :param rate: units of the currency per ruble
+    :return: price in the currency rounded to cents
+    """
+    if price is None:
+        return None
+    return round(price * rate, 2)
+
+
+# exchange rates shared by all API methods
+fx_table = FxTable()
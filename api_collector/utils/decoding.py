@@ -0,0 +1,128 @@
+import codecs
+import json
+
+try:
+    import orjson
+except ImportError:
+    # the standard parser is used when orjson is not installed
+    orjson = None
+
+# fields of 'fetch_hotel_list' hotels which are used by the route search
+HOTEL_LIST_FIELDS = ('id', 'propertyType', 'stars', 'location', 'distance', 'facilities', 'shortFacilities')
+# fields of places of interest of the hotel list
+POI_FIELDS = ('id', 'name', 'category', 'location', 'geom')
+
+
+def loads(content):
+    """
+    Parses json from raw bytes of the response without decoding them to str first
+
+    :param content: bytes or str with json
+    :return: parsed json
+    """
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def iterate_json_array(chunks):
+    """
+    Parses the json array incrementally while its bytes arrive, so only one element of the array
+    is kept in memory besides the current chunk. ValueError is raised if the bytes are not a json
+    array or end before the closing bracket, e.g. when the connection is dropped
+
+    :param chunks: iterable of bytes of the array
+    :return: generator of parsed elements of the array
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    is_started = False
+    for chunk in chunks:
+        buffer = buffer[position:] + text_decoder.decode(chunk)
+        position = 0
+        while True:
+            # skip whitespace, the opening bracket and commas between elements
+            while position < len(buffer) and buffer[position] in ' \t\r\n,[':
+                if buffer[position] == '[':
+                    if is_started:
+                        break
+                    is_started = True
+                position += 1
+            if position == len(buffer):
+                break
+            if not is_started:
+                raise ValueError('response is not a json array')
+            if buffer[position] == ']':
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the element is not complete yet, wait for the next chunk
+                break
+            following = end
+            while following < len(buffer) and buffer[following] in ' \t\r\n':
+                following += 1
+            if following == len(buffer) or buffer[following] not in ',]':
+                # a number at the end of the buffer may continue in the next chunk
+                break
+            position = end
+            yield element
+    if not is_started:
+        raise ValueError('response is not a json array')
+    # the closing bracket has not arrived, elements left in the buffer may be incomplete
+    raise ValueError('json array is truncated')
+
+
+def _hotel_price_record(hotel) -> dict:
+    return {'locationId': hotel['locationId'],
+            'hotelId': hotel['hotelId'],
+            'priceFrom': hotel['priceFrom'],
+            'priceAvg': hotel['priceAvg'],
+            'stars': hotel['stars'],
+            'hotelName': hotel['hotelName'],
+            'location': {'name': hotel['location']['name'], 'country': hotel['location']['country']}}
+
+
+def decode_hotel_prices(content) -> list[dict]:
+    """
+    Parses the response of 'fetch_hotel_prices' and keeps only fields used by the route search,
+    price percentiles and coordinates are dropped right after parsing
+
+    :param content: bytes of the response
+    :return: list of hotels of json type with 'locationId', 'hotelId', 'priceFrom', 'priceAvg', 'stars',
+        'hotelName' and 'location' ('name' and 'country') fields
+    """
+    return [_hotel_price_record(hotel) for hotel in loads(content)]
+
+
+def iterate_hotel_prices(chunks):
+    """
+    Streaming version of 'decode_hotel_prices'
+
+    :param chunks: iterable of bytes of the response
+    :return: generator of hotels of json type in the format of 'decode_hotel_prices'
+    """
+    for hotel in iterate_json_array(chunks):
+        yield _hotel_price_record(hotel)
+
+
+def decode_hotel_list(content) -> dict:
+    """
+    Parses the response of 'fetch_hotel_list' or the saved hotel list and keeps only fields used by
+    the route search and the location index, photos are dropped. Every hotel repeats places of interest
+    of the location, so they are kept once for the whole list.
+
+    :param content: bytes of the response or of the saved file
+    :return: dictionary with 'hotels' list of hotels of json type with 'HOTEL_LIST_FIELDS' fields
+        and 'pois' list of places of interest with 'POI_FIELDS' fields
+    """
+    hotels = []
+    pois = {}
+    for hotel in loads(content)['hotels']:
+        for poi in hotel.get('pois') or []:
+            if poi.get('id') is not None and poi['id'] not in pois:
+                pois[poi['id']] = {field: poi.get(field) for field in POI_FIELDS}
+        hotels.append({field: hotel.get(field) for field in HOTEL_LIST_FIELDS})
+    return {'hotels': hotels, 'pois': list(pois.values())}
@@ -0,0 +1,218 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import requests
+from api_collector.utils.directories import data_directory_path
+
+# max size of stored images in bytes, the least recently used are removed
+MEDIA_CACHE_QUOTA = 512 * 1024 * 1024
+# downloads which get no response in this number of seconds fail
+MEDIA_REQUEST_TIMEOUT = 15
+# stored images are used without requests during this number of seconds, then they are revalidated
+MEDIA_REVALIDATE_AGE = 7 * 24 * 60 * 60
+
+
+class MediaCache:
+    """
+    Disk cache of photos and logos. Images are stored once by the sha256 of their content, keys such as
+    (hotel id, photo index) or IATA code only refer to stored images, so the same image of several hotels
+    takes the disk once. Old images are revalidated with conditional requests (ETag and Last-Modified),
+    so unchanged images are not downloaded again. When the size of stored images exceeds the quota,
+    the least recently used images are removed. Where hard links are not supported, paths of keys are
+    copies of stored images, their size counts towards the quota as well.
+    """
+
+    def __init__(self, directory=None, quota=MEDIA_CACHE_QUOTA, max_age=MEDIA_REVALIDATE_AGE):
+        """
+        :param directory: directory of the cache, by default 'media' in the data directory
+        :param quota: max size of stored images in bytes
+        :param max_age: time in seconds after which stored images are revalidated
+        """
+        self.directory = directory
+        self.quota = quota
+        self.max_age = max_age
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        # the database is opened on the first use, so importing the module does not touch the disk
+        if self.connection is None:
+            if self.directory is None:
+                self.directory = data_directory_path() + '/media'
+            os.makedirs(self.directory, exist_ok=True)
+            self.connection = sqlite3.connect(os.path.join(self.directory, 'media.sqlite3'),
+                                              check_same_thread=False)
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    hash TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    used_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS blobs_by_use ON blobs (used_at);
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    path TEXT,
+                    etag TEXT,
+                    last_modified TEXT,
+                    checked_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS entries_by_hash ON entries (hash);
+                CREATE TABLE IF NOT EXISTS copies (
+                    path TEXT PRIMARY KEY,
+                    hash TEXT NOT NULL,
+                    size INTEGER NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS copies_by_hash ON copies (hash);""")
+            self.connection.commit()
+        return self.connection
+
+    def fetch(self, key, url, path=None) -> str:
+        """
+        Returns the stored image of the key, downloads it if it is not stored or changed upstream
+
+        :param key: str, key of the image, e.g. 'hotel/<hotel_id>/<index>'
+        :param url: url of the image
+        :param path: optional, path where the image is also available, it is a link to the stored image
+        :return: path to the image
+        """
+        now = time.time()
+        with self.lock:
+            row = self.connect().execute("SELECT url, hash, etag, last_modified, checked_at FROM entries "
+                                         "WHERE key = ?", (key,)).fetchone()
+        headers = {}
+        if row is not None and row[0] == url and os.path.exists(self.blob_path(row[1])):
+            if now - row[4] < self.max_age:
+                return self._use(key, row[1], path, now)
+            if row[2]:
+                headers['If-None-Match'] = row[2]
+            if row[3]:
+                headers['If-Modified-Since'] = row[3]
+        response = requests.get(url, timeout=MEDIA_REQUEST_TIMEOUT, headers=headers)
+        if response.status_code == 304 and headers:
+            with self.lock:
+                self.connection.execute("UPDATE entries SET checked_at = ? WHERE key = ?", (now, key))
+            return self._use(key, row[1], path, now)
+        if response.status_code != 200:
+            raise Exception(f"Failed to fetch {url}. Status code: {response.status_code}")
+        content_hash = hashlib.sha256(response.content).hexdigest()
+        blob_path = self.blob_path(content_hash)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            # the image appears only when it is written completely
+            temporary_path = f'{blob_path}.{threading.get_ident()}.tmp'
+            with open(temporary_path, 'wb') as file:
+                file.write(response.content)
+            os.replace(temporary_path, blob_path)
+        with self.lock:
+            self.connection.execute("INSERT OR IGNORE INTO blobs VALUES (?, ?, ?)",
+                                    (content_hash, len(response.content), now))
+            self.connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (key, url, content_hash, path, response.headers.get('ETag'),
+                                     response.headers.get('Last-Modified'), now))
+        path = self._use(key, content_hash, path, now)
+        self.evict()
+        return path
+
+    def lookup(self, key, url):
+        """
+        Returns the stored image of the key without requests
+
+        :param key: str, key of the image
+        :param url: url of the image
+        :return: path to the image, the path given to 'fetch' if it exists, None if the image is not stored
+            or must be revalidated
+        """
+        with self.lock:
+            row = self.connect().execute("SELECT url, hash, path, checked_at FROM entries WHERE key = ?",
+                                         (key,)).fetchone()
+        if row is None or row[0] != url or time.time() - row[3] >= self.max_age:
+            return None
+        for path in (row[2], self.blob_path(row[1])):
+            if path is not None and os.path.exists(path):
+                return path
+        return None
+
+    def blob_path(self, content_hash):
+        """
+        :param content_hash: sha256 of the image
+        :return: path to the stored image
+        """
+        return os.path.join(self.directory, 'blobs', content_hash[:2], content_hash)
+
+    def size(self) -> int:
+        """
+        :return: size of stored images in bytes, copies made where links are not supported are included
+        """
+        with self.lock:
+            return self._total_size(self.connect())
+
+    def evict(self):
+        """
+        Removes the least recently used images until their size fits the quota
+        """
+        with self.lock:
+            connection = self.connect()
+            total = self._total_size(connection)
+            removed = []
+            for content_hash, size in connection.execute("""
+                    SELECT hash, size + (SELECT COALESCE(SUM(size), 0) FROM copies WHERE copies.hash = blobs.hash)
+                    FROM blobs ORDER BY used_at""").fetchall():
+                if total <= self.quota:
+                    break
+                paths = [path for path, in connection.execute("SELECT path FROM entries WHERE hash = ?",
+                                                               (content_hash,)) if path]
+                paths += [path for path, in connection.execute("SELECT path FROM copies WHERE hash = ?",
+                                                                (content_hash,))]
+                connection.execute("DELETE FROM entries WHERE hash = ?", (content_hash,))
+                connection.execute("DELETE FROM copies WHERE hash = ?", (content_hash,))
+                connection.execute("DELETE FROM blobs WHERE hash = ?", (content_hash,))
+                removed.extend(set(paths) | {self.blob_path(content_hash)})
+                total -= size
+            connection.commit()
+        for path in removed:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _use(self, key, content_hash, path, now):
+        with self.lock:
+            self.connection.execute("UPDATE blobs SET used_at = ? WHERE hash = ?", (now, content_hash))
+            if path is not None:
+                self.connection.execute("UPDATE entries SET path = ? WHERE key = ?", (path, key))
+            self.connection.commit()
+        blob_path = self.blob_path(content_hash)
+        if path is None:
+            return blob_path
+        if not (os.path.exists(path) and os.path.samefile(path, blob_path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                os.remove(path)
+            try:
+                # a hard link takes no additional space
+                os.link(blob_path, path)
+                size = None
+            except OSError:
+                shutil.copyfile(blob_path, path)
+                size = os.path.getsize(path)
+            with self.lock:
+                # the previous copy at the path is replaced, a copy takes the disk as much as the image
+                self.connection.execute("DELETE FROM copies WHERE path = ?", (path,))
+                if size is not None:
+                    self.connection.execute("INSERT INTO copies VALUES (?, ?, ?)", (path, content_hash, size))
+                self.connection.commit()
+            if size is not None:
+                self.evict()
+        return path
+
+    @staticmethod
+    def _total_size(connection):
+        return connection.execute("SELECT (SELECT COALESCE(SUM(size), 0) FROM blobs) + "
+                                  "(SELECT COALESCE(SUM(size), 0) FROM copies)").fetchone()[0]
+
+
+# media cache shared by all API methods
+media_cache = MediaCache()
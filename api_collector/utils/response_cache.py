@@ -0,0 +1,197 @@
+import functools
+import inspect
+import threading
+from concurrent.futures import Future
+from cachetools import TTLCache
+from api_collector.utils.currency import CANONICAL_CURRENCY, fx_table
+
+# all decorated API methods, used to clear caches and collect statistics
+response_caches = {}
+
+
+class ResponseCache:
+    """
+    Cache of upstream responses of one API method, keyed by all arguments of the call
+    with default values applied. Responses are shared between callers and must not be mutated.
+    Concurrent identical calls are coalesced, only the first one makes the request.
+    """
+
+    def __init__(self, method, ttl, maxsize):
+        """
+        :param method: decorated API method
+        :param ttl: time to live of a response in seconds
+        :param maxsize: max number of cached responses
+        """
+        self.signature = inspect.signature(method)
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lock = threading.Lock()
+        # key -> Future of the request which is being made
+        self.in_flight = {}
+        # functions (arguments, response) called with every new upstream response
+        self.listeners = []
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def bind(self, api, args, kwargs) -> inspect.BoundArguments:
+        # the same call written with positional, keyword or default arguments gets the same arguments
+        arguments = self.signature.bind(api, *args, **kwargs)
+        arguments.apply_defaults()
+        return arguments
+
+    @staticmethod
+    def make_key(arguments):
+        return tuple((name, _hashable(value)) for name, value in arguments.arguments.items() if name != 'self')
+
+    def get_or_fetch(self, key, fetch):
+        """
+        Returns the cached response, waits for the same request if it is being made by another thread
+        or makes the request
+
+        :param key: key of the call
+        :param fetch: function without arguments which makes the request
+        :return: response
+        """
+        with self.lock:
+            if key in self.cache:
+                self.hits += 1
+                return self.cache[key]
+            future = self.in_flight.get(key)
+            if future is None:
+                self.misses += 1
+                future = self.in_flight[key] = Future()
+                is_owner = True
+            else:
+                self.coalesced += 1
+                is_owner = False
+        if not is_owner:
+            return future.result()
+
+        try:
+            response = fetch()
+        except BaseException as e:
+            # failed requests are not cached, waiting callers get the same error
+            with self.lock:
+                del self.in_flight[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self.cache[key] = response
+            del self.in_flight[key]
+        future.set_result(response)
+        self.notify(key, response)
+        return response
+
+    def refresh(self, key, fetch):
+        """
+        Makes the request even if the response is cached and replaces the cached response,
+        so it does not expire for other callers
+
+        :param key: key of the call
+        :param fetch: function without arguments which makes the request
+        :return: response
+        """
+        response = fetch()
+        with self.lock:
+            self.misses += 1
+            self.cache[key] = response
+        self.notify(key, response)
+        return response
+
+    def notify(self, key, response):
+        for listener in self.listeners:
+            try:
+                listener(dict(key), response)
+            except Exception:
+                # listeners only collect data, they must not break the request
+                pass
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.hits = 0
+            self.misses = 0
+            self.coalesced = 0
+
+
+def cached_response(ttl, maxsize=1024, convert_prices=None):
+    """
+    Decorator of API methods which caches their responses for 'ttl' seconds.
+    Failed requests raise exceptions and are not cached.
+
+    If 'convert_prices' is specified, responses are requested and cached in rubles whatever
+    'currency' argument is, and prices are converted to the required currency on read with
+    the local exchange rates. Without known rates the response is requested in the currency.
+
+    :param ttl: time to live of a response in seconds
+    :param maxsize: max number of cached responses
+    :param convert_prices: function (response, rate, currency) which returns a copy of the response
+        with prices multiplied by 'rate' in the currency with 'currency' code
+    """
+    def decorator(method):
+        response_cache = ResponseCache(method, ttl=ttl, maxsize=maxsize)
+        response_caches[method.__qualname__] = response_cache
+
+        def call(api, args, kwargs, refresh):
+            arguments = response_cache.bind(api, args, kwargs)
+            currency = arguments.arguments.get('currency')
+            rate = None
+            if convert_prices is not None and currency.value != CANONICAL_CURRENCY:
+                rate = fx_table.rate(currency.value)
+                if rate is not None:
+                    # one response in rubles serves every currency
+                    arguments.arguments['currency'] = type(currency)(CANONICAL_CURRENCY)
+            key = response_cache.make_key(arguments)
+
+            def fetch():
+                return method(*arguments.args, **arguments.kwargs)
+
+            response = response_cache.refresh(key, fetch) if refresh else response_cache.get_or_fetch(key, fetch)
+            if rate is not None:
+                response = convert_prices(response, rate, currency.value)
+            return response
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            return call(self, args, kwargs, refresh=False)
+
+        def refresh(self, *args, **kwargs):
+            return call(self, args, kwargs, refresh=True)
+
+        wrapper.response_cache = response_cache
+        # makes the request bypassing the cache, e.g. Api.method.refresh(api, ...)
+        wrapper.refresh = refresh
+        return wrapper
+    return decorator
+
+
+def response_cache_stats() -> dict:
+    """
+    Sums statistics of all API methods
+
+    :return: dictionary with 'hits' (served from the cache), 'misses' (requests made)
+        and 'coalesced' (joined a request made by another caller)
+    """
+    stats = {'hits': 0, 'misses': 0, 'coalesced': 0}
+    for response_cache in response_caches.values():
+        with response_cache.lock:
+            stats['hits'] += response_cache.hits
+            stats['misses'] += response_cache.misses
+            stats['coalesced'] += response_cache.coalesced
+    return stats
+
+
+def clear_response_caches():
+    """
+    Clears responses of all API methods
+    """
+    for response_cache in response_caches.values():
+        response_cache.clear()
+
+
+def _hashable(value):
+    if isinstance(value, list):
+        return tuple(_hashable(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _hashable(item)) for key, item in value.items()))
+    return value
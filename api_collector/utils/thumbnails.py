@@ -0,0 +1,132 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, ImageOps
+
+# variants of photos sent to users: name -> (max width, max height, format)
+PHOTO_VARIANTS = {'thumb': (320, 208, 'JPEG'), 'medium': (640, 416, 'WEBP')}
+# quality of encoded variants, photos are viewed on phones
+VARIANT_QUALITY = 80
+# number of processes which resize photos, one core is left to the event loop
+THUMBNAIL_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+
+_EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp', 'PNG': '.png'}
+
+
+def variant_path(path, name, variants=PHOTO_VARIANTS) -> str:
+    """
+    :param path: path to the original photo
+    :param name: name of the variant
+    :param variants: variants in the format of 'PHOTO_VARIANTS'
+    :return: path to the variant next to the original, e.g. 'photo1.thumb.jpg' for 'photo1.avif'
+    """
+    return f'{os.path.splitext(path)[0]}.{name}{_EXTENSIONS[variants[name][2]]}'
+
+
+def make_variants(path, variants=PHOTO_VARIANTS) -> dict:
+    """
+    Resizes the photo to all variants, variants which are newer than the original are not made again.
+    The function is run by worker processes of 'ThumbnailPipeline'.
+
+    :param path: path to the original photo
+    :param variants: variants in the format of 'PHOTO_VARIANTS'
+    :return: dictionary name of the variant -> path to the variant
+    """
+    paths = {name: variant_path(path, name, variants) for name in variants}
+    modified_at = os.path.getmtime(path)
+    missing = [name for name, target in paths.items()
+               if not os.path.exists(target) or os.path.getmtime(target) < modified_at]
+    if len(missing) == 0:
+        return paths
+    with Image.open(path) as original:
+        image = ImageOps.exif_transpose(original).convert('RGB')
+    for name in missing:
+        width, height, image_format = variants[name]
+        variant = image.copy()
+        variant.thumbnail((width, height), Image.LANCZOS)
+        # the variant appears only when it is written completely
+        temporary_path = f'{paths[name]}.{os.getpid()}.tmp'
+        variant.save(temporary_path, image_format, quality=VARIANT_QUALITY)
+        os.replace(temporary_path, paths[name])
+    return paths
+
+
+class ThumbnailPipeline:
+    """
+    Makes smaller variants of saved photos in a pool of processes, so resizing neither blocks
+    the event loop nor competes with it for the interpreter lock. The pool is started on the first use.
+    """
+
+    def __init__(self, max_workers=THUMBNAIL_WORKERS, variants=PHOTO_VARIANTS):
+        """
+        :param max_workers: number of worker processes
+        :param variants: variants in the format of 'PHOTO_VARIANTS'
+        """
+        self.max_workers = max_workers
+        self.variants = variants
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def generate(self, paths) -> dict:
+        """
+        Makes variants of photos and waits for them
+
+        :param paths: paths to original photos
+        :return: dictionary path to the original -> dictionary name of the variant -> path to the variant,
+            photos which can not be read are missing
+        """
+        futures = {path: self._executor().submit(make_variants, path, self.variants) for path in paths}
+        return _collect({path: _result(future) for path, future in futures.items()})
+
+    def submit(self, paths) -> list:
+        """
+        Makes variants of photos in the background without waiting for them
+
+        :param paths: paths to original photos
+        :return: list of futures of 'make_variants' results
+        """
+        executor = self._executor()
+        return [executor.submit(make_variants, path, self.variants) for path in paths]
+
+    async def generate_async(self, paths) -> dict:
+        """
+        Asynchronous version of 'generate'
+        """
+        loop = asyncio.get_running_loop()
+        executor = self._executor()
+        results = await asyncio.gather(*(loop.run_in_executor(executor, make_variants, path, self.variants)
+                                         for path in paths), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(result, OSError):
+                raise result
+        return _collect({path: None if isinstance(result, OSError) else result
+                         for path, result in zip(paths, results)})
+
+    def shutdown(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown()
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self.executor
+
+
+def _result(future):
+    try:
+        return future.result()
+    except OSError:
+        # formats without a Pillow decoder (e.g. AVIF) and broken files have no variants
+        return None
+
+
+def _collect(results):
+    return {path: variants for path, variants in results.items() if variants is not None}
+
+
+# pipeline shared by the whole application
+thumbnail_pipeline = ThumbnailPipeline()
@@ -1,12 +1,13 @@
 from request_analyzer.llm import LLM
 from request_analyzer.information_retriever import InformationRetriever
 from request_analyzer.more_info_required_message_generator import MoreInfoRequiredMessageGenerator
+from request_analyzer.request_fields_enum import ANYWHERE_DESTINATION
 import re
 import os
 import pandas as pd
 import json
 from datetime import datetime
-from typing import Tuple
+from typing import Tuple, Dict, Any, Callable
 
 
 class RequestAnalyzer:
@@ -40,6 +41,8 @@ class RequestAnalyzer:
         self.are_all_fields_retrieved = []
         # Indicates which fields need to be updated with new data
         self.fields_to_update = []
+        # Functions notified about fields retrieved before the request is complete
+        self.partial_state_listeners = []
         # Load the CSV file and create a city name to code mapping
         project_root = self._get_project_root()
         csv_file_path = os.path.join(project_root, 'data/all_cities_codes.csv')
@@ -62,6 +65,23 @@ class RequestAnalyzer:
                 f"Could not locate {root_marker_file} to determine project root."
             )
 
+    def add_partial_state_listener(
+            self, listener: Callable[[Dict[str, Any]], None]) -> None:
+        """
+        Registers a function which is called after every
+        incomplete analysis step with the fields verified
+        so far, converted the same way as the final json
+        output. It lets callers start work, like warming
+        caches, before the request is complete.
+
+        Args:
+            listener (Callable[[Dict[str, Any]], None]):
+                Function which receives the partial
+                state, e.g. {"Departure": "KZN",
+                "Destination": "MOW"}.
+        """
+        self.partial_state_listeners.append(listener)
+
     async def analyzer_step(self, user_request: str) -> Tuple[bool, str]:
         """
         Performs the analysis step for a
@@ -97,6 +117,8 @@ class RequestAnalyzer:
                         "Destination": "MOW",
                         "Budget": 35000
                         }"
+                      "Destination" is "None" when
+                      the user wants to go anywhere.
                     - Example of generated message:
                         "Похоже, что я не получил 
                         все необходимые данные для вашего 
@@ -146,6 +168,8 @@ class RequestAnalyzer:
 
         return_message = ""  # Initialize the return message
         if not all(self.are_all_fields_retrieved):
+            # Let listeners use the fields which are already verified
+            self._notify_partial_state(fields_verification_map)
             # Generate a feedback message if
             # any field verification failed
             return_message = await self \
@@ -158,23 +182,51 @@ class RequestAnalyzer:
         # Convert extracted data to the required JSON format
         json_output = {}
         for field_name, retr_data in self.extracted_data.items():
-            if field_name in ["Arrival", "Return"]:
-                # Convert dates to YYYY-MM-DD format
-                date_obj = datetime.strptime(retr_data, "%d/%m/%Y")
-                json_output[field_name] = date_obj.strftime("%Y-%m-%d")
-            elif field_name == "Budget" and retr_data != "None":
-                # Convert budget to integer
-                json_output[field_name] = int(retr_data)
-            elif field_name in ["Departure", "Destination"
-                                ] and retr_data != "None":
-                city_code = self.city_name_to_code.get(retr_data)
-                if city_code:
-                    json_output[field_name] = city_code
-                else:
-                    json_output[field_name] = retr_data
-            else:
-                # Add other fields as is
-                json_output[field_name] = retr_data
+            json_output[field_name] = self._convert_field(
+                field_name, retr_data)
 
         # Return true if all fields were correctly verified, along with the JSON output
         return True, json.dumps(json_output, ensure_ascii=False)
+
+    def _convert_field(self, field_name: str, retr_data: str) -> Any:
+        """Convert retrieved field data to the json output format."""
+        if field_name in ["Arrival", "Return"]:
+            # Convert dates to YYYY-MM-DD format
+            date_obj = datetime.strptime(retr_data, "%d/%m/%Y")
+            return date_obj.strftime("%Y-%m-%d")
+        elif field_name == "Budget" and retr_data != "None":
+            # Convert budget to integer
+            return int(retr_data)
+        elif field_name == "Destination" and \
+                retr_data == ANYWHERE_DESTINATION:
+            # The route search looks for destinations itself
+            # when the destination is not specified
+            return "None"
+        elif field_name in ["Departure", "Destination"
+                            ] and retr_data != "None":
+            city_code = self.city_name_to_code.get(retr_data)
+            if city_code:
+                return city_code
+            return retr_data
+        # Return other fields as is
+        return retr_data
+
+    def _notify_partial_state(self, fields_verification_map) -> None:
+        """Send verified fields retrieved so far to listeners."""
+        if not self.partial_state_listeners:
+            return
+        partial_state = {}
+        for field, is_field_retrieved in zip(
+                fields_verification_map, self.are_all_fields_retrieved):
+            retr_data = self.extracted_data.get(field.value, "None")
+            if not is_field_retrieved or retr_data == "None":
+                continue
+            try:
+                converted_data = self._convert_field(field.value, retr_data)
+            except ValueError:
+                # Skip data which is not in the expected format yet
+                continue
+            if converted_data != "None":
+                partial_state[field.value] = converted_data
+        for listener in self.partial_state_listeners:
+            listener(partial_state)
@@ -1,5 +1,8 @@
 from enum import Enum
 
+# destination retrieved when the user wants to go anywhere
+ANYWHERE_DESTINATION = "Anywhere"
+
 
 class RequestField(Enum):
     Arrival = ("Arrival", True)
@@ -1,4 +1,5 @@
 from request_analyzer.llm import LLM
+from request_analyzer.request_fields_enum import ANYWHERE_DESTINATION
 from request_analyzer.retreivers.abstract_retriever import BaseRetriever
 from request_analyzer.utils.embedding_city_search import EmbeddingCitySearch
 from request_analyzer.utils.extract_data import extract_data
@@ -46,7 +47,10 @@ Q: "Планирую сгонять в Хабаровск через три не
 A: Destination: "Хабаровск"
 
 Q: "Хочу уехать из Москвы куда-нибудь на три дня"
-A: Destination: "None"
+A: Destination: "Anywhere"
+
+Q: "Полечу из Казани в любой город с 3 по 10 сентября"
+A: Destination: "Anywhere"
 
 Q: "Уеду в Питер из Казани в июле с 12 по 17 числа"
 A: Destination: "Санкт-Петербург"
@@ -77,8 +81,9 @@ A: Destination: "'''
 
         Returns:
             str: The extracted destination city 
-                 as a string, or a message indicating 
-                 no destination was found.
+                 as a string, "Anywhere" if the user 
+                 wants to go anywhere, or a message 
+                 indicating no destination was found.
         """
         # Replace the placeholder in the prompt
         # template with the actual user request
@@ -88,7 +93,7 @@ A: Destination: "'''
         self.json_input["prompt"] = prompt
         result = await self.llm.get_response(self.json_input)
         result = extract_data(result)
-        if not result == 'None':
+        if result not in ('None', ANYWHERE_DESTINATION):
             found_russian_city = self.searcher.search_city(result)
             return found_russian_city[0][0]
         return result
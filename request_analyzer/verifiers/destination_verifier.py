@@ -1,4 +1,5 @@
 from typing import Tuple
+from request_analyzer.request_fields_enum import ANYWHERE_DESTINATION
 from request_analyzer.verifiers.abstract_verifier import BaseVerifier, ValueStages
 
 
@@ -50,6 +51,11 @@ class DestinationVerifier(BaseVerifier):
             return (ValueStages.FIELD_NOT_FOUND,
                     "The user has not entered this field")
 
+        # The user explicitly wants to go anywhere,
+        # the destination is chosen by the route search
+        if retrieved_value == ANYWHERE_DESTINATION:
+            return (ValueStages.OK, "The user wants to go anywhere")
+
         # If the retrieved value passes the initial check,
         # assume everything is good
         return (ValueStages.OK, "Everything is good")
@@ -1,8 +1,15 @@
+import asyncio
 import sys
 import json
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, LabeledPrice, WebAppInfo, KeyboardButton, ReplyKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, PreCheckoutQueryHandler, filters, ContextTypes
-from api_collector.route.route import find_top_routes
+from api_collector.air_tickets.price_calendar import price_calendar
+from api_collector.hotels.catalog import catalogs
+from api_collector.hotels.location_index import location_index
+from api_collector.route.async_route import stream_top_routes, fetch_hotel_photo_files_async
+from api_collector.route.discovery import find_anywhere_routes
+from api_collector.route.prefetch import RoutePrefetcher
+from api_collector.route.warmer import cache_warmer
 from telegram_bot.utils import messages
 from telegram_bot.utils.formatting import route_list_to_string, translate_to_russian, translate_to_english, format_web_app_data
 from request_analyzer.request_analyzer import RequestAnalyzer
@@ -10,10 +17,26 @@ from request_analyzer.llm import LLM
 
 # Global dictionary to track user states
 user_states = {}
+# Max time of the route search in seconds, routes found by then are shown as partial
+ROUTE_SEARCH_DEADLINE = 20
+
+def read_files(paths) -> list[bytes]:
+    contents = []
+    for path in paths:
+        with open(path, 'rb') as file:
+            contents.append(file.read())
+    return contents
+
 
 class SayNoMoreBot:
     def __init__(self, token):
-        self.application = Application.builder().token(token).build()
+        self.application = Application.builder().token(token).post_init(self.start_cache_warmer).build()
+        # keep ticket prices found by searches for flexible date questions
+        price_calendar.record_responses()
+        # keep found cities, so they are resolved locally next time
+        location_index.record_responses()
+        # types of hotels and rooms are looked up in memory
+        catalogs.load()
         self.setup_handlers()
 
     def setup_handlers(self):
@@ -30,6 +53,11 @@ class SayNoMoreBot:
     def run(self):
         self.application.run_polling()
 
+    async def start_cache_warmer(self, application):
+        # refresh data of popular searches and stale catalogs in the background
+        application.create_task(cache_warmer.run())
+        application.create_task(catalogs.run())
+
     async def send_welcome(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.message.chat.id
         if user_id not in user_states:
@@ -86,7 +114,7 @@ class SayNoMoreBot:
                     await call.message.reply_text(f"{messages.SELECTED_ROUTE_EN} {route_index + 1}:\n{selected_route.to_string_en()}")
                 else:
                     await call.message.reply_text(f"{messages.SELECTED_ROUTE_RU} {route_index + 1}:\n{translate_to_russian(selected_route.to_string_ru())}")
-                await self.send_photos(user_id, selected_route.hotel.photo_urls, context)
+                await self.send_photos(user_id, selected_route.hotel, context)
                 await self.send_payment_button(call.message.chat.id, context)
         elif call.data.startswith("lang_"):
             self.set_user_language(call.message.chat.id, call.data.split('_')[1])
@@ -141,15 +169,67 @@ class SayNoMoreBot:
 
     async def get_routes(self, chat_id, request):
         user_state = user_states[chat_id]
-        routes_list = find_top_routes(
-            origin=request['Departure'],
-            destination=request['Destination'],
-            departure_at=request['Arrival'],
-            return_at=request['Return'],
-            budget=request['Budget']
-            )
+        if request.get('Destination') in (None, "None"):
+            # destination is not specified, search through popular directions,
+            # the search is blocking, so it runs in a thread and other users are served meanwhile
+            routes_list = await asyncio.to_thread(
+                find_anywhere_routes,
+                origin=request['Departure'],
+                departure_at=request['Arrival'],
+                return_at=request['Return'],
+                budget=request['Budget'],
+                deadline=ROUTE_SEARCH_DEADLINE
+                )
+        else:
+            # show the first routes as soon as they are found and update the message with refined ones
+            routes_message = None
+            async for routes_list in stream_top_routes(
+                    origin=request['Departure'],
+                    destination=request['Destination'],
+                    departure_at=request['Arrival'],
+                    return_at=request['Return'],
+                    budget=request['Budget'],
+                    deadline=ROUTE_SEARCH_DEADLINE
+                    ):
+                user_state["routes_list"] = routes_list
+                routes_message = await self.send_routes_with_buttons(chat_id, routes_list, routes_message)
+            cache_warmer.record_routes(routes_list)
+            if routes_list and routes_list[0].partial:
+                if user_state['language'] == "en":
+                    await self.application.bot.send_message(chat_id, messages.PARTIAL_ROUTES_EN)
+                else:
+                    await self.application.bot.send_message(chat_id, messages.PARTIAL_ROUTES_RU)
+            await self.send_cheaper_date(chat_id, routes_list)
+            return
         user_state["routes_list"] = routes_list
+        if not routes_list:
+            if user_state['language'] == "en":
+                await self.application.bot.send_message(chat_id, messages.NO_ROUTES_EN)
+            else:
+                await self.application.bot.send_message(chat_id, messages.NO_ROUTES_RU)
+            return
         await self.send_routes_with_buttons(chat_id, routes_list)
+        if routes_list[0].partial:
+            if user_state['language'] == "en":
+                await self.application.bot.send_message(chat_id, messages.PARTIAL_ROUTES_EN)
+            else:
+                await self.application.bot.send_message(chat_id, messages.PARTIAL_ROUTES_RU)
+
+    async def send_cheaper_date(self, chat_id, routes_list):
+        # offer a nearby departure date with cheaper tickets found by earlier searches
+        prices = [route.ticket.ticket_price for route in routes_list if route.ticket and route.ticket.found]
+        if not prices or not routes_list[0].departure_at:
+            return
+        route = routes_list[0]
+        cheaper = await asyncio.to_thread(price_calendar.suggest_cheaper_date, route.origin, route.destination,
+                                          route.departure_at, min(prices))
+        if cheaper is None:
+            return
+        date, price, _ = cheaper
+        if user_states.get(chat_id)['language'] == "en":
+            await self.application.bot.send_message(chat_id, messages.CHEAPER_DATE_EN.format(date=date, price=round(price)))
+        else:
+            await self.application.bot.send_message(chat_id, messages.CHEAPER_DATE_RU.format(date=date, price=round(price)))
 
     async def process_message(self, message):
         user_id = message.chat.id
@@ -182,18 +262,32 @@ class SayNoMoreBot:
             await self.application.bot.send_message(message.chat.id, 'ERROR')
             sys.exit(0)
 
-    async def send_routes_with_buttons(self, chat_id, routes_list):
+    async def send_routes_with_buttons(self, chat_id, routes_list, message=None):
         if user_states.get(chat_id)['language'] == 'en':
             markup = InlineKeyboardMarkup([[InlineKeyboardButton(text=f"Route {index + 1}", callback_data=f"route_{index}") for index, route in enumerate(routes_list)]])
         else:
             markup = InlineKeyboardMarkup([[InlineKeyboardButton(text=f"Маршрут {index + 1}", callback_data=f"route_{index}") for index, route in enumerate(routes_list)]])
         routes_message = route_list_to_string(routes_list, user_states.get(chat_id)['language'])
-        await self.application.bot.send_message(chat_id, routes_message, reply_markup=markup)
+        if message is None:
+            return await self.application.bot.send_message(chat_id, routes_message, reply_markup=markup)
+        # edit previously sent routes in place, telegram rejects edits which do not change the message
+        if message.text != routes_message.strip():
+            return await message.edit_text(routes_message, reply_markup=markup)
+        return message
 
-    async def send_photos(self, chat_id, photos, context):
-        if len(photos) > 5:
-            photos = photos[:5]
-        media_group = [InputMediaPhoto(media=photo_url) for photo_url in photos]
+    async def send_photos(self, chat_id, hotel, context):
+        if len(hotel.photo_ids) == 0:
+            return
+        try:
+            # resized photos are sent as files, so phones do not download full photos
+            paths = await fetch_hotel_photo_files_async(hotel, max_photo_number=5)
+            photos = await asyncio.to_thread(read_files, paths)
+        except Exception:
+            photos = []
+        if len(photos) == 0:
+            # photos are sent by urls if they could not be saved or resized
+            photos = hotel.photo_urls[:5]
+        media_group = [InputMediaPhoto(media=photo) for photo in photos]
         await context.bot.send_media_group(chat_id, media_group)
 
     async def send_payment_button(self, chat_id, context):
@@ -243,11 +337,17 @@ class SayNoMoreBot:
 
     def restart_trip_planning_sequence(self, chat_id):
         if chat_id in user_states:
+            user_states[chat_id]["prefetcher"].cancel()
             del user_states[chat_id]
 
     def initialize_user_state(self):
+        analyzer = RequestAnalyzer(LLM())
+        # warm caches with the fields the user has already given
+        prefetcher = RoutePrefetcher()
+        analyzer.add_partial_state_listener(prefetcher.notify)
         return {
-            "analyzer": RequestAnalyzer(LLM()),
+            "analyzer": analyzer,
+            "prefetcher": prefetcher,
             "step": 0,
             "completed": False,
             "messages": [],
@@ -56,3 +56,18 @@ PAYMENT_FAIL_RU = "Ваша оплата не прошла. Пожалуйста
 SELECTED_ROUTE_EN = "You have selected route #"
 
 SELECTED_ROUTE_RU = "Вы выбрали мартшрут #"
+
+
+NO_ROUTES_EN = "Unfortunately, no routes fit your request. Try to change the dates or increase the budget."
+
+NO_ROUTES_RU = "К сожалению, подходящих маршрутов не найдено. Попробуйте изменить даты или увеличить бюджет."
+
+
+PARTIAL_ROUTES_EN = "The search took too long, so these routes are based on the data found so far. Try again later to get the full results."
+
+PARTIAL_ROUTES_RU = "Поиск занял слишком много времени, поэтому маршруты составлены по уже найденным данным. Попробуйте позже, чтобы получить полные результаты."
+
+
+CHEAPER_DATE_EN = "Tickets are cheaper on {date}: from {price} RUB."
+
+CHEAPER_DATE_RU = "Билеты дешевле {date}: от {price} руб."
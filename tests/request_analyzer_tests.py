@@ -1,5 +1,9 @@
+import json
 import unittest
+from datetime import datetime
+from unittest.mock import AsyncMock, Mock, patch
 
+from api_collector.route.batch import plan_query
 from request_analyzer.llm import LLM
 from request_analyzer.request_analyzer import RequestAnalyzer
 
@@ -72,5 +76,38 @@ class TestRequestAnalyzer(unittest.IsolatedAsyncioTestCase):
         )
 
 
+    @patch('api_collector.route.batch.find_anywhere_routes', return_value=[])
+    @patch('request_analyzer.information_retriever.EmbeddingCitySearch')
+    async def test_anywhere_request(self, MockEmbeddingCitySearch,
+                                    mock_find_anywhere_routes):
+        MockEmbeddingCitySearch.return_value.search_city.side_effect = \
+            lambda query, k=1: ([query], [0.0])
+        year = datetime.now().year + 1
+        # answers of the LLM to the last question of every retriever prompt
+        answers = {
+            'Arrival Time: "': f'01/08/{year}"',
+            'Return date: "': f'08/08/{year}"',
+            'Departure: "': 'Москва"',
+            'Destination: "': 'Anywhere"',
+            'Budget: "': '50000"'
+        }
+        llm = Mock()
+        llm.get_response = AsyncMock(side_effect=lambda json_data: answers[
+            json_data['prompt'].rsplit('A: ', 1)[1]])
+        request_analyzer = RequestAnalyzer(llm)
+        are_all_fields_retireved, message = await \
+            request_analyzer.analyzer_step(
+                "Хочу уехать из Москвы куда-нибудь с 1го по 8ое августа")
+        # the request is complete without asking for a destination
+        self.assertTrue(are_all_fields_retireved)
+        request = json.loads(message)
+        self.assertEqual(request['Destination'], "None")
+
+        await plan_query(request)
+        mock_find_anywhere_routes.assert_called_once_with(
+            origin='MOW', departure_at=f'{year}-08-01',
+            return_at=f'{year}-08-08', budget=50000, deadline=None)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,9 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
 from unittest import TestCase, main
+from unittest.mock import Mock, patch
+from PIL import Image
 from api_collector.utils.directories import data_directory_path
-from api_collector.air_tickets.air_tickets_api import AirTicketsApi
-from api_collector.hotels.hotel_api import HotelApi
+from api_collector.air_tickets.air_tickets_api import AirTicketsApi, convert_ticket_prices
+from api_collector.hotels.hotel_api import HotelApi, convert_hotel_prices
+from api_collector.hotels.catalog import Catalog, Catalogs
+from api_collector.route.candidates import HotelIndex
+from api_collector.route import route as route_module
+from api_collector.route.route import Hotel
+from api_collector.air_tickets.price_calendar import PriceCalendar
+from api_collector.air_tickets.flight_enums import Currency
+from api_collector.utils.response_cache import cached_response, clear_response_caches
+from api_collector.utils.currency import FxTable
+from api_collector.utils.decoding import decode_hotel_prices, decode_hotel_list, iterate_json_array
+from api_collector.utils.media_cache import MediaCache
+from api_collector.utils.thumbnails import ThumbnailPipeline, make_variants
 from datetime import datetime, timedelta
+import hashlib
+import json
 import os
+import tempfile
+import threading
+import time
 
 
 # Define a class that inherits from TestCase to create unit tests for the AirTicketsApi
@@ -184,5 +204,324 @@ class TestAirTicketsApi(TestCase):
         self.assertTrue(os.path.exists(file_path))
 
 
+# Tests of the API helpers which do not make requests
+class TestApiUtils(TestCase):
+
+    def setUp(self):
+        clear_response_caches()
+
+    def test_price_calendar(self):
+        calendar = PriceCalendar(path=':memory:')
+        now = datetime.utcnow()
+        month = (now + timedelta(days=40)).strftime('%Y-%m')
+        calendar.add([
+            ('MOW', 'LED', f'{month}-01', 5000.0, now - timedelta(days=40)),
+            ('MOW', 'LED', f'{month}-01', 4000.0, now - timedelta(days=35)),
+            ('MOW', 'LED', f'{month}-01', 4500.0, now - timedelta(hours=1)),
+            ('MOW', 'LED', f'{month}-02T10:00:00+03:00', 3000.0, now - timedelta(hours=1)),
+            ('MOW', 'LED', f'{month}-02T18:00:00+03:00', 3500.0, now - timedelta(hours=1)),
+            ('MOW', 'LED', '2000-01-01', 100.0, now),
+        ])
+        # the latest price of every date, the cheapest one for the same moment
+        self.assertEqual([row[:2] for row in calendar.get_prices('MOW', 'LED', f'{month}-01', f'{month}-31')],
+                         [(f'{month}-01', 4500.0), (f'{month}-02', 3000.0)])
+        self.assertEqual(calendar.get_cheapest_date('MOW', 'LED', f'{month}-01', f'{month}-31')[1], 3000.0)
+        self.assertEqual(list(calendar.get_cheapest_months('MOW', 'LED', f'{month}-01', f'{month}-31')), [month])
+        # a nearby date is suggested only if it is cheaper enough than the chosen ticket
+        self.assertEqual(calendar.suggest_cheaper_date('MOW', 'LED', f'{month}-01', 4500.0)[:2],
+                         (f'{month}-02', 3000.0))
+        self.assertIsNone(calendar.suggest_cheaper_date('MOW', 'LED', f'{month}-02', 3000.0))
+        self.assertIsNone(calendar.suggest_cheaper_date('MOW', 'LED', f'{month}-01', 3100.0))
+        # stale prices are not used
+        self.assertEqual(calendar.get_prices('MOW', 'LED', f'{month}-01', f'{month}-31', max_age=60), [])
+        self.assertIsNone(calendar.get_cheapest_date('MOW', 'LED', f'{month}-01', f'{month}-31', max_age=60))
+
+        # the past date and the old history are removed, the latest price of every date is kept
+        self.assertEqual(calendar.compact(history_days=30), 3)
+        self.assertEqual([price for _, price in calendar.get_history('MOW', 'LED', f'{month}-01')], [4500.0])
+
+        calendar.record_period_tickets({'currency': Currency.RUB}, {'success': True, 'data': [
+            {'origin': 'MOW', 'destination': 'AER', 'depart_date': f'{month}-05', 'value': 7000.0,
+             'found_at': '2024-06-20T09:00:00Z'}]})
+        calendar.record_period_tickets({'currency': Currency.USD}, {'success': True, 'data': [
+            {'origin': 'MOW', 'destination': 'AER', 'depart_date': f'{month}-06', 'value': 70.0}]})
+        self.assertEqual(calendar.get_history('MOW', 'AER', f'{month}-05'), [('2024-06-20T09:00:00', 7000.0)])
+        self.assertEqual(calendar.get_history('MOW', 'AER', f'{month}-06'), [])
+
+    def test_cached_response_listeners(self):
+        class Api:
+            @cached_response(ttl=60)
+            def fetch(self, origin, currency=Currency.RUB):
+                return {'success': True, 'data': [{'origin': origin, 'destination': 'LED',
+                                                   'departure_at': '2024-07-01T10:00:00+03:00', 'price': 3000.0}]}
+
+        Api.fetch.response_cache.clear()
+        calendar = PriceCalendar(path=':memory:')
+        Api.fetch.response_cache.listeners.append(calendar.record_cheapest_tickets)
+        Api().fetch('MOW')
+        # cached responses are not recorded again
+        Api().fetch('MOW')
+        self.assertEqual(len(calendar.get_history('MOW', 'LED', '2024-07-01')), 1)
+
+    def test_cached_response(self):
+        class Api:
+            calls = 0
+
+            @cached_response(ttl=60)
+            def fetch(self, origin, page=1):
+                Api.calls += 1
+                return {'origin': origin, 'page': page}
+
+        Api.fetch.response_cache.clear()
+        self.assertEqual(Api().fetch('MOW'), {'origin': 'MOW', 'page': 1})
+        # the same call written with keyword and default arguments is served from the cache
+        self.assertEqual(Api().fetch(origin='MOW', page=1), {'origin': 'MOW', 'page': 1})
+        self.assertEqual(Api.calls, 1)
+        Api().fetch('MOW', page=2)
+        self.assertEqual(Api.calls, 2)
+        self.assertEqual(Api.fetch.response_cache.hits, 1)
+        # refresh makes the request even if the response is cached
+        Api.fetch.refresh(Api(), 'MOW')
+        self.assertEqual(Api.calls, 3)
+        Api().fetch('MOW')
+        self.assertEqual(Api.calls, 3)
+
+    def test_cached_response_coalesces_calls(self):
+        class Api:
+            calls = 0
+
+            @cached_response(ttl=60)
+            def fetch(self, origin):
+                Api.calls += 1
+                time.sleep(0.1)
+                return {'origin': origin}
+
+        Api.fetch.response_cache.clear()
+        # identical calls made at the same time share one request
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            responses = list(executor.map(lambda _: Api().fetch('MOW'), range(4)))
+        self.assertEqual(responses, [{'origin': 'MOW'}] * 4)
+        self.assertEqual(Api.calls, 1)
+        self.assertEqual(Api.fetch.response_cache.coalesced, 3)
+
+    @patch('api_collector.utils.currency.requests')
+    def test_currency_normalized_responses(self, mock_requests):
+        fx_table = FxTable(path='/nonexistent/fx_rates.json')
+        fx_table.set_rates({'usd': 80.0, 'eur': 100.0})
+
+        class Api:
+            currencies = []
+
+            @cached_response(ttl=60, convert_prices=convert_ticket_prices)
+            def fetch(self, origin, currency=Currency.RUB):
+                Api.currencies.append(currency)
+                return {'success': True, 'data': [{'origin': origin, 'price': 8000.0}]}
+
+        Api.fetch.response_cache.clear()
+        with patch('api_collector.utils.response_cache.fx_table', fx_table):
+            self.assertEqual(Api().fetch('MOW', currency=Currency.USD)['data'][0],
+                             {'origin': 'MOW', 'price': 100.0, 'currency': 'usd'})
+            self.assertEqual(Api().fetch('MOW', currency=Currency.EUR)['data'][0]['price'], 80.0)
+            self.assertEqual(Api().fetch('MOW')['data'][0]['price'], 8000.0)
+            # one response in rubles serves every currency and is not changed by conversion
+            self.assertEqual(Api.currencies, [Currency.RUB])
+
+            # too old rates are not used, the response is requested in the currency
+            fx_table.set_rates({'usd': 80.0}, updated_at=0)
+            mock_requests.get.side_effect = Exception('no connection')
+            Api().fetch('MOW', currency=Currency.USD)
+            self.assertEqual(Api.currencies, [Currency.RUB, Currency.USD])
+
+    @patch('api_collector.utils.currency.requests')
+    def test_fx_table_refresh(self, mock_requests):
+        release = threading.Event()
+
+        def get(url, timeout):
+            release.wait(5)
+            return SimpleNamespace(status_code=200, json=lambda: {'usd': 100.0})
+
+        mock_requests.get.side_effect = get
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'fx_rates.json')
+            fx_table = FxTable(path=path, ttl=60)
+            fx_table.set_rates({'usd': 80.0}, updated_at=time.time() - 120)
+            # stale rates are refreshed in the background, readers keep the previous rates meanwhile
+            self.assertEqual(fx_table.rate('usd'), 1 / 80.0)
+            refresh_thread = fx_table.refresh_thread
+            self.assertEqual(fx_table.rate('usd'), 1 / 80.0)
+            release.set()
+            refresh_thread.join()
+            self.assertEqual(mock_requests.get.call_count, 1)
+            self.assertTrue(mock_requests.get.call_args.args[0].startswith('https://'))
+            self.assertEqual(fx_table.rate('usd'), 1 / 100.0)
+            # the saved table is loaded once without requests
+            fx_table = FxTable(path=path, ttl=60)
+            self.assertEqual(fx_table.rate('usd'), 1 / 100.0)
+            self.assertEqual(fx_table.rate('eur'), None)
+            self.assertIsNone(fx_table.refresh_thread)
+            self.assertEqual(mock_requests.get.call_count, 1)
+
+    def test_decode_hotel_responses(self):
+        content = json.dumps([{
+            'locationId': 1, 'hotelId': 2, 'priceFrom': 1000.0, 'priceAvg': 1200.0, 'pricePercentile': {'3': 900.0},
+            'stars': 4, 'hotelName': 'Hotel', 'photos': [{'url': '/photo'}] * 10,
+            'location': {'name': 'Kazan', 'country': 'Russia', 'state': None, 'geo': {'lat': 55.7, 'lon': 49.1}}
+        }]).encode()
+        hotels = decode_hotel_prices(content)
+        self.assertEqual(hotels, [{
+            'locationId': 1, 'hotelId': 2, 'priceFrom': 1000.0, 'priceAvg': 1200.0, 'stars': 4, 'hotelName': 'Hotel',
+            'location': {'name': 'Kazan', 'country': 'Russia'}
+        }])
+        self.assertEqual(Hotel(hotels[0]).hotel_city_name, 'Kazan')
+
+        # the public method keeps the full schema, slim records are requested explicitly
+        with patch('api_collector.hotels.hotel_api.requests.get',
+                   return_value=SimpleNamespace(status_code=200, content=content)):
+            self.assertEqual(HotelApi().fetch_hotel_prices('KZN', '2024-07-01', '2024-07-04'), json.loads(content))
+            self.assertEqual(HotelApi().fetch_hotel_prices('KZN', '2024-07-01', '2024-07-04', slim=True), hotels)
+        self.assertEqual(convert_hotel_prices(json.loads(content), 0.01, 'usd')[0]['pricePercentile'], {'3': 9.0})
+        self.assertNotIn('pricePercentile', convert_hotel_prices(hotels, 0.01, 'usd')[0])
+
+        content = json.dumps({'hotels': [{'id': 2, 'propertyType': 1, 'stars': 4, 'pois': [{'id': 1}] * 10,
+                                          'photos': [{'url': '/photo'}] * 10, 'facilities': [1, 2],
+                                          'location': {'lat': 55.7, 'lon': 49.1}, 'distance': 1.5}]}).encode()
+        self.assertEqual(decode_hotel_list(content), {'hotels': [{'id': 2, 'propertyType': 1, 'stars': 4,
+                                                                  'location': {'lat': 55.7, 'lon': 49.1},
+                                                                  'distance': 1.5, 'facilities': [1, 2],
+                                                                  'shortFacilities': None}],
+                                                      'pois': [{'id': 1, 'name': None, 'category': None,
+                                                                'location': None, 'geom': None}]})
+
+    def test_iterate_truncated_json_array(self):
+        content = b'[{"id": 1}, {"id": 2}, {"id": 3}]'
+        chunks = [content[start:start + 5] for start in range(0, len(content), 5)]
+        self.assertEqual(list(iterate_json_array(chunks)), [{'id': 1}, {'id': 2}, {'id': 3}])
+        self.assertEqual(list(iterate_json_array([b' [ ', b']'])), [])
+        # the stream ends before the closing bracket, e.g. the connection is dropped
+        for truncated in (content[:-1], content[:-3], b'[', b'[{"id": 1}, '):
+            elements = []
+            with self.assertRaises(ValueError):
+                for element in iterate_json_array([truncated]):
+                    elements.append(element)
+            self.assertLessEqual(len(elements), 2)
+        with self.assertRaises(ValueError):
+            list(iterate_json_array([b'']))
+
+    @patch('api_collector.utils.media_cache.requests.get')
+    def test_media_cache(self, mock_get):
+        images = {'/1': b'a' * 100, '/2': b'a' * 100, '/3': b'b' * 150}
+
+        def get(url, headers, timeout):
+            if headers.get('If-None-Match') == f'"{url}"':
+                return SimpleNamespace(status_code=304, content=b'', headers={})
+            return SimpleNamespace(status_code=200, content=images[url], headers={'ETag': f'"{url}"'})
+        mock_get.side_effect = get
+        with tempfile.TemporaryDirectory() as directory:
+            cache = MediaCache(directory, quota=300, max_age=60)
+            first = cache.fetch('hotel/1/1', '/1', path=os.path.join(directory, 'hotel1', 'photo1.avif'))
+            second = cache.fetch('hotel/2/1', '/2')
+            # the same image of two hotels is stored once
+            self.assertEqual(cache.size(), 100)
+            self.assertEqual(second, cache.blob_path(hashlib.sha256(images['/2']).hexdigest()))
+            with open(first, 'rb') as file:
+                self.assertEqual(file.read(), images['/1'])
+            # fresh images are used without requests, old images are revalidated
+            cache.fetch('hotel/1/1', '/1')
+            self.assertEqual(mock_get.call_count, 2)
+            with patch('api_collector.utils.media_cache.time.time', return_value=time.time() + 120):
+                cache.fetch('hotel/1/1', '/1')
+            self.assertEqual(mock_get.call_args.kwargs['headers'], {'If-None-Match': '"/1"'})
+            # the least recently used image is removed when the quota is exceeded
+            cache.fetch('logo/UN', '/3')
+            cache.fetch('logo/UT', '/3')
+            self.assertEqual(cache.size(), 250)
+            cache.quota = 200
+            cache.evict()
+            self.assertEqual(cache.size(), 100)
+            self.assertTrue(os.path.exists(first))
+            cache.fetch('logo/UN', '/3')
+            self.assertEqual(mock_get.call_args.kwargs['headers'], {})
+            self.assertEqual(mock_get.call_count, 6)
+
+        # copies made where hard links are not supported count towards the quota and are evicted
+        with tempfile.TemporaryDirectory() as directory, \
+                patch('api_collector.utils.media_cache.os.link', side_effect=OSError('not supported')):
+            cache = MediaCache(directory, quota=300, max_age=60)
+            first = cache.fetch('hotel/1/1', '/1', path=os.path.join(directory, 'hotel1', 'photo1.avif'))
+            self.assertFalse(os.path.samefile(first, cache.blob_path(hashlib.sha256(images['/1']).hexdigest())))
+            self.assertEqual(cache.size(), 200)
+            # the copy at the same path is replaced, not counted twice
+            cache.fetch('hotel/1/1', '/1', path=first)
+            self.assertEqual(cache.size(), 200)
+            third = cache.fetch('hotel/3/1', '/3', path=os.path.join(directory, 'hotel3', 'photo1.avif'))
+            self.assertEqual(cache.size(), 300)
+            self.assertFalse(os.path.exists(first))
+            self.assertTrue(os.path.exists(third))
+
+    @patch('api_collector.utils.media_cache.requests.get')
+    def test_fetch_airline_logos(self, mock_get):
+        mock_get.side_effect = lambda url, headers, timeout: SimpleNamespace(
+            status_code=404 if 'XX' in url else 200, content=url.encode(), headers={})
+        with tempfile.TemporaryDirectory() as directory, \
+                patch('api_collector.air_tickets.air_tickets_api.media_cache', MediaCache(directory)), \
+                patch('api_collector.air_tickets.air_tickets_api.data_directory_path', return_value=directory):
+            # airlines of found tickets repeat, tickets which are not found have no airline
+            airlines = ['SU', 'S7', 'SU', 'XX', None]
+            logos = AirTicketsApi().fetch_airline_logos(airlines)
+            self.assertEqual(list(logos), ['SU', 'S7'])
+            self.assertEqual(logos['S7'], os.path.join(directory + '/photos/airline_logos', 'S7.png'))
+            self.assertTrue(os.path.exists(logos['S7']))
+            self.assertEqual(mock_get.call_count, 3)
+            # cached logos are returned without requests, only the failed logo is requested again
+            self.assertEqual(AirTicketsApi().fetch_airline_logos(airlines), logos)
+            self.assertEqual(mock_get.call_count, 4)
+
+    def test_thumbnail_pipeline(self):
+        pipeline = ThumbnailPipeline(max_workers=1)
+        self.addCleanup(pipeline.shutdown)
+        with tempfile.TemporaryDirectory() as directory:
+            photo_path = os.path.join(directory, 'photo1.png')
+            Image.new('RGB', (800, 520), 'blue').save(photo_path)
+            broken_path = os.path.join(directory, 'photo2.avif')
+            with open(broken_path, 'wb') as file:
+                file.write(b'not an image')
+            variants = pipeline.generate([photo_path, broken_path])
+            self.assertEqual(list(variants), [photo_path])
+            self.assertEqual(variants[photo_path]['thumb'], os.path.join(directory, 'photo1.thumb.jpg'))
+            with Image.open(variants[photo_path]['thumb']) as thumb:
+                self.assertEqual((thumb.format, thumb.size), ('JPEG', (320, 208)))
+            with Image.open(variants[photo_path]['medium']) as medium:
+                self.assertEqual((medium.format, medium.size), ('WEBP', (640, 416)))
+            # variants newer than the original are not made again
+            modified_at = os.path.getmtime(variants[photo_path]['thumb'])
+            self.assertEqual(make_variants(photo_path), variants[photo_path])
+            self.assertEqual(os.path.getmtime(variants[photo_path]['thumb']), modified_at)
+
+    def test_hotel_type_catalog(self):
+        with route_module._hotel_indexes_lock:
+            route_module._hotel_indexes.clear()
+        fetch = Mock(return_value={'1': 'Hotel', '7': 'Hostel', '12': 'Villa'})
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'hotels', 'hotels_type.json')
+            catalog = Catalog('hotels_type.json', fetch, path=path)
+            # nothing is saved yet, so the catalog is empty and stale
+            self.assertIsNone(catalog.name(1))
+            Catalogs([catalog]).refresh_stale()
+            self.assertEqual((catalog.name(7), catalog.id('hostel'), catalog.resolve([1, 'Villa', 'Castle'])),
+                             ('Hostel', 7, (1, 12)))
+            self.assertEqual(Catalogs([catalog]).refresh_stale(), 0)
+            # the saved catalog is loaded without requests
+            catalog = Catalog('hotels_type.json', fetch, path=path)
+            self.assertEqual(catalog.name('12'), 'Villa')
+            self.assertEqual(fetch.call_count, 1)
+            with patch('api_collector.route.route.hotel_types', catalog), \
+                    patch('api_collector.route.route.load_hotel_index') as mock_load_hotel_index:
+                mock_load_hotel_index.return_value = HotelIndex([{'id': 1, 'propertyType': 7, 'stars': 2},
+                                                                 {'id': 2, 'propertyType': 1, 'stars': 3}])
+                self.assertEqual(route_module.find_filtered_hotels(locationId=1), [2])
+                self.assertEqual(route_module.find_filtered_hotels(locationId=1, filter=('Hostel',)), [1])
+                self.assertEqual(route_module.find_filtered_hotels(locationId=1, filter=('Castle',)), [])
+
+
 if __name__ == '__main__':
     main()
@@ -1,10 +1,105 @@
+import asyncio
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import patch
-from api_collector.route.route import get_hotel, get_ticket, find_top_routes, Hotel, Ticket
+from datetime import datetime, timedelta
+from PIL import Image
+from unittest.mock import Mock, mock_open, patch
+from api_collector.route.route import get_hotel, get_ticket, find_top_routes, combine_routes, Hotel, Ticket
+from api_collector.route import discovery
+from api_collector.route.discovery import clear_discovery_caches
+from api_collector.route.route import filter_tickets, select_tickets, fetch_alternative_tickets, \
+    add_alternative_routes, Route, filter_hotels, select_hotels
+from api_collector.route.candidates import HotelIndex
+from api_collector.route.route_cache import route_cache, normalize_budget, price_freshness, RouteCache
+from api_collector.route.async_route import find_top_routes_async, stream_top_routes, fetch_hotel_photo_files_async, \
+    iterate_ticket_pages_async
+from api_collector.route.prefetch import RoutePrefetcher
+from api_collector.route.pagination import page_size_history
+from api_collector.route.batch import plan_routes_batch
+from api_collector.route.warmer import CacheWarmer, CALENDAR_COMPACT_INTERVAL
+from api_collector.route import route as route_module
+from api_collector.hotels.hotel_enums import CollectionType
+from api_collector.hotels.location_index import LocationIndex, haversine
+from api_collector.hotels.photo_ids import PhotoIdStore, PHOTO_IDS_MAX_AGE
+from api_collector.utils.response_cache import clear_response_caches
+from api_collector.utils.thumbnails import ThumbnailPipeline
+from api_collector.utils.decoding import iterate_hotel_prices
+from api_collector.air_tickets.air_tickets_api import AirTicketsApi
+from api_collector.hotels.hotel_api import HotelApi, UpstreamError
+
+
+def clear_caches():
+    """
+    Clears caches kept by modules between calls, so every test starts with empty caches
+    """
+    route_cache.clear()
+    page_size_history.clear()
+    clear_response_caches()
+    clear_discovery_caches()
+    with route_module._photo_ids_lock:
+        route_module._photo_ids_cache.clear()
+    with route_module._collection_misses_lock:
+        route_module._collection_misses.clear()
+    route_module.location_ids.clear()
+    with route_module._hotel_indexes_lock:
+        route_module._hotel_indexes.clear()
+
+
+def ticket_json(**fields) -> dict:
+    """
+    Returns a direct MOW - LED ticket as it comes from the tickets API, the given fields replace the defaults
+    """
+    ticket = {
+        'origin': 'MOW', 'destination': 'LED', 'origin_airport': 'SVO', 'destination_airport': 'LED',
+        'price': 3000.0, 'airline': 'SU', 'flight_number': '10', 'departure_at': '2024-07-01',
+        'return_at': '2024-07-04', 'transfers': 0, 'return_transfers': 0, 'duration': 180, 'duration_to': 90,
+        'duration_back': 90, 'link': '/ticket'
+    }
+    ticket.update(fields)
+    return ticket
+
+
+def hotel_json(**fields) -> dict:
+    """
+    Returns a Saint Petersburg hotel as it comes from the hotels API, the given fields replace the defaults
+    """
+    hotel = {
+        'locationId': 1, 'hotelId': 7, 'priceFrom': 1000.0, 'priceAvg': 1000.0, 'pricePercentile': {},
+        'stars': 3, 'hotelName': 'Hotel',
+        'location': {'name': 'Saint Petersburg', 'country': 'Russia', 'state': None, 'geo': {}}
+    }
+    hotel.update(fields)
+    return hotel
+
+
+def ticket_pages(tickets, page_size=None):
+    """
+    Returns a mocked 'fetch_cheapest_tickets' which serves the tickets by pages of the requested limit,
+    or by pages of 'page_size' if the upstream ignores the limit
+    """
+    def fetch_cheapest_tickets(page, limit=None, **kwargs):
+        size = page_size or limit
+        return {'success': True, 'data': tickets[(page - 1) * size:page * size]}
+
+    return fetch_cheapest_tickets
 
 
 class TestRouteCollector(unittest.TestCase):
 
+    def setUp(self):
+        clear_caches()
+        # locations and photo ids are saved in memory instead of the data directory
+        for name, store in (('location_index', LocationIndex(':memory:')), ('photo_id_store', PhotoIdStore(':memory:'))):
+            patcher = patch(f'api_collector.route.route.{name}', store)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
     @patch('api_collector.route.route.AirTicketsApi')  # Mock the AirTicketsApi class
     def test_get_ticket_with_budget(self, MockAirTicketsApi):
         # Set up the mock response
@@ -66,6 +161,43 @@ class TestRouteCollector(unittest.TestCase):
         self.assertEqual(tickets[0].airline, 'AA')
 
 
+    @patch('api_collector.route.route.AirTicketsApi')
+    def test_adaptive_page_size(self, MockAirTicketsApi):
+        tickets = [ticket_json(price=1000.0 + number, flight_number=str(number)) for number in range(40)]
+        mock_fetch = MockAirTicketsApi.return_value.fetch_cheapest_tickets
+        mock_fetch.side_effect = ticket_pages(tickets)
+        search = dict(origin='MOW', destination='LED', departure_at='2024-07-01', return_at='2024-07-04')
+
+        # unknown route: default pages until the page which is not full
+        self.assertEqual(len(route_module.fetch_ticket_candidates(**search)), 40)
+        self.assertEqual(mock_fetch.call_count, 2)
+        # known route: all tickets in a larger page, the page which is not full is not the last one
+        # until the upstream is known to fill pages of that size
+        mock_fetch.reset_mock()
+        self.assertEqual(len(route_module.fetch_ticket_candidates(**search)), 40)
+        self.assertEqual(mock_fetch.call_count, 2)
+        self.assertEqual(mock_fetch.call_args_list[0].kwargs['limit'], 50)
+        # another route has filled a page of that size: all tickets in a single request
+        page_size_history.is_last_page(50, 50)
+        mock_fetch.reset_mock()
+        self.assertEqual(len(route_module.fetch_ticket_candidates(**search)), 40)
+        self.assertEqual(mock_fetch.call_count, 1)
+        # only the cheapest ticket is needed: a single small page
+        mock_fetch.reset_mock()
+        ticket = get_ticket(**search, cheapest_only=True)[0]
+        self.assertEqual(ticket.ticket_price, 1000.0)
+        self.assertEqual(mock_fetch.call_args.kwargs['limit'], 1)
+
+    @patch('api_collector.route.route.AirTicketsApi')
+    def test_capped_page_size(self, MockAirTicketsApi):
+        tickets = [ticket_json(price=1000.0 + number, flight_number=str(number)) for number in range(45)]
+        mock_fetch = MockAirTicketsApi.return_value.fetch_cheapest_tickets
+        # the upstream ignores the limit and returns pages of 20 tickets
+        mock_fetch.side_effect = ticket_pages(tickets, page_size=20)
+        # pages which are not full are not the last ones, walking stops at the empty page
+        self.assertEqual(len(route_module.fetch_ticket_pages('MOW', 'LED', '2024-07-01', '2024-07-04')), 45)
+        self.assertEqual(mock_fetch.call_count, 4)
+
     @patch('api_collector.route.route.HotelApi')
     @patch('api_collector.route.route.find_filtered_hotels')
     def test_get_hotel_with_budget(self, mock_find_filtered_hotels, mock_HotelApi):
@@ -154,6 +286,172 @@ class TestRouteCollector(unittest.TestCase):
         self.assertEqual(hotels[0].hotel_id, 40972234)
         self.assertEqual(hotels[0].hotel_location_id, 12186)
 
+    @patch('api_collector.route.route.HotelApi')
+    @patch('api_collector.route.route.find_filtered_hotels')
+    def test_get_hotel_streaming(self, mock_find_filtered_hotels, mock_HotelApi):
+        random_generator = random.Random(1)
+        hotels = [{'locationId': 1, 'hotelId': hotel_id, 'priceFrom': float(random_generator.randint(1, 50) * 100),
+                   'priceAvg': 0.0, 'stars': 3, 'hotelName': 'Hotel', 'location': {'name': 'Kazan', 'country': 'Russia'}}
+                  for hotel_id in range(300)]
+        mock_HotelApi.return_value.iterate_hotel_prices.side_effect = lambda **kwargs: iter(hotels)
+        mock_find_filtered_hotels.return_value = list(range(0, 300, 2))
+        allowed_hotels = filter_hotels(hotels, range(0, 300, 2))
+
+        # the bounded window chooses the same hotels as the full sorted list
+        for budget in (None, 50, 1000, 2550, 4900, 10000):
+            for number_of_hotels in (1, 2, 5):
+                window = route_module.stream_hotel_window(location='KZN', check_in='2024-07-01',
+                                                          check_out='2024-07-04', budget=budget,
+                                                          number_of_hotels=number_of_hotels)
+                self.assertLessEqual(len(window), 3 * number_of_hotels)
+                expected = [hotel.hotel_id for hotel in select_hotels(allowed_hotels, budget, number_of_hotels)]
+                chosen = get_hotel(location='KZN', check_in='2024-07-01', check_out='2024-07-04', budget=budget,
+                                   number_of_hotels=number_of_hotels, streaming=True)
+                self.assertEqual([hotel.hotel_id for hotel in chosen], expected)
+        mock_find_filtered_hotels.assert_called_with(locationId=1, min_stars=0, amenities=(), max_distance=None,
+                                                     poi=None)
+
+        # the response is parsed while it arrives
+        content = json.dumps(hotels).encode()
+        streamed = list(iterate_hotel_prices(content[start:start + 100] for start in range(0, len(content), 100)))
+        self.assertEqual(streamed, hotels)
+
+    @patch('api_collector.route.route.HotelApi')
+    @patch('api_collector.route.route.find_filtered_hotels')
+    def test_get_hotel_from_collections(self, mock_find_filtered_hotels, mock_HotelApi):
+        hotel_api = mock_HotelApi.return_value
+        # collections are tried only for locations of the local index
+        route_module.location_index.add_locations([{'id': '12186', 'cityName': 'Ryazan', 'countryName': 'Russia'}])
+        hotel_api.fetch_hotel_collections.return_value = {'cheaphotel': [
+            {'hotel_id': hotel_id, 'name': f'Hotel {hotel_id}', 'stars': 3,
+             'last_price_info': {'price': price, 'search_params': {'checkIn': '2024-07-01', 'checkOut': check_out}}}
+            for hotel_id, price, check_out in ((1, 3000.0, '2024-07-04'), (2, 1000.0, '2024-07-04'),
+                                               (3, 2000.0, '2024-07-04'), (4, 500.0, '2024-07-05'))]}
+        hotel_api.fetch_hotel_prices.return_value = [{
+            'locationId': 12186, 'hotelId': 5, 'priceFrom': 9000.0, 'priceAvg': 9000.0, 'stars': 5,
+            'hotelName': 'Hotel 5', 'location': {'name': 'Ryazan', 'country': 'Russia'}}]
+        mock_find_filtered_hotels.return_value = [1, 2, 4, 5]
+
+        # the cheapest hotel of the same dates is taken from the collection
+        hotels = get_hotel(location='Ryazan', check_in='2024-07-01', check_out='2024-07-04')
+        self.assertEqual((hotels[0].hotel_id, hotels[0].hotel_price_from, hotels[0].hotel_city_name),
+                         (2, 1000.0, 'Ryazan'))
+        self.assertEqual(hotel_api.fetch_hotel_collections.call_args.kwargs['collection_type'],
+                         CollectionType.CHEAP)
+        hotel_api.fetch_hotel_prices.assert_not_called()
+        # the budget window is inside the collection
+        hotels = get_hotel(location='Ryazan', check_in='2024-07-01', check_out='2024-07-04', budget=2500)
+        self.assertEqual(hotels[0].hotel_id, 2)
+        hotel_api.fetch_hotel_prices.assert_not_called()
+
+        # all hotels of the collection fit the budget, so the full price list is scanned
+        hotels = get_hotel(location='Ryazan', check_in='2024-07-01', check_out='2024-07-04', budget=10000)
+        self.assertEqual(hotels[0].hotel_id, 5)
+        # star collections are used for required stars
+        get_hotel(location='Ryazan', check_in='2024-07-01', check_out='2024-07-04', min_stars=4)
+        calls = hotel_api.fetch_hotel_collections.call_args_list[-2:]
+        self.assertEqual([call.kwargs['collection_type'] for call in calls],
+                         [CollectionType.FOUR_STARS, CollectionType.FIVE_STARS])
+        hotel_api.search_hotel_or_location.assert_not_called()
+
+        # failed collections fall back to the full price list, other errors are not hidden
+        hotel_api.fetch_hotel_collections.side_effect = UpstreamError('Failed to fetch hotel collections')
+        self.assertEqual(get_hotel(location='Ryazan', check_in='2024-07-01', check_out='2024-07-04')[0].hotel_id, 5)
+        hotel_api.fetch_hotel_collections.side_effect = KeyError('cheaphotel')
+        with self.assertRaises(KeyError):
+            get_hotel(location='Ryazan', check_in='2024-07-01', check_out='2024-07-04')
+
+        # collections without prices of the dates are not requested again for the location
+        hotel_api.fetch_hotel_collections.side_effect = None
+        calls = hotel_api.fetch_hotel_collections.call_count
+        for _ in range(2):
+            hotels = get_hotel(location='Ryazan', check_in='2024-08-01', check_out='2024-08-04')
+            self.assertEqual(hotels[0].hotel_id, 5)
+        self.assertEqual(hotel_api.fetch_hotel_collections.call_count, calls + 1)
+        # unknown locations are not searched for collections
+        get_hotel(location='Tula', check_in='2024-07-01', check_out='2024-07-04')
+        self.assertEqual(hotel_api.fetch_hotel_collections.call_count, calls + 1)
+
+    @patch('api_collector.route.route.HotelApi')
+    def test_location_index(self, mock_HotelApi):
+        index = LocationIndex(':memory:')
+        index.add_locations([{'id': '12153', 'cityName': 'Moscow', 'fullName': 'Moscow, Russia', 'countryName': 'Russia',
+                              'countryCode': 'RU', 'iata': ['MOW'], 'hotelsCount': 3000,
+                              'location': {'lat': '55.75', 'lon': '37.62'}},
+                             {'id': '12196', 'cityName': 'Tver', 'fullName': 'Tver, Russia', 'countryName': 'Russia',
+                              'countryCode': 'RU', 'iata': [], 'hotelsCount': 100,
+                              'location': {'lat': '56.86', 'lon': '35.9'}}], query='Москва')
+        index.add_hotel_list(12186, [{'id': 1, 'location': {'lat': 54.6, 'lon': 39.7}},
+                                     {'id': 2, 'location': {'lat': 54.64, 'lon': 39.74}}])
+
+        self.assertEqual(index.find('mow')['cityName'], 'Moscow')
+        self.assertEqual(index.find('  moscow ')['id'], '12153')
+        self.assertEqual(index.find('москва')['iata'], ['MOW'])
+        self.assertIsNone(index.find('LED'))
+        # nearest locations are found by the grid of coordinates
+        nearest = index.nearest(55.6, 37.5, max_distance=300, number=3)
+        self.assertEqual([location['id'] for _, location in nearest], ['12153', '12196', '12186'])
+        self.assertLess(nearest[0][0], 20)
+        self.assertEqual(index.nearest(55.6, 37.5, max_distance=100), nearest[:1])
+        self.assertAlmostEqual(index.get(12186)['location']['lat'], 54.62)
+
+        # the second resolution of the location is a local lookup
+        mock_HotelApi.return_value.search_hotel_or_location.return_value = {'results': {'locations': [
+            {'id': '12209', 'cityName': 'Kazan', 'fullName': 'Kazan, Russia', 'countryName': 'Russia',
+             'iata': ['KZN'], 'location': {'lat': 55.79, 'lon': 49.12}}]}}
+        self.assertEqual(route_module.search_location('KZN')['id'], '12209')
+        self.assertEqual(route_module.search_location('KZN')['cityName'], 'Kazan')
+        self.assertEqual(route_module.known_location_id('kazan'), 12209)
+        self.assertEqual(mock_HotelApi.return_value.search_hotel_or_location.call_count, 1)
+
+    @patch('api_collector.route.route.hotel_list_age', return_value=0)
+    @patch('api_collector.route.route.HotelApi')
+    def test_hotel_amenity_filters(self, mock_HotelApi, mock_hotel_list_age):
+        hotels = [{'id': hotel_id, 'propertyType': 1 if hotel_id % 5 else 7, 'stars': hotel_id // 7 % 6,
+                   'shortFacilities': ['wifi'] + (['pool'] if hotel_id % 3 == 0 else []) +
+                                      (['pets'] if hotel_id % 4 == 0 else []),
+                   'facilities': list(range(hotel_id % 100))} for hotel_id in range(1000)]
+        index = HotelIndex(hotels)
+        # 'pool' + 'pets' + 4 stars, facility ids are used as well as names
+        expected = [hotel['id'] for hotel in hotels if hotel['propertyType'] in (1, 2, 3, 12) and hotel['stars'] >= 4
+                    and {'pool', 'pets'} <= set(hotel['shortFacilities']) and 70 in hotel['facilities']]
+        self.assertEqual(index.filter((1, 2, 3, 12), min_stars=4, amenities=('Pool', 'pets', 70)), expected)
+        self.assertGreater(len(expected), 0)
+        self.assertEqual(index.filter(amenities=('spa',)), [])
+        self.assertEqual(len(index.filter()), 1000)
+
+        # the index of the saved hotel list is built once
+        with patch('api_collector.route.route.open', mock_open(read_data=json.dumps({'hotels': hotels}).encode())) \
+                as mocked_open, patch('api_collector.route.route.os.path.getmtime', return_value=1.0), \
+                patch('api_collector.route.route.data_directory_path', return_value='/data'):
+            route_module._hotel_indexes.clear()
+            self.assertEqual(route_module.find_filtered_hotels(locationId=1, min_stars=4, amenities=('pool', 'pets', 70)),
+                             expected)
+            self.assertEqual(len(route_module.find_filtered_hotels(locationId=1)), 800)
+            self.assertEqual(mocked_open.call_count, 1)
+
+    def test_hotel_spatial_filters(self):
+        random.seed(5)
+        hotels = [{'id': hotel_id, 'propertyType': 1, 'stars': hotel_id % 6, 'distance': round(hotel_id / 100, 2),
+                   'location': {'lat': 55.75 + random.uniform(-0.2, 0.2), 'lon': 37.6 + random.uniform(-0.3, 0.3)}}
+                  for hotel_id in range(2000)]
+        pois = [{'id': 7, 'name': 'Red Square', 'category': 'landmark',
+                 'geom': {'type': 'Point', 'coordinates': [37.62, 55.754]}}]
+        index = HotelIndex(hotels + [{'id': 9999, 'propertyType': 1, 'stars': 5}], pois)
+
+        def distance(hotel):
+            return haversine(55.754, 37.62, hotel['location']['lat'], hotel['location']['lon'])
+
+        # hotels within 3 km of the place of interest ranked by distance, the grid gives the same as the full pass
+        expected = sorted((hotel for hotel in hotels if distance(hotel) <= 3 and hotel['stars'] >= 4), key=distance)
+        self.assertEqual(index.filter(min_stars=4, max_distance=3, poi='red square'),
+                         [hotel['id'] for hotel in expected])
+        self.assertEqual(index.filter(min_stars=4, max_distance=3, poi=7), [hotel['id'] for hotel in expected])
+        self.assertEqual(len(index.filter(poi='Red Square')), 2000)
+        self.assertEqual(index.filter(poi='unknown'), [])
+        # the distance to the city center is given by the hotel list
+        self.assertEqual(index.filter(min_stars=5, max_distance=0.5), [5, 11, 17, 23, 29, 35, 41, 47])
+
     @patch('api_collector.route.route.get_ticket')
     @patch('api_collector.route.route.get_hotel')
     def test_find_top_routes_with_budget(self, mock_get_hotel, mock_get_ticket):
@@ -202,6 +500,604 @@ class TestRouteCollector(unittest.TestCase):
         self.assertEqual(routes[0].ticket.ticket_price, 150.0)
         self.assertEqual(routes[0].hotel.hotel_price_from, 100.0)
 
+    @patch('api_collector.route.route.save_hotel_photo_urls')
+    @patch('api_collector.route.route.fetch_alternative_tickets', return_value=[])
+    @patch('api_collector.route.route.get_ticket')
+    @patch('api_collector.route.route.get_hotel')
+    def test_find_top_routes_deadline(self, mock_get_hotel, mock_get_ticket, mock_alternatives, mock_save_photos):
+        mock_get_ticket.return_value = [Ticket(ticket=ticket_json())]
+        # hotels do not arrive until the search has returned
+        release = threading.Event()
+        mock_get_hotel.side_effect = lambda **kwargs: [Hotel(hotel=None)] if release.wait(5) else None
+        try:
+            routes = find_top_routes(origin='MOW', destination='LED', departure_at='2024-07-01',
+                                     return_at='2024-07-04', deadline=0.05)
+        finally:
+            release.set()
+
+        # the route is built from the ticket which has arrived and is not cached
+        self.assertEqual(len(routes), 1)
+        self.assertTrue(routes[0].partial)
+        self.assertEqual(routes[0].ticket.ticket_price, 3000.0)
+        self.assertFalse(routes[0].hotel.found)
+        # the hotel is requested once, later steps do not wait for the passed deadline
+        self.assertEqual(mock_get_hotel.call_count, 1)
+        mock_save_photos.assert_not_called()
+        self.assertEqual(len(route_cache.cache), 0)
+
+    @patch('api_collector.route.route.save_hotel_photo_urls')
+    @patch('api_collector.route.route.fetch_alternative_tickets', return_value=[])
+    @patch('api_collector.route.route.get_ticket')
+    @patch('api_collector.route.route.get_hotel')
+    def test_find_top_routes_budget_bucket(self, mock_get_hotel, mock_get_ticket, mock_alternatives,
+                                           mock_save_photos):
+        mock_get_ticket.return_value = [Ticket(ticket=ticket_json(price=150.0))]
+        mock_get_hotel.return_value = [Hotel(hotel=hotel_json(priceFrom=140.0, priceAvg=140.0))]
+        search = {'origin': 'MOW', 'destination': 'LED', 'departure_at': '2024-07-01', 'return_at': '2024-07-04'}
+
+        # the search uses the real budget, not the lower bound of its bucket
+        routes = find_top_routes(**search, budget=300)
+        self.assertEqual(mock_get_hotel.call_args.kwargs['budget'], 150.0)
+        self.assertEqual([route.calculate_total_cost() for route in routes], [290])
+        calls = mock_get_ticket.call_count
+        # a close budget which the route fits is served from the cache
+        routes = find_top_routes(**search, budget=295)
+        self.assertEqual([(route.calculate_total_cost(), route.budget) for route in routes], [(290, 295)])
+        self.assertEqual(mock_get_ticket.call_count, calls)
+        # the route does not fit a lower budget of the same bucket, so the search is made again
+        self.assertEqual(RouteCache.make_key(**search, budget=289), RouteCache.make_key(**search, budget=300))
+        routes = find_top_routes(**search, budget=289)
+        self.assertGreater(mock_get_ticket.call_count, calls)
+        # nothing fits the budget, so the search returns the cheapest route
+        self.assertEqual([(route.calculate_total_cost(), route.budget) for route in routes], [(290, 289)])
+        # a negative budget does not break the search
+        routes = find_top_routes(**search, budget=-100)
+        self.assertEqual([(route.calculate_total_cost(), route.budget) for route in routes], [(290, -100)])
+
+    def test_combine_routes_removes_duplicates_by_key(self):
+        # every call creates new objects from equal json, they are still the same ticket and hotel
+        routes = combine_routes(origin='MOW', destination='LED', departure_at='2024-07-01', return_at='2024-07-04',
+                                budget=None, route_number=3,
+                                choose_tickets=lambda ticket_budget=None, number=1: [Ticket(ticket_json())],
+                                choose_hotels=lambda hotel_budget=None, number=1: [Hotel(hotel_json())])
+
+        self.assertEqual(len(routes), 1)
+        self.assertEqual(routes[0].ticket.key, ('10', '2024-07-01'))
+        self.assertEqual(routes[0].hotel.key, 7)
+        # raw json is not kept and rendering is computed once
+        self.assertFalse(hasattr(routes[0].ticket, '__dict__'))
+        self.assertIs(routes[0].to_string_en(), routes[0].to_string_en())
+        self.assertIsNone(Ticket(ticket=None).key)
+
+    def test_filter_and_select_tickets(self):
+        tickets = [ticket_json(
+            price=price, airline=airline, flight_number=str(number), transfers=transfers, duration=2 * duration,
+            duration_to=duration, duration_back=duration
+        ) for number, (price, airline, transfers, duration) in enumerate([
+            (5000.0, 'SU', 0, 90), (1000.0, 'SU', 2, 90), (3000.0, 'S7', 0, 90), (2000.0, 'SU', 1, 600),
+            (4000.0, 'SU', 1, 120), (6000.0, 'SU', 0, 100)
+        ])]
+
+        candidates = filter_tickets(tickets, max_transfers=1, airlines=('SU',), max_flight_duration=5)
+
+        # too many transfers, other airline and too long flight are filtered out, the rest is sorted by price
+        self.assertEqual([ticket['price'] for ticket in candidates.to_list()], [4000.0, 5000.0, 6000.0])
+        # the most expensive ticket within budget is in the middle of the window
+        selected = select_tickets(candidates, budget=5500, number_of_tickets=3)
+        self.assertEqual([ticket.ticket_price for ticket in selected], [4000.0, 5000.0, 6000.0])
+        selected = select_tickets(candidates, budget=5500, number_of_tickets=1)
+        self.assertEqual([ticket.ticket_price for ticket in selected], [5000.0])
+        # nothing fits the budget, the cheapest ticket is chosen
+        self.assertEqual(select_tickets(candidates, budget=100)[0].ticket_price, 4000.0)
+        self.assertFalse(select_tickets(filter_tickets([]))[0].found)
+
+    def test_route_cache_key_and_freshness(self):
+        # close budgets share a bucket, the bucket bound never exceeds the budget
+        self.assertEqual(RouteCache.make_key('MOW', 'LED', budget=30000), RouteCache.make_key('MOW', 'LED', budget=30500))
+        self.assertLessEqual(normalize_budget(30000), 30000)
+        self.assertIsNone(normalize_budget("None"))
+        # budgets below 1, negative ones too, share one bucket
+        self.assertEqual([normalize_budget(budget) for budget in (-500, -0.5, 0.5)], [0, 0, 0])
+        self.assertEqual(RouteCache.make_key('MOW', 'LED', budget=-500).budget, 0)
+        self.assertEqual(RouteCache.make_key('MOW', 'LED', airlines=['SU', 'S7']).airlines, ('S7', 'SU'))
+
+        today = datetime.today()
+        near_key = RouteCache.make_key('MOW', 'LED', departure_at=(today + timedelta(days=1)).strftime('%Y-%m-%d'))
+        far_key = RouteCache.make_key('MOW', 'LED', departure_at=(today + timedelta(days=90)).strftime('%Y-%m-%d'))
+        self.assertLess(price_freshness(near_key, [], 0), price_freshness(far_key, [], 0))
+
+    @patch('api_collector.route.route.AirTicketsApi')
+    def test_alternative_routes(self, MockAirTicketsApi):
+        MockAirTicketsApi.return_value.fetch_alternative_route_tickets.return_value = {'prices': [
+            {'origin': 'MOW', 'destination': 'PKV', 'depart_date': '2024-07-01', 'return_date': '2024-07-04',
+             'distance': 600, 'duration': 120, 'number_of_changes': 0, 'value': 6000.0},
+            {'origin': 'MOW', 'destination': 'LED', 'depart_date': '2024-07-01', 'return_date': '2024-07-04',
+             'distance': 650, 'duration': 90, 'number_of_changes': 1, 'value': 5000.0},
+        ]}
+        alternative_tickets = fetch_alternative_tickets('MOW', 'LED', '2024-07-01', '2024-07-04')
+        self.assertEqual([ticket['price'] for ticket in alternative_tickets], [5000.0, 6000.0])
+        self.assertEqual(alternative_tickets[0]['link'], '/search/MOW0107LED04071')
+        self.assertEqual(len(fetch_alternative_tickets('MOW', 'LED', '2024-07-01', '2024-07-04', max_transfers=0,
+                                                       max_flight_duration=1.5)), 1)
+        # alternative options have no airline
+        self.assertEqual(fetch_alternative_tickets('MOW', 'LED', '2024-07-01', '2024-07-04', airlines=['SU']), [])
+
+        hotel = Hotel(hotel_json())
+        not_found = [Route('MOW', 'LED', '2024-07-01', '2024-07-04', budget=10000, ticket=Ticket(None), hotel=hotel)]
+        # alternatives replace the route without a ticket
+        routes = add_alternative_routes(not_found, alternative_tickets, budget=10000, route_number=3)
+        self.assertEqual([route.ticket.ticket_price for route in routes], [5000.0, 6000.0])
+        self.assertTrue(all(route.ticket.alternative and route.hotel is hotel for route in routes))
+        self.assertIn('Nearby Airport Option', routes[1].to_string_en())
+        # only a cheaper alternative to other airports is added to found routes
+        found_ticket = Ticket(dict(alternative_tickets[1], alternative=False, flight_number='10', price=5500.0))
+        found = [Route('MOW', 'LED', '2024-07-01', '2024-07-04', budget=10000, ticket=found_ticket, hotel=hotel)]
+        self.assertEqual(len(add_alternative_routes(found, alternative_tickets, budget=10000)), 1)
+        found_ticket = Ticket(dict(alternative_tickets[1], alternative=False, flight_number='10', price=6500.0))
+        found = [Route('MOW', 'LED', '2024-07-01', '2024-07-04', budget=10000, ticket=found_ticket, hotel=hotel)]
+        routes = add_alternative_routes(found, alternative_tickets, budget=10000)
+        self.assertEqual([route.ticket.key for route in routes], [('10', '2024-07-01'),
+                                                                  ('MOW', 'PKV', '2024-07-01')])
+
+    @patch('api_collector.route.route.HotelApi')
+    def test_fetch_hotel_photo_ids_cache(self, MockHotelApi):
+        route_module._photo_ids_cache.clear()
+        fetch_hotel_photos = MockHotelApi.return_value.fetch_hotel_photos
+        fetch_hotel_photos.side_effect = lambda hotel_ids, **kwargs: {str(hotel_id): [hotel_id] for hotel_id in hotel_ids}
+        self.assertEqual(route_module.fetch_hotel_photo_ids([1, 2]), {'1': [1], '2': [2]})
+        # only hotels which photo ids are not cached are requested
+        self.assertEqual(route_module.fetch_hotel_photo_ids([2, 3]), {'2': [2], '3': [3]})
+        fetch_hotel_photos.assert_called_with(hotel_ids=[3], return_only_urls=True)
+        route_module.fetch_hotel_photo_ids([2, 3], refresh=True)
+        fetch_hotel_photos.assert_called_with(hotel_ids=[2, 3], return_only_urls=True)
+        self.assertEqual(route_module.fetch_hotel_photo_ids([]), {})
+        # photo ids are saved, so they are not requested again after the memory cache expires
+        route_module._photo_ids_cache.clear()
+        self.assertEqual(route_module.fetch_hotel_photo_ids([1, 3, 4]), {'1': [1], '3': [3], '4': [4]})
+        fetch_hotel_photos.assert_called_with(hotel_ids=[4], return_only_urls=True)
+        with patch('api_collector.hotels.photo_ids.time.time', return_value=time.time() + PHOTO_IDS_MAX_AGE):
+            route_module._photo_ids_cache.clear()
+            route_module.fetch_hotel_photo_ids([1, 3])
+        fetch_hotel_photos.assert_called_with(hotel_ids=[1, 3], return_only_urls=True)
+        # urls are built from photo ids
+        hotel = Hotel(hotel=None)
+        hotel.photo_ids = [5]
+        self.assertEqual(hotel.photo_urls, ['https://photo.hotellook.com/image_v2/limit/5/800/520.auto'])
+
+    @patch('api_collector.route.warmer.price_calendar')
+    @patch('api_collector.route.warmer.fetch_hotel_photo_ids')
+    @patch('api_collector.route.warmer.hotel_list_age')
+    @patch('api_collector.route.warmer.HotelApi')
+    @patch('api_collector.route.warmer.AirTicketsApi')
+    def test_cache_warmer(self, MockAirTicketsApi, MockHotelApi, mock_hotel_list_age, mock_fetch_hotel_photo_ids,
+                          mock_price_calendar):
+        hotel = Hotel(hotel_json())
+        warmer = CacheWarmer()
+        for destination in ('LED', 'LED', 'AER'):
+            warmer.record_routes([Route('MOW', destination, '2024-07-01', '2024-07-04', ticket=Ticket(None),
+                                        hotel=hotel if destination == 'LED' else Hotel(None))])
+        self.assertEqual(warmer.plan(), [('price_calendar', ('MOW', 'LED', '2024-07')), ('hotel_list', 1),
+                                         ('photo_ids', (7,)), ('price_calendar', ('MOW', 'AER', '2024-07'))])
+
+        # the fresh hotel list is not loaded again and the budget stops the round
+        mock_hotel_list_age.return_value = 0
+        self.assertEqual(warmer.warm(call_budget=2), 2)
+        MockAirTicketsApi.fetch_grouped_tickets.refresh.assert_called_once_with(
+            MockAirTicketsApi.return_value, origin='MOW', destination='LED', departure_at='2024-07')
+        MockHotelApi.return_value.fetch_hotel_list.assert_not_called()
+        mock_fetch_hotel_photo_ids.assert_called_once_with([7], refresh=True)
+        # searches requested once stay warm for several rounds and are forgotten later
+        plan = warmer.plan()
+        for _ in range(10):
+            warmer.warm(call_budget=0)
+        self.assertEqual(warmer.plan(), plan)
+        self.assertEqual(plan[-1], ('price_calendar', ('MOW', 'AER', '2024-07')))
+        for _ in range(15):
+            warmer.warm(call_budget=0)
+        self.assertEqual(warmer.plan(), [('price_calendar', ('MOW', 'LED', '2024-07')), ('hotel_list', 1),
+                                         ('photo_ids', (7,))])
+        # the price calendar is compacted once a day
+        mock_price_calendar.compact.assert_called_once_with()
+        warmer.compacted_at -= CALENDAR_COMPACT_INTERVAL
+        warmer.warm(call_budget=0)
+        self.assertEqual(mock_price_calendar.compact.call_count, 2)
+
+    @patch('api_collector.route.discovery.save_hotel_photo_urls')
+    @patch('api_collector.route.discovery.get_hotel')
+    @patch('api_collector.route.discovery.get_ticket')
+    @patch('api_collector.route.discovery.AirTicketsApi')
+    def test_find_anywhere_routes(self, MockAirTicketsApi, mock_get_ticket, mock_get_hotel, mock_save_photos):
+        MockAirTicketsApi.return_value.fetch_popular_routes_from_city.return_value = {
+            'success': True,
+            'data': {
+                'AER': {'origin': 'MOW', 'destination': 'AER', 'price': 9000},
+                'LED': {'origin': 'MOW', 'destination': 'LED', 'price': 3000},
+                'OVB': {'origin': 'MOW', 'destination': 'OVB', 'price': 25000}
+            }
+        }
+        ticket_prices = {'AER': 9000.0, 'LED': 3000.0}
+        hotel_prices = {'AER': 5000.0, 'LED': 14000.0}
+
+        def make_ticket(destination, **kwargs):
+            return [Ticket(ticket=ticket_json(
+                destination=destination, destination_airport=destination, price=ticket_prices[destination],
+                flight_number='100', duration=300, duration_to=150, duration_back=150
+            ))]
+
+        def make_hotel(location, **kwargs):
+            return [Hotel(hotel=hotel_json(
+                hotelId=len(location), priceFrom=hotel_prices[location], priceAvg=hotel_prices[location],
+                location={'name': location, 'country': 'Russia', 'state': None, 'geo': {}}
+            ))]
+
+        mock_get_ticket.side_effect = make_ticket
+        mock_get_hotel.side_effect = make_hotel
+
+        routes = discovery.find_anywhere_routes(origin='MOW', departure_at='2024-07-01', return_at='2024-07-04',
+                                                budget=20000, destinations_number=5)
+
+        # OVB ticket alone exceeds the budget and is not priced at all
+        self.assertEqual([route.destination for route in routes], ['AER', 'LED'])
+        self.assertEqual(mock_get_ticket.call_count, 2)
+
+        # repeated search for the same origin and dates is served from cache
+        routes = discovery.find_anywhere_routes(origin='MOW', departure_at='2024-07-01', return_at='2024-07-04',
+                                                budget=15000, destinations_number=5)
+        self.assertEqual([route.destination for route in routes], ['AER'])
+        self.assertEqual(mock_get_ticket.call_count, 2)
+        self.assertEqual(MockAirTicketsApi.return_value.fetch_popular_routes_from_city.call_count, 1)
+        # every search gets its own tickets and hotels, changes of them do not reach the cache
+        routes[0].hotel.photo_ids = [1]
+        cached_routes = discovery.find_anywhere_routes(origin='MOW', departure_at='2024-07-01',
+                                                       return_at='2024-07-04', budget=15000, destinations_number=5)
+        self.assertIsNot(cached_routes[0].hotel, routes[0].hotel)
+        self.assertIsNot(cached_routes[0].ticket, routes[0].ticket)
+        self.assertEqual(cached_routes[0].hotel.photo_ids, [])
+
+        # photos which arrive after the deadline do not change the returned routes
+        release = threading.Event()
+        attached = threading.Event()
+
+        def save_photos(photo_routes):
+            release.wait(5)
+            for route in photo_routes:
+                route.hotel.photo_ids = [1]
+            attached.set()
+        mock_save_photos.side_effect = save_photos
+        try:
+            routes = discovery.find_anywhere_routes(origin='MOW', departure_at='2024-07-01', return_at='2024-07-04',
+                                                    budget=15000, destinations_number=5, deadline=0.05)
+        finally:
+            release.set()
+        attached.wait(5)
+        self.assertTrue(routes[0].partial)
+        self.assertEqual(routes[0].hotel.photo_ids, [])
+        mock_save_photos.side_effect = None
+
+        # destinations which are not priced before the deadline are skipped and the result is not cached
+        release = threading.Event()
+        mock_get_hotel.side_effect = lambda location, **kwargs: \
+            make_hotel(location) if location == 'AER' or release.wait(5) else None
+        try:
+            routes = discovery.find_anywhere_routes(origin='MOW', departure_at='2024-07-02',
+                                                    return_at='2024-07-05', budget=20000, destinations_number=5,
+                                                    deadline=0.05)
+        finally:
+            release.set()
+        self.assertEqual([route.destination for route in routes], ['AER'])
+        self.assertTrue(routes[0].partial)
+        self.assertEqual(len(discovery._priced_destinations_cache), 1)
+
+
+class TestAsyncRouteCollector(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        clear_caches()
+        # locations and photo ids are saved in memory instead of the data directory
+        for name, store in (('location_index', LocationIndex(':memory:')), ('photo_id_store', PhotoIdStore(':memory:'))):
+            patcher = patch(f'api_collector.route.route.{name}', store)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @patch('api_collector.route.async_route.AirTicketsApi')
+    async def test_capped_page_size(self, MockAirTicketsApi):
+        # the upstream ignores the limit and returns pages of 20 tickets
+        MockAirTicketsApi.return_value.fetch_cheapest_tickets.side_effect = \
+            lambda limit, page, **kwargs: {'success': True, 'data': [{'price': 1000.0}] * (20 if page <= 4 else 0)}
+        pages = [len(tickets) async for tickets in iterate_ticket_pages_async('MOW', 'LED', page_concurrency=2)]
+        # waves of pages which are not full go on until the empty page
+        self.assertEqual(pages, [40, 40])
+        self.assertEqual(MockAirTicketsApi.return_value.fetch_cheapest_tickets.call_count, 6)
+
+    @patch('api_collector.route.async_route.fetch_alternative_tickets', return_value=[])
+    @patch('api_collector.route.async_route.fetch_hotel_photo_ids')
+    @patch('api_collector.route.async_route.find_filtered_hotels')
+    @patch('api_collector.route.async_route.fetch_hotel_prices')
+    @patch('api_collector.route.async_route.AirTicketsApi')
+    async def test_find_top_routes_async(self, MockAirTicketsApi, mock_fetch_hotel_prices,
+                                         mock_find_filtered_hotels, mock_fetch_hotel_photo_ids,
+                                         mock_fetch_alternative_tickets):
+        # tickets and hotel prices are requested at the same time, the barrier is broken if one waits for another
+        started = threading.Barrier(2, timeout=5)
+
+        def fetch_cheapest_tickets(page, **kwargs):
+            if page == 1:
+                started.wait()
+            data = [ticket_json(price=3000.0 + price, flight_number=str(price)) for price in range(3)]
+            return {'success': True, 'data': data if page == 1 else []}
+
+        def fetch_hotel_prices(*args):
+            started.wait()
+            return [hotel_json(hotelId=hotel_id, priceFrom=1000.0 * hotel_id, priceAvg=1000.0 * hotel_id)
+                    for hotel_id in (3, 1, 2)]
+
+        def find_filtered_hotels(**kwargs):
+            return [1, 2, 3]
+
+        MockAirTicketsApi.return_value.fetch_cheapest_tickets.side_effect = fetch_cheapest_tickets
+        mock_fetch_hotel_prices.side_effect = fetch_hotel_prices
+        mock_find_filtered_hotels.side_effect = find_filtered_hotels
+        mock_fetch_hotel_photo_ids.side_effect = lambda hotel_ids: {str(hotel_id): [hotel_id] for hotel_id in hotel_ids}
+
+        routes = await find_top_routes_async(origin='MOW', destination='LED', departure_at='2024-07-01',
+                                             return_at='2024-07-04', route_number=3)
+
+        self.assertFalse(started.broken)
+        self.assertEqual(routes[0].ticket.ticket_price, 3000.0)
+        self.assertEqual(routes[0].hotel.hotel_id, 1)
+        self.assertEqual(len(routes[0].hotel.photo_urls), 1)
+        # photos of the cheapest hotels are requested once, in advance
+        mock_fetch_hotel_photo_ids.assert_called_once_with([1, 2, 3])
+
+    @patch('api_collector.route.async_route.fetch_alternative_tickets', return_value=[])
+    @patch('api_collector.route.async_route.fetch_hotel_photo_ids')
+    @patch('api_collector.route.async_route.find_filtered_hotels')
+    @patch('api_collector.route.async_route.fetch_hotel_prices')
+    @patch('api_collector.route.async_route.AirTicketsApi')
+    async def test_stream_top_routes(self, MockAirTicketsApi, mock_fetch_hotel_prices, mock_find_filtered_hotels,
+                                     mock_fetch_hotel_photo_ids, mock_fetch_alternative_tickets):
+        # pages after the first wave arrive only when the first routes have been yielded
+        first_yield = threading.Event()
+        finished_pages = []
+
+        def fetch_cheapest_tickets(page, limit, **kwargs):
+            # every next wave of pages contains more expensive tickets
+            if page > 3:
+                first_yield.wait(5)
+            finished_pages.append(page)
+            data = [ticket_json(price=1000.0 * page, flight_number=f'{page}-{number}') for number in range(limit)]
+            return {'success': True, 'data': data if page <= 6 else []}
+
+        MockAirTicketsApi.return_value.fetch_cheapest_tickets.side_effect = fetch_cheapest_tickets
+        mock_fetch_hotel_prices.return_value = [hotel_json(hotelId=1)]
+        mock_find_filtered_hotels.return_value = [1]
+        mock_fetch_hotel_photo_ids.side_effect = lambda hotel_ids: {str(hotel_id): [hotel_id] for hotel_id in hotel_ids}
+
+        yields = []
+        try:
+            async for routes in stream_top_routes(origin='MOW', destination='LED', departure_at='2024-07-01',
+                                                  return_at='2024-07-04', budget=10000, route_number=1):
+                yields.append((list(finished_pages), routes))
+                first_yield.set()
+        finally:
+            first_yield.set()
+
+        # the first route comes with the first wave of pages, before the pagination is finished
+        self.assertEqual(sorted(yields[0][0]), [1, 2, 3])
+        self.assertEqual(yields[0][1][0].ticket.ticket_price, 3000.0)
+        # routes are refined when more expensive tickets fitting the budget arrive
+        self.assertEqual(yields[-1][1][0].ticket.ticket_price, 4000.0)
+        self.assertGreater(max(yields[-1][0]), 3)
+        self.assertEqual(yields[-1][1][0].hotel.photo_urls,
+                         ['https://photo.hotellook.com/image_v2/limit/1/800/520.auto'])
+
+        # the same search with a close budget is served from the cache at once
+        calls = MockAirTicketsApi.return_value.fetch_cheapest_tickets.call_count
+        yields = [routes async for routes in stream_top_routes(origin='MOW', destination='LED',
+                                                               departure_at='2024-07-01', return_at='2024-07-04',
+                                                               budget=10100, route_number=1)]
+        self.assertEqual(len(yields), 1)
+        self.assertEqual(yields[0][0].ticket.ticket_price, 4000.0)
+        self.assertEqual(yields[0][0].budget, 10100)
+        self.assertEqual(MockAirTicketsApi.return_value.fetch_cheapest_tickets.call_count, calls)
+
+    @patch('api_collector.route.async_route.fetch_alternative_tickets', return_value=[])
+    @patch('api_collector.route.route.fetch_alternative_tickets', return_value=[])
+    @patch('api_collector.route.async_route.fetch_hotel_photo_ids', return_value={})
+    @patch('api_collector.route.route.fetch_hotel_photo_ids', return_value={})
+    @patch('api_collector.route.route.load_hotel_index')
+    @patch('api_collector.route.route.HotelApi')
+    @patch('api_collector.route.async_route.AirTicketsApi')
+    @patch('api_collector.route.route.AirTicketsApi')
+    async def test_sync_and_async_routes_with_hotel_filters(self, MockAirTicketsApi, MockAsyncAirTicketsApi,
+                                                            MockHotelApi, mock_load_hotel_index, *mocks):
+        fetch_cheapest_tickets = ticket_pages([ticket_json(price=3000.0 + 500 * number, flight_number=str(number))
+                                               for number in range(10)])
+        MockAirTicketsApi.return_value.fetch_cheapest_tickets.side_effect = fetch_cheapest_tickets
+        MockAsyncAirTicketsApi.return_value.fetch_cheapest_tickets.side_effect = fetch_cheapest_tickets
+        MockHotelApi.return_value.fetch_hotel_prices.return_value = sorted([hotel_json(
+            hotelId=hotel_id, priceFrom=1000.0 + hotel_id * 37 % 60 * 100, stars=hotel_id % 6,
+            hotelName=f'Hotel {hotel_id}'
+        ) for hotel_id in range(60)], key=lambda hotel: hotel['priceFrom'])
+        mock_load_hotel_index.return_value = HotelIndex([{
+            'id': hotel_id, 'propertyType': 1, 'stars': hotel_id % 6, 'distance': hotel_id / 10,
+            'shortFacilities': ['pool'] if hotel_id % 3 == 0 else []} for hotel_id in range(60)])
+        search = dict(origin='MOW', destination='LED', departure_at='2024-07-01', return_at='2024-07-04',
+                      budget=20000, route_number=3, min_stars=1, amenities=('pool',), max_distance=4.0)
+
+        sync_routes = await asyncio.to_thread(find_top_routes, **search)
+        route_cache.clear()
+        async_routes = await find_top_routes_async(**search)
+
+        hotel_ids = [route.hotel.hotel_id for route in sync_routes]
+        self.assertEqual([route.hotel.hotel_id for route in async_routes], hotel_ids)
+        self.assertEqual([route.ticket.ticket_price for route in async_routes],
+                         [route.ticket.ticket_price for route in sync_routes])
+        # only hotels with a pool, at least one star and close to the center are chosen
+        self.assertTrue(all(hotel_id % 3 == 0 and hotel_id % 6 >= 1 and hotel_id <= 40 for hotel_id in hotel_ids))
+        self.assertGreater(len(hotel_ids), 1)
+        # the filters are a part of the cache key
+        self.assertIsNone(route_cache.get(route_cache.make_key(**{**search, 'amenities': ()})))
+
+    @patch('api_collector.route.route.HotelApi')
+    @patch('api_collector.route.route.find_filtered_hotels', return_value=[1, 2])
+    @patch('api_collector.route.async_route.fetch_alternative_tickets', return_value=[])
+    @patch('api_collector.route.async_route.fetch_hotel_photo_ids', return_value={})
+    @patch('api_collector.route.async_route.find_filtered_hotels', return_value=[1, 2])
+    @patch('api_collector.route.async_route.fetch_hotel_prices')
+    @patch('api_collector.route.async_route.AirTicketsApi')
+    async def test_stream_top_routes_from_collections(self, MockAirTicketsApi, mock_fetch_hotel_prices,
+                                                      mock_find_filtered_hotels, mock_fetch_hotel_photo_ids,
+                                                      mock_fetch_alternative_tickets, mock_route_find_filtered_hotels,
+                                                      MockHotelApi):
+        MockAirTicketsApi.return_value.fetch_cheapest_tickets.side_effect = ticket_pages([ticket_json()], page_size=1)
+        route_module.location_index.add_locations([{'id': '1', 'cityName': 'Saint Petersburg',
+                                                    'countryName': 'Russia'}], query='LED')
+        MockHotelApi.return_value.fetch_hotel_collections.return_value = {'cheaphotel': [
+            {'hotel_id': 1, 'name': 'Hotel 1', 'stars': 3, 'last_price_info': {
+                'price': 1000.0, 'search_params': {'checkIn': '2024-07-01', 'checkOut': '2024-07-04'}}}]}
+        # the full price list arrives only after the routes from collections are yielded
+        first_yield = threading.Event()
+
+        def fetch_hotel_prices(*args):
+            first_yield.wait(5)
+            return [hotel_json(hotelId=2, priceFrom=900.0, priceAvg=900.0, hotelName='Hotel 2')]
+
+        mock_fetch_hotel_prices.side_effect = fetch_hotel_prices
+        yields = []
+        try:
+            async for routes in stream_top_routes(origin='MOW', destination='LED', departure_at='2024-07-01',
+                                                  return_at='2024-07-04', route_number=1):
+                yields.append(routes)
+                first_yield.set()
+        finally:
+            first_yield.set()
+
+        self.assertEqual(yields[0][0].hotel.hotel_id, 1)
+        # the full price list refines the routes
+        self.assertEqual(yields[-1][0].hotel.hotel_id, 2)
+
+    @patch('api_collector.route.async_route.HotelApi')
+    async def test_fetch_hotel_photo_files_async(self, MockHotelApi):
+        pipeline = ThumbnailPipeline(max_workers=1)
+        self.addCleanup(pipeline.shutdown)
+        with tempfile.TemporaryDirectory() as directory, \
+                patch('api_collector.route.async_route.thumbnail_pipeline', pipeline):
+            def fetch_and_save_photo(url, hotel_id, photo_index, extension):
+                if photo_index == 2:
+                    raise Exception(f'Failed to fetch photo from {url}')
+                path = os.path.join(directory, f'photo{photo_index}.{extension}')
+                Image.new('RGB', (800, 520), 'blue').save(path, 'JPEG')
+                return path
+
+            MockHotelApi.return_value.fetch_and_save_photo.side_effect = fetch_and_save_photo
+            hotel = Hotel(hotel=None)
+            hotel.hotel_id = 7
+            hotel.photo_ids = [10, 11, 12]
+            paths = await fetch_hotel_photo_files_async(hotel, max_photo_number=2)
+
+            # photos are downloaded as JPEG, so they can be resized, failed photos are skipped
+            self.assertEqual(MockHotelApi.return_value.fetch_and_save_photo.call_args_list[0].args,
+                             ('https://photo.hotellook.com/image_v2/limit/10/800/520.jpg', 7, 1))
+            self.assertEqual(MockHotelApi.return_value.fetch_and_save_photo.call_count, 2)
+            self.assertEqual(paths, [os.path.join(directory, 'photo1.medium.webp')])
+            with Image.open(paths[0]) as medium:
+                self.assertEqual(medium.size, (640, 416))
+
+    @patch('api_collector.route.prefetch.fetch_hotel_prices')
+    @patch('api_collector.route.prefetch.warm_ticket_pages')
+    @patch('api_collector.route.prefetch.warm_price_calendar')
+    @patch('api_collector.route.prefetch.warm_hotel_list')
+    async def test_route_prefetcher(self, mock_warm_hotel_list, mock_warm_price_calendar, mock_warm_ticket_pages,
+                                    mock_fetch_hotel_prices):
+        prefetcher = RoutePrefetcher()
+        prefetcher.notify({'Destination': 'LED'})
+        first_task = prefetcher.task
+        # the same state does not restart the prefetch
+        prefetcher.notify({'Destination': 'LED', 'Budget': 10000})
+        self.assertIs(prefetcher.task, first_task)
+        # changed state cancels the previous prefetch
+        prefetcher.notify({'Departure': 'MOW', 'Destination': 'LED', 'Arrival': '2024-07-01',
+                           'Return': '2024-07-04'})
+        self.assertTrue(first_task.cancelled() or first_task.cancelling())
+        await prefetcher.task
+
+        mock_warm_hotel_list.assert_called_with('LED')
+        mock_warm_price_calendar.assert_called_once_with('MOW', 'LED', '2024-07-01')
+        mock_warm_ticket_pages.assert_called_once_with('MOW', 'LED', '2024-07-01', '2024-07-04')
+        mock_fetch_hotel_prices.assert_called_once_with('LED', '2024-07-01', '2024-07-04')
+
+        prefetcher.cancel()
+        self.assertIsNone(prefetcher.task)
+
+    @patch('api_collector.route.async_route.fetch_alternative_tickets', return_value=[])
+    @patch('api_collector.route.async_route.fetch_hotel_photo_ids')
+    @patch('api_collector.route.async_route.find_filtered_hotels')
+    @patch('api_collector.route.async_route.fetch_hotel_prices')
+    @patch('api_collector.route.async_route.AirTicketsApi')
+    async def test_stream_top_routes_deadline(self, MockAirTicketsApi, mock_fetch_hotel_prices,
+                                              mock_find_filtered_hotels, mock_fetch_hotel_photo_ids,
+                                              mock_fetch_alternative_tickets):
+        # the second wave of pages does not arrive before the deadline
+        release = threading.Event()
+        finished_pages = []
+
+        def fetch_cheapest_tickets(page, limit, **kwargs):
+            if page > 3:
+                release.wait(5)
+            finished_pages.append(page)
+            data = [ticket_json(price=1000.0 * page, flight_number=f'{page}-{number}') for number in range(limit)]
+            return {'success': True, 'data': data}
+
+        MockAirTicketsApi.return_value.fetch_cheapest_tickets.side_effect = fetch_cheapest_tickets
+        mock_fetch_hotel_prices.return_value = [hotel_json(hotelId=1)]
+        mock_find_filtered_hotels.return_value = [1]
+        mock_fetch_hotel_photo_ids.side_effect = lambda hotel_ids: {str(hotel_id): [hotel_id] for hotel_id in hotel_ids}
+
+        try:
+            routes = await find_top_routes_async(origin='MOW', destination='LED', departure_at='2024-07-01',
+                                                 return_at='2024-07-04', budget=10000, route_number=1,
+                                                 deadline=0.3)
+            # the search has returned without waiting for the second wave
+            self.assertEqual(sorted(finished_pages), [1, 2, 3])
+        finally:
+            release.set()
+        # routes are built from the first wave of pages and marked as partial
+        self.assertTrue(routes[0].partial)
+        self.assertEqual(routes[0].ticket.ticket_price, 3000.0)
+        self.assertTrue(routes[0].hotel.found)
+        # partial routes are not cached
+        self.assertIsNone(route_cache.get(route_cache.make_key(origin='MOW', destination='LED',
+                                                               departure_at='2024-07-01', return_at='2024-07-04',
+                                                               budget=10000, route_number=1)))
+
+    @patch('api_collector.route.batch.find_top_routes_async')
+    async def test_plan_routes_batch(self, mock_find_top_routes_async):
+        ticket = Ticket(ticket_json())
+
+        async def find_top_routes_async(origin, destination, **kwargs):
+            if destination == 'XXX':
+                raise Exception('response was not successful')
+            return [Route(origin, destination, kwargs['departure_at'], kwargs['return_at'], budget=kwargs['budget'],
+                          ticket=ticket, hotel=Hotel(None))]
+
+        mock_find_top_routes_async.side_effect = find_top_routes_async
+        queries = [{'Departure': 'MOW', 'Destination': destination, 'Arrival': '2024-07-01', 'Return': '2024-07-04',
+                    'Budget': "None"} for destination in ('LED', 'XXX', 'LED')]
+        output = io.StringIO()
+        stats = await plan_routes_batch(queries, output, max_concurrency=2)
+
+        results = sorted((json.loads(line) for line in output.getvalue().splitlines()),
+                         key=lambda result: result['index'])
+        self.assertEqual([result['index'] for result in results], [0, 1, 2])
+        self.assertEqual(results[0]['routes'][0]['ticket']['price'], 3000.0)
+        self.assertIsNone(results[0]['routes'][0]['hotel'])
+        self.assertIsNone(results[0]['routes'][0]['budget'])
+        self.assertIn('error', results[1])
+        self.assertEqual(stats['queries'], 3)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['upstream_calls'], 0)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -61,6 +61,10 @@ class TestRetrievers(unittest.TestCase):
             'None',
             "expected_answer": (ValueStages.FIELD_NOT_FOUND,
                                 "The user has not entered this field")
+        }, {
+            "retrieved_field": 'Anywhere',
+            "expected_answer": (ValueStages.OK,
+                                "The user wants to go anywhere")
         }]
 
         for case in test_cases: